@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012-2016 Xue Can <xuecan@gmail.com> and contributors.
+# Licensed under the MIT license: http://opensource.org/licenses/mit-license
+
+"""
+比较 ``logging.Formatter`` 和 ``logkit.JSONFormatter`` 格式化日志记录的耗时。
+
+用法::
+
+    python benchmarks/logkit_formatters.py [次数]
+"""
+
+import os
+import sys
+import timeit
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ganggu import logkit  # noqa
+
+
+def _record(extra):
+    logger = logkit.get_logger('benchmark')
+    return logger.makeRecord('benchmark', logging.INFO, __file__, 1,
+                             'user %s fetched %d items', ('alice', 42),
+                             None, extra=extra)
+
+
+def _json_formatter(use_orjson):
+    orjson = logkit.orjson
+    if not use_orjson:
+        logkit.orjson = None
+    try:
+        return logkit.JSONFormatter()
+    finally:
+        logkit.orjson = orjson
+
+
+def main(number=100000):
+    formatters = [
+        ('logging.Formatter', logging.Formatter(
+            logkit.DEFAULTS['LOG-FORMAT'], logkit.DEFAULTS['DATE-FORMAT'])),
+        ('JSONFormatter+json', _json_formatter(False)),
+    ]
+    if logkit.orjson is not None:
+        formatters.append(('JSONFormatter+orjson', _json_formatter(True)))
+    extras = [('no extra', None),
+              ('extra', {'request_id': 'abc123', 'task_id': 7})]
+    print('%-22s %10s %10s' % ('formatter', extras[0][0], extras[1][0]))
+    for name, formatter in formatters:
+        costs = []
+        for _, extra in extras:
+            record = _record(extra)
+            seconds = timeit.timeit(lambda: formatter.format(record),
+                                    number=number)
+            costs.append(seconds / number * 1e6)
+        print('%-22s %8.2fus %8.2fus' % (name, costs[0], costs[1]))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
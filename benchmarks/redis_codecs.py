@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012-2016 Xue Can <xuecan@gmail.com> and contributors.
+# Licensed under the MIT license: http://opensource.org/licenses/mit-license
+
+"""
+比较 ``redisstore.Codec`` 各种组合的编解码耗时和数据大小。
+
+用法::
+
+    python benchmarks/redis_codecs.py [次数]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ganggu.redisstore import Codec, SERIALIZERS, COMPRESSORS  # noqa
+
+
+# 一个典型的缓存对象：一组记录的列表
+SAMPLE = [
+    {'id': i, 'name': 'item-%d' % i, 'price': i * 1.5,
+     'tags': ['foo', 'bar', 'baz'], 'enabled': i % 2 == 0}
+    for i in range(200)
+]
+
+
+def main(number=1000):
+    print('%-16s %10s %12s %12s' % ('codec', 'bytes', 'encode(us)',
+                                    'decode(us)'))
+    for serializer in sorted(SERIALIZERS):
+        for compression in [None] + sorted(COMPRESSORS):
+            codec = Codec(serializer, compression)
+            payload = codec.encode(SAMPLE)
+            encode = timeit.timeit(lambda: codec.encode(SAMPLE),
+                                   number=number)
+            decode = timeit.timeit(lambda: codec.decode(payload),
+                                   number=number)
+            name = serializer + ('+' + compression if compression else '')
+            print('%-16s %10d %12.1f %12.1f' % (
+                name, len(payload),
+                encode / number * 1e6, decode / number * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -10,6 +10,9 @@ Celery 应用程序的配置众多，这里提供一个快速的生成器，避
 本模块根据 Celery 4.0.0rc4 重新编写。配置详情请参考：
 
 * http://docs.celeryproject.org/en/master/userguide/configuration.html
+
+执行任务时，任务的 ``task_id`` 和 ``task_name`` 被绑定到 logkit 的上下文，
+任务中输出的日志都带有这两个字段。
 """
 
 import celery
@@ -17,8 +20,13 @@ if '4.0.0' > celery.__version__:
     raise RuntimeError('Require celery 4.0.0rc4 or up')
 
 from celery import Celery
+from celery.signals import task_prerun, task_postrun
 from kombu.exceptions import OperationalError
 from .datastructures import Object
+from . import logkit
+
+# task_id -> 绑定 logkit 上下文时得到的 token
+_LOG_CONTEXT_TOKENS = {}
 
 
 def make_worker(name, set_as_current=True):
@@ -91,6 +99,19 @@ def with_backend(worker, backend):
     worker.conf.result_backend = backend
 
 
+@task_prerun.connect
+def _bind_log_context(task_id=None, task=None, **kwargs):
+    _LOG_CONTEXT_TOKENS[task_id] = logkit.bind(
+        task_id=task_id, task_name=getattr(task, 'name', None))
+
+
+@task_postrun.connect
+def _reset_log_context(task_id=None, **kwargs):
+    token = _LOG_CONTEXT_TOKENS.pop(task_id, None)
+    if token is not None:
+        logkit.reset_context(token)
+
+
 # patch: don't use image
 import celery.utils.term
 celery.utils.term.supports_images = lambda: False
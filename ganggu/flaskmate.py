@@ -12,13 +12,21 @@
 
 __all__ = ['render_template', 'url_for', 'jsonify', 'urlize',
            'redirect', 'js_redirect', 'abort', 'json_abort',
-           'JsonAbort', 'register_json_abort_handler']
+           'JsonAbort', 'register_json_abort_handler',
+           'register_log_context']
 
+import re
+import uuid
 import urllib
 from flask import render_template, url_for, abort, jsonify, redirect
+from flask import g, request
 from werkzeug.wrappers import BaseResponse
 from werkzeug.utils import escape
 from werkzeug.http import HTTP_STATUS_CODES
+from . import logkit
+
+# 可以接受的客户端请求 ID，其它的请求 ID 会被替换为新生成的
+_REQUEST_ID = re.compile(r'[A-Za-z0-9._:-]{1,128}')
 
 
 def js_redirect(location, template=None):
@@ -78,3 +86,36 @@ def register_json_abort_handler(app):
 
 def json_abort(status_code=200, message=None, payload=None):
     raise JsonAbort(status_code, message, payload)
+
+
+def register_log_context(app, header='X-Request-ID'):
+    """处理每个请求时把 ``request_id`` 绑定到 logkit 的上下文。
+
+    ``request_id`` 取自请求头 ``header``，没有时或者不是 1 到 128 个字母、
+    数字和 ``._:-`` 时生成一个，并通过响应的同名头返回给客户端。
+
+    Args:
+        app (flask.Flask): Flask 应用程序。
+        header (str): 携带请求 ID 的请求头和响应头。
+    """
+
+    @app.before_request
+    def _bind_log_context():
+        request_id = request.headers.get(header)
+        if not request_id or not _REQUEST_ID.fullmatch(request_id):
+            request_id = uuid.uuid4().hex
+        g.request_id = request_id
+        g.logkit_token = logkit.bind(request_id=g.request_id)
+
+    @app.after_request
+    def _add_request_id(response):
+        request_id = g.get('request_id')
+        if request_id is not None:
+            response.headers.setdefault(header, request_id)
+        return response
+
+    @app.teardown_request
+    def _reset_log_context(error=None):
+        token = g.pop('logkit_token', None)
+        if token is not None:
+            logkit.reset_context(token)
@@ -0,0 +1,561 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012-2016 Xue Can <xuecan@gmail.com> and contributors.
+# Licensed under the MIT license: http://opensource.org/licenses/mit-license
+
+"""
+HTTP 工具包
+===========
+
+本模块简单封装了 requests 包，提供了默认的超时设置和一些调试需要的工具。
+
+模块级的 ``get()``、``post()`` 等函数共享一个进程内的 ``Session``，以便复用
+连接池中的 TCP/TLS 连接。连接池的大小可以通过 ``POOL_CONNECTIONS``、
+``POOL_MAXSIZE`` 和 ``set_pool_size()`` 设置；共享的 ``Session`` 不保存
+cookies，fork 之后子进程会使用新的 ``Session``，``close_all()`` 关闭所有连接。
+
+``gather()`` 通过共享的 ``Session`` 并发地发送一批请求。
+
+``download()`` 和 ``upload()`` 以固定大小的块传输大文件，支持断点续传和
+校验和，参见子模块 ``httpkit.transfer``。
+
+``Session`` 可以设置重试和熔断策略，参见子模块 ``httpkit.policy``；以及
+GET 请求的响应缓存，参见子模块 ``httpkit.cache``；以及幂等请求的对冲，参见
+子模块 ``httpkit.hedge``；以及请求各阶段的耗时统计，参见子模块
+``httpkit.timing``。
+
+子模块 ``httpkit.aio`` 提供了基于 aiohttp 的同名协程。
+
+本模块依赖如下第三方库：
+
+* `requests <http://docs.python-requests.org/en/master/>`_
+"""
+
+import os
+import time
+import socket
+import http.client
+import http.cookiejar
+import logging
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+from .. import logkit  # logkit 需要在 requests 之前被 import
+import requests
+from requests.sessions import merge_setting
+from requests.structures import CaseInsensitiveDict
+from urllib3.connection import HTTPConnection
+from platform import python_version
+from .transfer import download, upload
+from .timing import TimingAdapter
+
+__all__ = ['debug_on', 'debug_off', 'debug_mode', 'Session',
+           'shared_session', 'close_all', 'set_pool_size',
+           'gather', 'DeadlineExceeded', 'download', 'upload',
+           'get', 'options', 'head', 'post', 'put', 'patch', 'delete',
+           'GET', 'OPTIONS', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE']
+
+__version__ = '1.8.0'
+
+
+# timeouts in seconds: (connect_timeout, read_timeout)
+TIMEOUT = (5.0, 10.0)
+
+# default number of worker threads of ``gather()``
+GATHER_WORKERS = 16
+
+# connection pools of sessions: number of hosts whose pools are kept, and
+# max connections kept per host, no less than ``GATHER_WORKERS`` so that the
+# connections of a ``gather()`` to one host are all kept for reuse
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = GATHER_WORKERS
+# block instead of opening extra connections when a host pool is exhausted
+POOL_BLOCK = False
+
+# URL prefix -> pool maxsize, see ``set_pool_size()``
+HOST_POOLS = {}
+
+# TCP keep-alive probes on pooled connections: idle seconds, interval, count
+TCP_KEEPALIVE = (60, 10, 6)
+
+# logger of requests
+LOGGER = logkit.get_logger('requests.packages.urllib3')
+
+
+def debug_on():
+    """Turn on logging of the requests module."""
+    http.client.HTTPConnection.debuglevel = 1
+    LOGGER.setLevel(logging.DEBUG).setPropagate(True)
+
+
+def debug_off():
+    """Turn off logging of the requests module."""
+    http.client.HTTPConnection.debuglevel = 0
+    LOGGER.setLevel(logging.WARNING).setPropagate(False)
+
+
+@contextlib.contextmanager
+def debug_mode():
+    """Logging of the requests module context."""
+    debug_on()
+    yield
+    debug_off()
+
+
+def _default_user_agent():
+    return 'ganggu.httpkit/%s requests/%s python/%s' % \
+           (__version__, requests.__version__, python_version())
+
+
+def setup_default_user_agent(callback=None):
+    """Setup default user agent.
+
+    Args:
+        callback (callable): A callable returns a string representing
+                             the default user agent.
+    """
+    requests.utils.default_user_agent = callback or _default_user_agent
+
+
+setup_default_user_agent()
+
+
+class KeepAliveAdapter(TimingAdapter):
+    """HTTPAdapter enabling TCP keep-alive on its pooled connections."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        options = list(HTTPConnection.default_socket_options)
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        if TCP_KEEPALIVE and hasattr(socket, 'TCP_KEEPIDLE'):
+            idle, interval, count = TCP_KEEPALIVE
+            options.extend([
+                (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle),
+                (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval),
+                (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count),
+            ])
+        kwargs.setdefault('socket_options', options)
+        super(KeepAliveAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+class _RejectCookies(http.cookiejar.DefaultCookiePolicy):
+    """Keep the shared session stateless like the former per-call sessions."""
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+class Session(requests.Session):
+
+    def __init__(self, policy=None, cache=None, hedge=None, timing=None):
+        """
+        Args:
+            policy (policy.Policy): Retry and circuit breaker policy of
+                                    requests, see ``httpkit.policy``.
+            cache (cache.HTTPCache): Response cache of GET requests, see
+                                     ``httpkit.cache``.
+            hedge (hedge.Hedge): Hedging of idempotent requests, see
+                                 ``httpkit.hedge``.
+            timing (timing.Recorder): Recorder of request timings, see
+                                      ``httpkit.timing``.
+        """
+        super(Session, self).__init__()
+        self.mount('https://', TimingAdapter(pool_maxsize=POOL_MAXSIZE))
+        self.mount('http://', TimingAdapter(pool_maxsize=POOL_MAXSIZE))
+        self.policy = policy
+        self.cache = cache
+        self.hedge = hedge
+        self.timing = timing
+
+    def send(self, request, **kwargs):
+        """Sends a prepared request, recording its timing if required."""
+        recorder = self.timing
+        if recorder is None:
+            return super(Session, self).send(request, **kwargs)
+        token = recorder.begin(request.method, request.url)
+        try:
+            response = super(Session, self).send(request, **kwargs)
+        except Exception as e:
+            recorder.end(token, error=e)
+            raise
+        recorder.end(token, response)
+        return response
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                cookies=None, files=None, auth=None, timeout=None,
+                allow_redirects=True, proxies=None, hooks=None, stream=None,
+                verify=None, cert=None, json=None):
+        """Constructs and sends an HTTP request.
+
+        Args:
+            method (str): Method for the request.
+            url (str|callable): URL for the request. Or a callable should return
+                                the URL.
+            params (bytes|dict): Dictionary or bytes to be sent in the query
+                                 string for the request.
+            data (bytes|dict|file): Dictionary, bytes, or file-like object to send
+                                    in the body of the request.
+            json (dict|list): JSON to send in the body of the request.
+            headers (dict): Dictionary of HTTP Headers to send with the request.
+            cookies (dict|CookieJar): Dict or CookieJar object to send with the request.
+            files (dict): Dictionary of ``'filename': file-like-objects``
+                          for multipart encoding upload.
+            auth (tuple|callable): Auth tuple or callable to enable
+                                   Basic/Digest/Custom HTTP Auth.
+            timeout (float|tuple): How long to wait for the server to send
+                                   data before giving up, as a float, or a (float, float) tuple.
+            allow_redirects (bool):  Set to True by default.
+            proxies (dict): Dictionary mapping protocol or protocol and
+                            hostname to the URL of the proxy.
+            stream (bool): Whether to immediately download the response
+                           content. Defaults to ``False``.
+            verify (bool): Whether the SSL cert will be verified.
+                           A CA_BUNDLE path can also be provided. Defaults to ``True``.
+            cert (str|tuple): If String, path to ssl client cert file (.pem).
+                              If Tuple, ('cert', 'key') pair.
+            hooks (dict): Event hooks.
+
+        Returns:
+            requests.Response: HTTP response.
+        """
+        if not timeout:
+            timeout = TIMEOUT
+        if callable(url):
+            url = url()
+
+        def send(url=url, headers=headers):
+            return super(Session, self).request(method, url, params, data,
+                                                headers, cookies, files, auth,
+                                                timeout, allow_redirects,
+                                                proxies, hooks, stream, verify,
+                                                cert, json)
+
+        def attempt(headers=headers):
+            if self.hedge is None or stream or not self.hedge.applies(method):
+                return send(url, headers)
+            return self.hedge.send(url, headers, send, timeout)
+
+        def dispatch(headers=headers):
+            if self.policy is None:
+                return attempt(headers)
+            rewindable = not files and not hasattr(data, 'read')
+            # the policy sees the headers really sent, session ones included
+            merged = merge_setting(headers, self.headers,
+                                   dict_class=CaseInsensitiveDict)
+            return self.policy.send(method, url, lambda: attempt(headers),
+                                    merged, rewindable)
+
+        if self.cache is not None and method.upper() == 'GET' and not stream:
+            return self.cache.send(url, params, headers, dispatch)
+        return dispatch()
+
+
+# the shared session of module level helpers
+_SHARED = {'session': None}
+_SHARED_LOCK = threading.Lock()
+
+
+def _make_adapter(maxsize):
+    return KeepAliveAdapter(pool_connections=POOL_CONNECTIONS,
+                            pool_maxsize=maxsize, pool_block=POOL_BLOCK)
+
+
+def shared_session():
+    """Return the shared session of this process, creating it if needed.
+
+    Returns:
+        Session: The shared session.
+    """
+    session = _SHARED['session']
+    if session is not None:
+        return session
+    with _SHARED_LOCK:
+        session = _SHARED['session']
+        if session is None:
+            session = Session()
+            session.cookies.set_policy(_RejectCookies())
+            session.mount('https://', _make_adapter(POOL_MAXSIZE))
+            session.mount('http://', _make_adapter(POOL_MAXSIZE))
+            for prefix, maxsize in HOST_POOLS.items():
+                session.mount(prefix, _make_adapter(maxsize))
+            _SHARED['session'] = session
+    return session
+
+
+def set_pool_size(prefix, maxsize):
+    """Set the max connections kept for URLs starting with the prefix.
+
+    Args:
+        prefix (str): URL prefix, e.g. ``'https://api.example.com'``.
+        maxsize (int): Max connections kept in the pool.
+    """
+    with _SHARED_LOCK:
+        HOST_POOLS[prefix] = maxsize
+        session = _SHARED['session']
+        if session is not None:
+            previous = session.adapters.get(prefix)
+            session.mount(prefix, _make_adapter(maxsize))
+            if previous is not None:
+                # the pooled connections of the replaced adapter
+                previous.close()
+
+
+def close_all():
+    """Close the shared session and all its pooled connections."""
+    with _SHARED_LOCK:
+        session, _SHARED['session'] = _SHARED['session'], None
+    if session is not None:
+        session.close()
+
+
+def _reset_after_fork():
+    # the sockets belong to the parent process, just forget them
+    global _SHARED_LOCK
+    _SHARED_LOCK = threading.Lock()
+    _SHARED['session'] = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def request(method, url, **kwargs):
+    """Constructs and sends an HTTP request with the shared session.
+
+    Args:
+        method (str): Method for the request.
+        url (str|callable): URL for the request. Or a callable should return
+                            the URL.
+        \*\*kwargs: Optional arguments that ``Session.request()`` takes.
+
+    Returns:
+        requests.Response: HTTP response.
+    """
+    return shared_session().request(method, url, **kwargs)
+
+
+class DeadlineExceeded(requests.Timeout):
+    """The deadline of ``gather()`` passed before the request completed."""
+
+
+def _cap_timeout(timeout, remaining):
+    """Limit a requests style timeout to the remaining seconds."""
+    if isinstance(timeout, tuple):
+        return tuple(remaining if t is None else min(t, remaining)
+                     for t in timeout)
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def _request_spec(spec):
+    """Return (method, url, kwargs) of a request spec of ``gather()``."""
+    if isinstance(spec, dict):
+        kwargs = dict(spec)
+        method = kwargs.pop('method', 'GET')
+        url = kwargs.pop('url')
+    else:
+        method, url = spec[0], spec[1]
+        kwargs = dict(spec[2]) if len(spec) > 2 else {}
+    return method, url, kwargs
+
+
+def gather(requests_, max_workers=None, per_host_limit=None, deadline=None,
+           session=None):
+    """Sends a batch of requests concurrently.
+
+    Each request spec is either a dict holding ``url``, an optional
+    ``method`` (GET by default) and any other ``Session.request()`` argument,
+    or a ``(method, url[, kwargs])`` tuple.
+
+    Errors are captured: the result of a failed request is its exception
+    instance. When ``deadline`` passes, requests not started yet are
+    cancelled and the results of all unfinished requests are
+    ``DeadlineExceeded`` instances. Timeouts of requests are capped to the
+    remaining time, so that late workers finish soon after.
+
+    Args:
+        requests_ (iterable): Request specs.
+        max_workers (int): Number of threads, ``GATHER_WORKERS`` by default.
+        per_host_limit (int): Max concurrent requests per host, no limit
+                              by default.
+        deadline (float): Seconds for the whole batch, no limit by default.
+        session (Session): Session to use, the shared session by default.
+
+    Returns:
+        list: ``requests.Response`` or exception of each spec, in order.
+    """
+    specs = [_request_spec(spec) for spec in requests_]
+    if not specs:
+        return []
+    session = session or shared_session()
+    expires = None if deadline is None else time.monotonic() + deadline
+    semaphores = {}
+    lock = threading.Lock()
+
+    def remaining():
+        if expires is None:
+            return None
+        left = expires - time.monotonic()
+        if left <= 0:
+            raise DeadlineExceeded('deadline exceeded')
+        return left
+
+    def run(method, url, kwargs):
+        if callable(url):
+            url = url()
+        semaphore = None
+        if per_host_limit:
+            with lock:
+                semaphore = semaphores.setdefault(
+                    urlparse(url).netloc,
+                    threading.BoundedSemaphore(per_host_limit))
+            if not semaphore.acquire(timeout=remaining()):
+                raise DeadlineExceeded('deadline exceeded')
+        try:
+            left = remaining()
+            if left is not None:
+                kwargs['timeout'] = _cap_timeout(
+                    kwargs.get('timeout') or TIMEOUT, left)
+            try:
+                return session.request(method, url, **kwargs)
+            except requests.Timeout:
+                # the capped timeout fired, report it as the deadline
+                remaining()
+                raise
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+    workers = min(max_workers or GATHER_WORKERS, len(specs))
+    executor = ThreadPoolExecutor(max_workers=workers,
+                                  thread_name_prefix='httpkit.gather')
+    futures = [executor.submit(run, *spec) for spec in specs]
+    done, _ = wait(futures, timeout=deadline)
+    executor.shutdown(wait=False, cancel_futures=True)
+    results = []
+    for future in futures:
+        if future in done:
+            results.append(future.exception() or future.result())
+        else:
+            future.cancel()
+            results.append(DeadlineExceeded(
+                'deadline of %.3fs exceeded' % deadline))
+    return results
+
+
+def get(url, params=None, **kwargs):
+    """Sends a GET request.
+
+    Args:
+        url (str|callable): URL for the request. Or a callable should return
+                            the URL.
+        params (bytes|dict): Dictionary or bytes to be sent in the query string
+                             for the request.
+        \*\*kwargs: Optional arguments that ``Session.request()`` takes.
+
+    Returns:
+        requests.Response: HTTP response.
+    """
+    kwargs.setdefault('allow_redirects', True)
+    return request('get', url, params=params, **kwargs)
+
+
+def options(url, **kwargs):
+    """Sends a OPTIONS request.
+
+    Args:
+        url (str|callable): URL for the request. Or a callable should return
+                            the URL.
+        \*\*kwargs: Optional arguments that ``Session.request()`` takes.
+
+    Returns:
+        requests.Response: HTTP response.
+    """
+    kwargs.setdefault('allow_redirects', True)
+    return request('options', url, **kwargs)
+
+
+def head(url, **kwargs):
+    """Sends a HEAD request.
+
+    Args:
+        url (str|callable): URL for the request. Or a callable should return
+                            the URL.
+        \*\*kwargs: Optional arguments that ``Session.request()`` takes.
+
+    Returns:
+        requests.Response: HTTP response.
+    """
+    kwargs.setdefault('allow_redirects', False)
+    return request('head', url, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs):
+    """Sends a POST request.
+
+    Args:
+        url (str|callable): URL for the request. Or a callable should return
+                            the URL.
+        data (bytes|dict|file): Dictionary, bytes, or file-like object to send in the body of
+                                the request.
+        json (dict|list): JSON data to send in the body of the request.
+        \*\*kwargs: Optional arguments that ``Session.request()`` takes.
+
+    Returns:
+        requests.Response: HTTP response.
+    """
+    return request('post', url, data=data, json=json, **kwargs)
+
+
+def put(url, data=None, **kwargs):
+    """Sends a PUT request.
+
+    Args:
+        url (str|callable): URL for the request. Or a callable should return
+                            the URL.
+        data (bytes|dict|file): Dictionary, bytes, or file-like object to send in the body of
+                                the request.
+        \*\*kwargs: Optional arguments that ``Session.request()`` takes.
+
+    Returns:
+        requests.Response: HTTP response.
+    """
+    return request('put', url, data=data, **kwargs)
+
+
+def patch(url, data=None, **kwargs):
+    """Sends a PATCH request.
+
+    Args:
+        url (str|callable): URL for the request. Or a callable should return
+                            the URL.
+        data (bytes|dict|file): Dictionary, bytes, or file-like object to send in the body of
+                                the request.
+        \*\*kwargs: Optional arguments that ``Session.request()`` takes.
+
+    Returns:
+        requests.Response: HTTP response.
+    """
+    return request('patch', url,  data=data, **kwargs)
+
+
+def delete(url, **kwargs):
+    """Sends a DELETE request.
+
+    Args:
+        url (str|callable): URL for the request. Or a callable should return
+                            the URL.
+        \*\*kwargs: Optional arguments that ``Session.request()`` takes.
+
+    Returns:
+        requests.Response: HTTP response.
+    """
+    return request('delete', url, **kwargs)
+
+
+# upper case
+GET = get
+OPTIONS = options
+HEAD = head
+POST = post
+PUT = put
+PATCH = patch
+DELETE = delete
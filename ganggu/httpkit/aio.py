@@ -0,0 +1,176 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012-2016 Xue Can <xuecan@gmail.com> and contributors.
+# Licensed under the MIT license: http://opensource.org/licenses/mit-license
+
+"""
+异步 HTTP 工具包
+================
+
+本模块提供了与 ``httpkit`` 相同形式的 ``get()``、``post()`` 等协程，使用
+相同的默认超时设置 ``httpkit.TIMEOUT`` 和默认的 User-Agent，``url`` 参数
+同样可以是返回 URL 的 callable（例如 ``resolvecache.smart_url()``）。
+
+同一个事件循环中的请求共享一个 ``aiohttp.ClientSession``，它的连接池最多
+保持 ``LIMIT`` 个连接，对每个主机最多 ``LIMIT_PER_HOST`` 个并发连接，超出
+的请求会排队等待。与 ``httpkit`` 的共享 ``Session`` 一样，它不保存 cookies。
+
+返回的 ``aiohttp.ClientResponse`` 已经读取了全部内容，可以直接使用
+``await resp.json()`` 或 ``await resp.text()``::
+
+    from ganggu.httpkit import aio
+
+    async def main():
+        resp = await aio.get('http://httpbin.org/get', params={'a': 1})
+        return await resp.json()
+
+本模块依赖如下第三方库：
+
+* `aiohttp <https://docs.aiohttp.org/>`_
+"""
+
+import asyncio
+import weakref
+import aiohttp
+import requests
+from .. import httpkit
+
+__all__ = ['session', 'close_all',
+           'get', 'options', 'head', 'post', 'put', 'patch', 'delete',
+           'GET', 'OPTIONS', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE']
+
+
+# connection pool of the shared session: max connections in total and per
+# host, 0 for no limit
+LIMIT = 100
+LIMIT_PER_HOST = 10
+
+# event loop -> shared aiohttp.ClientSession
+_SESSIONS = weakref.WeakKeyDictionary()
+
+
+def _client_timeout(timeout):
+    """Convert a requests style timeout to ``aiohttp.ClientTimeout``."""
+    if isinstance(timeout, aiohttp.ClientTimeout):
+        return timeout
+    if not timeout:
+        timeout = httpkit.TIMEOUT
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+    else:
+        connect = read = timeout
+    return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+
+def session():
+    """Return the shared session of the running event loop.
+
+    Returns:
+        aiohttp.ClientSession: The shared session.
+    """
+    loop = asyncio.get_running_loop()
+    client = _SESSIONS.get(loop)
+    if client is None or client.closed:
+        connector = aiohttp.TCPConnector(limit=LIMIT,
+                                         limit_per_host=LIMIT_PER_HOST)
+        client = aiohttp.ClientSession(
+            connector=connector,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            headers={'User-Agent': requests.utils.default_user_agent()})
+        _SESSIONS[loop] = client
+    return client
+
+
+async def close_all():
+    """Close the shared session of the running event loop."""
+    client = _SESSIONS.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+async def request(method, url, params=None, data=None, headers=None,
+                  cookies=None, auth=None, timeout=None, allow_redirects=True,
+                  verify=None, json=None, **kwargs):
+    """Constructs and sends an HTTP request.
+
+    Args:
+        method (str): Method for the request.
+        url (str|callable): URL for the request. Or a callable should return
+                            the URL.
+        params (dict): Dictionary to be sent in the query string.
+        data (bytes|dict): Dictionary or bytes to send in the body.
+        headers (dict): Dictionary of HTTP Headers to send with the request.
+        cookies (dict): Dict to send with the request.
+        auth (tuple|aiohttp.BasicAuth): Basic auth.
+        timeout (float|tuple): How long to wait for the server to send
+                               data before giving up, as a float, or a
+                               (connect timeout, read timeout) tuple.
+        allow_redirects (bool): Set to True by default.
+        verify (bool): Whether the SSL cert will be verified.
+        json (dict|list): JSON to send in the body of the request.
+        **kwargs: Optional arguments that ``aiohttp.ClientSession.request()``
+                  takes.
+
+    Returns:
+        aiohttp.ClientResponse: HTTP response, its body has been read.
+    """
+    if callable(url):
+        url = url()
+    if isinstance(auth, tuple):
+        auth = aiohttp.BasicAuth(*auth)
+    if verify is False:
+        kwargs['ssl'] = False
+    async with session().request(method, url, params=params, data=data,
+                                 headers=headers, cookies=cookies, auth=auth,
+                                 timeout=_client_timeout(timeout),
+                                 allow_redirects=allow_redirects, json=json,
+                                 **kwargs) as resp:
+        await resp.read()
+    return resp
+
+
+async def get(url, params=None, **kwargs):
+    """Sends a GET request, see ``request()``."""
+    kwargs.setdefault('allow_redirects', True)
+    return await request('GET', url, params=params, **kwargs)
+
+
+async def options(url, **kwargs):
+    """Sends a OPTIONS request, see ``request()``."""
+    kwargs.setdefault('allow_redirects', True)
+    return await request('OPTIONS', url, **kwargs)
+
+
+async def head(url, **kwargs):
+    """Sends a HEAD request, see ``request()``."""
+    kwargs.setdefault('allow_redirects', False)
+    return await request('HEAD', url, **kwargs)
+
+
+async def post(url, data=None, json=None, **kwargs):
+    """Sends a POST request, see ``request()``."""
+    return await request('POST', url, data=data, json=json, **kwargs)
+
+
+async def put(url, data=None, **kwargs):
+    """Sends a PUT request, see ``request()``."""
+    return await request('PUT', url, data=data, **kwargs)
+
+
+async def patch(url, data=None, **kwargs):
+    """Sends a PATCH request, see ``request()``."""
+    return await request('PATCH', url, data=data, **kwargs)
+
+
+async def delete(url, **kwargs):
+    """Sends a DELETE request, see ``request()``."""
+    return await request('DELETE', url, **kwargs)
+
+
+# upper case
+GET = get
+OPTIONS = options
+HEAD = head
+POST = post
+PUT = put
+PATCH = patch
+DELETE = delete
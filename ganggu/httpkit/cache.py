@@ -0,0 +1,384 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012-2016 Xue Can <xuecan@gmail.com> and contributors.
+# Licensed under the MIT license: http://opensource.org/licenses/mit-license
+
+"""
+HTTP 响应缓存
+=============
+
+``HTTPCache`` 为 ``httpkit.Session`` 的 GET 请求提供可选的响应缓存::
+
+    from ganggu import httpkit
+    from ganggu.httpkit import cache
+
+    session = httpkit.Session(cache=cache.HTTPCache())
+    # 或者作用于模块级函数使用的共享 Session
+    httpkit.shared_session().cache = cache.HTTPCache(cache.FileStorage(path))
+
+缓存遵循响应的 ``Cache-Control``（``max-age``、``s-maxage``、``no-store``、
+``no-cache``、``private``、``public``）和 ``Expires``：新鲜的响应直接从缓存
+返回，不发送请求；过期但带有 ``ETag`` 或 ``Last-Modified`` 的响应会以
+``If-None-Match``/``If-Modified-Since`` 发送条件请求，服务端返回 304 时
+更新缓存并返回缓存的内容。过期的响应总是先重新验证，从不直接返回。
+带有 ``Authorization`` 头（包括 ``auth=`` 参数产生的）的请求的响应只有在
+带有 ``public``、``s-maxage`` 或 ``must-revalidate`` 时才会被缓存
+（RFC 7234 section 3.2），因为缓存可能被共享 Session 的多个调用者以及
+多个进程共用。请求的 ``Cache-Control: no-cache`` 强制
+重新验证，``no-store`` 跳过缓存。``Vary`` 中列出的请求头不同的请求不会
+命中缓存。从缓存返回的响应的 ``from_cache`` 属性为 True。
+
+存储是可替换的，任何提供 ``get(key)``、``set(key, entry, ttl)`` 和
+``delete(key)`` 的对象都可以使用，本模块提供了：
+
+* ``MemoryStorage``：进程内的 LRU
+* ``FileStorage``：磁盘上的目录，可以在多个进程之间共享
+* ``RedisStorage``：使用 ``redisstore`` 的客户端，以 ``redisstore.Codec``
+  序列化和压缩
+
+共享的存储中的记录以 JSON 保存（响应体使用 base64 编码），而不是 pickle，
+能够写入缓存目录或 Redis 的人不能借此在读取缓存的进程中执行代码。
+"""
+
+import os
+import time
+import json
+import base64
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from email.utils import parsedate_to_datetime
+
+__all__ = ['MemoryStorage', 'FileStorage', 'RedisStorage', 'HTTPCache']
+
+
+# status codes cacheable by default, see RFC 7231 section 6.1
+CACHEABLE_STATUSES = frozenset([200, 203, 300, 301, 308, 404, 410])
+
+# seconds to keep a stale response which can be revalidated
+STALE_TTL = 86400
+
+# max entries of ``MemoryStorage``
+MEMORY_SIZE = 1024
+
+# directives allowing to cache a response to an authorized request, see
+# RFC 7234 section 3.2
+_AUTHORIZED_CACHEABLE = frozenset(['public', 's-maxage', 'must-revalidate'])
+
+# headers of a 304 response not merged into the cached response
+_NOT_MERGED = frozenset(['content-length', 'content-encoding',
+                         'transfer-encoding'])
+
+
+def _parse_cache_control(value):
+    """Parse a Cache-Control header into a dict, values are None or str."""
+    directives = {}
+    for item in (value or '').split(','):
+        name, _, arg = item.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else None
+    return directives
+
+
+def _seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _timestamp(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _storage_key(key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _dump_entry(entry):
+    """Return a JSON serializable copy of the entry."""
+    return dict(entry, content=base64.b64encode(entry['content'])
+                .decode('ascii'))
+
+
+def _load_entry(data):
+    """Return the entry of ``_dump_entry()``, None if it is malformed."""
+    try:
+        return dict(data, content=base64.b64decode(data['content']))
+    except (TypeError, ValueError, KeyError):
+        return None
+
+
+class MemoryStorage(object):
+    """In-process LRU storage."""
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize or MEMORY_SIZE
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            entry, expires = item
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, ttl):
+        with self._lock:
+            self._entries[key] = (entry, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileStorage(object):
+    """Storage in a directory, one JSON file per entry."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, _storage_key(key))
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+            entry, expires = data['entry'], float(data['expires'])
+        except (OSError, ValueError, TypeError, KeyError):
+            return None
+        if expires < time.time():
+            self.delete(key)
+            return None
+        return _load_entry(entry)
+
+    def set(self, key, entry, ttl):
+        # write to a temporary file then rename, readers never see a
+        # partially written entry
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps({'entry': _dump_entry(entry),
+                                    'expires': time.time() + ttl})
+                        .encode('utf-8'))
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.startswith('.tmp-') or len(name) == 40:
+                os.unlink(os.path.join(self.directory, name))
+
+
+class RedisStorage(object):
+    """Storage in Redis, entries expire by the TTL of the keys."""
+
+    def __init__(self, store, prefix='httpcache:', codec=None):
+        """
+        Args:
+            store (redis.StrictRedis): Redis client, e.g. from
+                                       ``redisstore.get_redis_store()``.
+            prefix (str): Prefix of the keys.
+            codec (redisstore.Codec): Codec of the entries, json and zlib
+                                      by default.
+        """
+        if codec is None:
+            from .. import redisstore
+            codec = redisstore.Codec('json', 'zlib')
+        self.store = store
+        self.prefix = prefix
+        self.codec = codec
+
+    def get(self, key):
+        data = self.store.get(self.prefix + _storage_key(key))
+        try:
+            data = self.codec.decode(data)
+        except ValueError:
+            return None
+        return None if data is None else _load_entry(data)
+
+    def set(self, key, entry, ttl):
+        self.store.set(self.prefix + _storage_key(key),
+                       self.codec.encode(_dump_entry(entry)),
+                       ex=max(1, int(ttl)))
+
+    def delete(self, key):
+        self.store.delete(self.prefix + _storage_key(key))
+
+
+def _authorized(response):
+    """Whether the request of the response carried credentials."""
+    request = response.request
+    return request is not None and 'Authorization' in request.headers
+
+
+def _build_response(entry, request=None):
+    response = requests.Response()
+    response.status_code = entry['status']
+    response.reason = entry['reason']
+    response.headers = CaseInsensitiveDict(entry['headers'])
+    response._content = entry['content']
+    response.url = entry['url']
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.request = request
+    response.from_cache = True
+    return response
+
+
+class HTTPCache(object):
+    """Response cache of ``httpkit.Session``."""
+
+    def __init__(self, storage=None, shared=False, stale_ttl=None):
+        """
+        Args:
+            storage: Storage of the entries, ``MemoryStorage()`` by default.
+            shared (bool): Behave as a shared cache, i.e. prefer
+                           ``s-maxage`` and do not store ``private``
+                           responses.
+            stale_ttl (float): Seconds to keep stale responses having
+                               validators, ``STALE_TTL`` by default.
+        """
+        self.storage = MemoryStorage() if storage is None else storage
+        self.shared = shared
+        self.stale_ttl = STALE_TTL if stale_ttl is None else stale_ttl
+
+    def _freshness(self, headers, now):
+        """Return the time until which the response is fresh."""
+        directives = _parse_cache_control(headers.get('Cache-Control'))
+        if 'no-cache' in directives:
+            return 0.0
+        age = _seconds(headers.get('Age')) or 0
+        max_age = None
+        if self.shared:
+            max_age = _seconds(directives.get('s-maxage'))
+        if max_age is None:
+            max_age = _seconds(directives.get('max-age'))
+        if max_age is not None:
+            return now + max_age - age
+        expires = _timestamp(headers.get('Expires'))
+        if expires is not None:
+            date = _timestamp(headers.get('Date')) or now
+            return now + expires - date - age
+        return 0.0
+
+    def _store(self, key, response, request_headers, now, authorized):
+        if response.status_code not in CACHEABLE_STATUSES:
+            return
+        headers = response.headers
+        directives = _parse_cache_control(headers.get('Cache-Control'))
+        if 'no-store' in directives or \
+                (self.shared and 'private' in directives):
+            return
+        if authorized and not _AUTHORIZED_CACHEABLE & set(directives):
+            return
+        vary = headers.get('Vary', '')
+        if vary.strip() == '*':
+            return
+        fresh_until = self._freshness(headers, now)
+        validated = 'ETag' in headers or 'Last-Modified' in headers
+        ttl = max(fresh_until - now, 0)
+        if validated:
+            ttl += self.stale_ttl
+        if ttl <= 0:
+            return
+        request_headers = request_headers or {}
+        entry = {
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': dict(headers),
+            'content': response.content,
+            'url': response.url,
+            'fresh_until': fresh_until,
+            'vary': dict((name.strip().lower(),
+                          request_headers.get(name.strip()))
+                         for name in vary.split(',') if name.strip()),
+        }
+        self.storage.set(key, entry, ttl)
+
+    def send(self, url, params, headers, dispatch):
+        """Send a GET request through the cache.
+
+        Args:
+            url (str): URL of the request.
+            params (dict|bytes): Query string of the request.
+            headers (dict): Headers of the request.
+            dispatch (callable): Sends the request with the given headers,
+                                 returns the response.
+
+        Returns:
+            requests.Response: HTTP response.
+        """
+        request = requests.Request('GET', url, params=params,
+                                   headers=headers).prepare()
+        key = 'GET ' + request.url
+        directives = _parse_cache_control((headers or {}).get('Cache-Control'))
+        if 'no-store' in directives:
+            return dispatch(headers)
+        entry = self.storage.get(key)
+        if entry is not None:
+            for name, value in entry['vary'].items():
+                if request.headers.get(name) != value:
+                    entry = None
+                    break
+        if entry is None:
+            response = dispatch(headers)
+            self._store(key, response, request.headers, time.time(),
+                        _authorized(response))
+            return response
+        if 'no-cache' not in directives and \
+                entry['fresh_until'] > time.time():
+            return _build_response(entry, request)
+        cached = CaseInsensitiveDict(entry['headers'])
+        conditional = dict(headers or {})
+        if 'ETag' in cached:
+            conditional['If-None-Match'] = cached['ETag']
+        if 'Last-Modified' in cached:
+            conditional['If-Modified-Since'] = cached['Last-Modified']
+        response = dispatch(conditional)
+        now = time.time()
+        if response.status_code != 304:
+            if response.status_code >= 500:
+                # keep the stale entry for later revalidation
+                return response
+            self.storage.delete(key)
+            self._store(key, response, request.headers, now,
+                        _authorized(response))
+            return response
+        for name, value in response.headers.items():
+            if name.lower() not in _NOT_MERGED:
+                cached[name] = value
+        entry = dict(entry, headers=dict(cached))
+        response.close()
+        self._store(key, _build_response(entry), request.headers, now,
+                    _authorized(response))
+        return _build_response(entry, response.request)
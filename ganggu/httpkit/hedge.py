@@ -0,0 +1,238 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012-2016 Xue Can <xuecan@gmail.com> and contributors.
+# Licensed under the MIT license: http://opensource.org/licenses/mit-license
+
+"""
+对冲请求
+========
+
+``Hedge`` 为 ``httpkit.Session`` 的幂等请求（默认为 GET 和 HEAD）提供对冲
+（hedged requests），用于降低尾部延迟::
+
+    from ganggu import httpkit
+    from ganggu.httpkit import hedge
+
+    session = httpkit.Session(hedge=hedge.Hedge(percentile=95))
+
+第一次尝试在 ``delay`` 秒内没有完成时，发出第二次尝试，先得到的响应作为
+结果，另一次尝试被取消：尚未开始的直接取消，已经开始的会执行完毕，然后
+关闭它的响应，连接被放回连接池。请求的 ``timeout`` 之和（连接和读取）
+限定了等待两次尝试的总时间。尝试在线程池中执行，``Recorder``（参见
+``httpkit.timing``）在执行它的线程中为每次尝试分别记录各阶段的耗时。
+线程池在每个进程中分别创建，fork 出的子进程不会使用父进程的线程池。``delay`` 是每个主机最近 ``window`` 个响应耗时的
+``percentile`` 百分位数，限定在 ``min_delay`` 和 ``max_delay`` 之间；样本
+不足 ``min_samples`` 个时不对冲。对冲的请求数不会超过全部请求的
+``max_ratio``，以免下游变慢时请求量翻倍。
+
+对于 http URL，如果 ``resolvecache`` 解析主机名得到多个地址，请求会发送
+到 ``resolvecache.select_address()`` 选择的地址，对冲的尝试发送到另一个
+地址（``Host`` 头保持原来的主机名）；https URL 为了证书验证
+仍然使用原来的主机名，第二次尝试使用连接池中的另一个连接。
+"""
+
+import os
+import time
+import threading
+import ipaddress
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+import requests
+from .. import resolvecache
+
+__all__ = ['Hedge']
+
+
+# methods hedged by default
+HEDGE_METHODS = frozenset(['GET', 'HEAD'])
+
+# threads shared by the attempts of a ``Hedge``
+HEDGE_WORKERS = 32
+
+# recompute the delay of a host after this many new samples
+_RECOMPUTE_EVERY = 16
+
+
+def _close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def _is_address(hostname):
+    try:
+        ipaddress.ip_address(hostname)
+    except ValueError:
+        return False
+    return True
+
+
+class _HostStats(object):
+    """Recent latencies of a host and the delay computed from them."""
+
+    def __init__(self, window):
+        self.samples = collections.deque(maxlen=window)
+        self.delay = None
+        self.pending = 0
+
+
+class Hedge(object):
+    """Hedging settings, per-host latency statistics and counters."""
+
+    def __init__(self, percentile=95, min_delay=0.01, max_delay=2.0,
+                 window=1000, min_samples=20, max_ratio=0.1,
+                 methods=HEDGE_METHODS, max_workers=None):
+        """
+        Args:
+            percentile (float): Percentile of recent latencies to wait for
+                                before hedging, 0 to 100.
+            min_delay (float): Min seconds to wait before hedging.
+            max_delay (float): Max seconds to wait before hedging.
+            window (int): Number of recent latencies kept per host.
+            min_samples (int): Min latencies of a host before hedging.
+            max_ratio (float): Max ratio of hedged requests.
+            methods (iterable): Methods to hedge, must be idempotent.
+            max_workers (int): Number of threads, ``HEDGE_WORKERS`` by
+                               default.
+        """
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.window = window
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self.methods = frozenset(method.upper() for method in methods)
+        self._hosts = {}
+        self._counters = {'requests': 0, 'hedged': 0, 'hedge_wins': 0}
+        self.max_workers = max_workers or HEDGE_WORKERS
+        self._lock = threading.Lock()
+        # (pid, executor), the threads of the parent are lost after fork
+        self._executor = (None, None)
+
+    def _submit(self, *args):
+        pid, executor = self._executor
+        if pid != os.getpid():
+            with self._lock:
+                pid, executor = self._executor
+                if pid != os.getpid():
+                    executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix='httpkit.hedge')
+                    self._executor = (os.getpid(), executor)
+        return executor.submit(*args)
+
+    def applies(self, method):
+        return method.upper() in self.methods
+
+    def record(self, host, elapsed):
+        """Record the latency of a response from the host."""
+        with self._lock:
+            stats = self._hosts.get(host)
+            if stats is None:
+                stats = self._hosts[host] = _HostStats(self.window)
+            stats.samples.append(elapsed)
+            stats.pending += 1
+            if len(stats.samples) >= self.min_samples and \
+                    (stats.delay is None or
+                     stats.pending >= _RECOMPUTE_EVERY):
+                ordered = sorted(stats.samples)
+                index = int(round(self.percentile / 100.0 *
+                                  (len(ordered) - 1)))
+                stats.delay = min(max(ordered[index], self.min_delay),
+                                  self.max_delay)
+                stats.pending = 0
+
+    def delay(self, host):
+        """Seconds to wait before hedging, None if not enough samples."""
+        stats = self._hosts.get(host)
+        return None if stats is None else stats.delay
+
+    def stats(self):
+        """Return the counters and the current delay of each host."""
+        with self._lock:
+            result = dict(self._counters)
+            result['delays'] = dict((host, stats.delay)
+                                    for host, stats in self._hosts.items())
+        return result
+
+    def _targets(self, url, headers):
+        """Return (url, headers) of the first attempt and the hedge."""
+        parsed = urlparse(url)
+        hostname = parsed.hostname
+        if parsed.scheme != 'http' or not hostname or _is_address(hostname):
+            return (url, headers), (url, headers)
+        try:
+            addresses = resolvecache.resolve(hostname)
+        except OSError:
+            addresses = []
+        if len(addresses) < 2:
+            return (url, headers), (url, headers)
+        first = resolvecache.select_address(hostname)
+        second = next(address for address in addresses if address != first)
+        headers = dict(headers or {})
+        headers.setdefault('Host', parsed.netloc.rpartition('@')[2])
+        return (resolvecache.replace_host(url, first), headers), \
+            (resolvecache.replace_host(url, second), headers)
+
+    def _attempt(self, host, send, url, headers):
+        started = time.monotonic()
+        response = send(url, headers)
+        self.record(host, time.monotonic() - started)
+        return response
+
+    def send(self, url, headers, send, timeout=None):
+        """Send a request with hedging.
+
+        Args:
+            url (str): URL of the request.
+            headers (dict): Headers of the request.
+            send (callable): Sends the request to the given URL with the
+                             given headers, returns the response.
+            timeout (float|tuple): Timeout of the request, the attempts are
+                                   waited for at most its sum.
+
+        Returns:
+            requests.Response: The first response.
+        """
+        host = urlparse(url).netloc
+        delay = self.delay(host)
+        with self._lock:
+            self._counters['requests'] += 1
+            allowed = delay is not None and self._counters['hedged'] < \
+                self.max_ratio * self._counters['requests']
+        if not allowed:
+            return self._attempt(host, send, url, headers)
+        if isinstance(timeout, tuple):
+            timeout = sum(part for part in timeout if part)
+        deadline = time.monotonic() + timeout if timeout else None
+        primary, backup = self._targets(url, headers)
+        first = self._submit(self._attempt, host, send, *primary)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        with self._lock:
+            self._counters['hedged'] += 1
+        second = self._submit(self._attempt, host, send, *backup)
+        pending = set([first, second])
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+            done, pending = wait(pending, timeout=remaining,
+                                 return_when=FIRST_COMPLETED)
+            winner = next((future for future in done
+                           if future.exception() is None), None)
+            if winner is not None or not pending or not done:
+                break
+        for future in (first, second):
+            if future is not winner and not future.cancel():
+                future.add_done_callback(_close_response)
+        if winner is None:
+            if pending:
+                raise requests.Timeout('hedged request to %s timed out' %
+                                       host)
+            # both attempts failed, report the error of the first one
+            return first.result()
+        if winner is second:
+            with self._lock:
+                self._counters['hedge_wins'] += 1
+        return winner.result()
@@ -0,0 +1,337 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012-2016 Xue Can <xuecan@gmail.com> and contributors.
+# Licensed under the MIT license: http://opensource.org/licenses/mit-license
+
+"""
+重试和熔断策略
+==============
+
+``Policy`` 为 ``httpkit.Session`` 提供按主机（``host:port``）区分的重试和
+熔断::
+
+    from ganggu import httpkit
+    from ganggu.httpkit import policy
+
+    session = httpkit.Session(policy=policy.Policy())
+    # 或者作用于模块级函数使用的共享 Session
+    httpkit.shared_session().policy = policy.Policy()
+
+重试（``Retry``）
+    只有幂等的方法（``IDEMPOTENT_METHODS``）或者带有 ``Idempotency-Key``
+    头的请求才会在出错或收到 ``Retry.statuses`` 中的状态码时重试；其它
+    请求只在连接未能建立（请求肯定没有发出）时重试。两次尝试之间按指数
+    退避并加入随机抖动（full jitter），服务端给出的 ``Retry-After`` 也会
+    被遵守。每个主机有一个重试预算：每个请求存入 ``budget_ratio`` 个令牌，
+    每次重试消耗一个，预算耗尽时不再重试，从而避免下游故障时重试放大流量。
+
+熔断（``Breaker``）
+    统计每个主机最近 ``window`` 秒内的请求，当样本数不少于
+    ``min_requests`` 且错误率达到 ``error_rate``，或者慢请求（耗时超过
+    ``slow_call``）的比例达到 ``slow_rate`` 时熔断器打开。打开期间请求
+    立即以 ``CircuitOpenError`` 失败，不会占用线程等待超时；
+    ``reset_timeout`` 秒后进入半开状态，放行一个探测请求，成功则关闭，
+    失败则再次打开。
+"""
+
+import time
+import random
+import threading
+import collections
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import requests
+from requests.structures import CaseInsensitiveDict
+from urllib3.exceptions import NewConnectionError
+
+__all__ = ['CircuitOpenError', 'Retry', 'Breaker', 'Policy']
+
+
+# methods which are safe to send twice, see RFC 7231 section 4.2.2
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE',
+                                'TRACE'])
+
+# header marking a non-idempotent request as safe to retry
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+# states of a breaker
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """The circuit breaker of the host is open, the request is not sent."""
+
+
+def _not_sent(error):
+    """Whether the request surely has not reached the server."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError):
+        reason = error.args[0] if error.args else None
+        reason = getattr(reason, 'reason', reason)
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+def _retry_after(value):
+    """Seconds to wait from a ``Retry-After`` header, None if invalid.
+
+    The value is either delay seconds or an HTTP-date, see RFC 7231
+    section 7.1.3.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        # an HTTP-date is always in GMT
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+class Retry(object):
+    """Retry settings and the per-host retry budgets."""
+
+    def __init__(self, total=3, backoff=0.1, max_backoff=10.0,
+                 statuses=(502, 503, 504), methods=IDEMPOTENT_METHODS,
+                 budget_ratio=0.2, budget_min=10):
+        """
+        Args:
+            total (int): Max retries of a request.
+            backoff (float): Base seconds of the exponential backoff.
+            max_backoff (float): Max seconds to sleep between attempts.
+            statuses (iterable): Status codes to retry on.
+            methods (iterable): Methods to retry on errors and statuses.
+            budget_ratio (float): Retries earned by each request of a host.
+            budget_min (int): Initial and max retry budget of a host.
+        """
+        self.total = total
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+        self.methods = frozenset(method.upper() for method in methods)
+        self.budget_ratio = budget_ratio
+        self.budget_min = budget_min
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def is_idempotent(self, method, headers=None):
+        if method.upper() in self.methods:
+            return True
+        if not headers:
+            return False
+        if not isinstance(headers, CaseInsensitiveDict):
+            headers = CaseInsensitiveDict(headers)
+        return bool(headers.get(IDEMPOTENCY_HEADER))
+
+    def deposit(self, host):
+        """Earn retry budget for a request to the host."""
+        with self._lock:
+            budget = self._budgets.get(host, self.budget_min)
+            self._budgets[host] = min(budget + self.budget_ratio,
+                                      self.budget_min)
+
+    def withdraw(self, host):
+        """Spend one retry of the host, return False if exhausted."""
+        with self._lock:
+            budget = self._budgets.get(host, self.budget_min)
+            if budget < 1:
+                return False
+            self._budgets[host] = budget - 1
+            return True
+
+    def sleep_time(self, attempt, response=None):
+        """Seconds to sleep before the attempt, ``attempt`` starts from 1."""
+        if response is not None:
+            delay = _retry_after(response.headers.get('Retry-After'))
+            if delay is not None:
+                return min(delay, self.max_backoff)
+        ceiling = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+
+class _HostBreaker(object):
+    """Circuit breaker state of a host."""
+
+    def __init__(self):
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+        # (timestamp, failed, slow)
+        self.samples = collections.deque()
+        self.lock = threading.Lock()
+
+
+class Breaker(object):
+    """Circuit breaker settings and the per-host states."""
+
+    def __init__(self, error_rate=0.5, slow_call=None, slow_rate=0.8,
+                 window=30.0, min_requests=20, reset_timeout=15.0,
+                 failure_statuses=(500, 502, 503, 504)):
+        """
+        Args:
+            error_rate (float): Ratio of failures to open the breaker.
+            slow_call (float|None): Seconds of a slow request, None to
+                                    disable tripping on latency.
+            slow_rate (float): Ratio of slow requests to open the breaker.
+            window (float): Seconds of the statistics window.
+            min_requests (int): Min samples in the window before tripping.
+            reset_timeout (float): Seconds to stay open before probing.
+            failure_statuses (iterable): Status codes counted as failures.
+        """
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.window = window
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.failure_statuses = frozenset(failure_statuses)
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host(self, host):
+        breaker = self._hosts.get(host)
+        if breaker is None:
+            with self._lock:
+                breaker = self._hosts.setdefault(host, _HostBreaker())
+        return breaker
+
+    def state(self, host):
+        return self._host(host).state
+
+    def before(self, host):
+        """Check the breaker before sending a request.
+
+        Raises:
+            CircuitOpenError: The breaker is open.
+        """
+        breaker = self._host(host)
+        with breaker.lock:
+            if breaker.state == CLOSED:
+                return
+            if breaker.state == OPEN:
+                if time.monotonic() - breaker.opened_at < self.reset_timeout:
+                    raise CircuitOpenError('circuit of %s is open' % host)
+                breaker.state = HALF_OPEN
+                breaker.probing = False
+            if breaker.probing:
+                raise CircuitOpenError('circuit of %s is half-open' % host)
+            breaker.probing = True
+
+    def record(self, host, failed, elapsed):
+        """Record the outcome of a request."""
+        breaker = self._host(host)
+        now = time.monotonic()
+        slow = self.slow_call is not None and elapsed >= self.slow_call
+        with breaker.lock:
+            if breaker.state == HALF_OPEN:
+                breaker.probing = False
+                if failed or slow:
+                    breaker.state = OPEN
+                    breaker.opened_at = now
+                else:
+                    breaker.state = CLOSED
+                    breaker.samples.clear()
+                return
+            if breaker.state == OPEN:
+                return
+            samples = breaker.samples
+            samples.append((now, failed, slow))
+            while samples and samples[0][0] < now - self.window:
+                samples.popleft()
+            count = len(samples)
+            if count < self.min_requests:
+                return
+            failures = sum(1 for _, f, _ in samples if f)
+            slows = sum(1 for _, _, s in samples if s)
+            if failures >= self.error_rate * count or \
+                    (self.slow_call is not None and
+                     slows >= self.slow_rate * count):
+                breaker.state = OPEN
+                breaker.opened_at = now
+                samples.clear()
+
+    def reset(self, host=None):
+        """Close the breaker of the host, or all breakers."""
+        with self._lock:
+            if host is None:
+                self._hosts.clear()
+            else:
+                self._hosts.pop(host, None)
+
+
+class Policy(object):
+    """Retry and circuit breaker policy of ``httpkit.Session``."""
+
+    def __init__(self, retry=None, breaker=None):
+        """
+        Args:
+            retry (Retry|bool): Retry settings, ``Retry()`` by default,
+                                False to disable retries.
+            breaker (Breaker|bool): Breaker settings, ``Breaker()`` by
+                                    default, False to disable the breaker.
+        """
+        self.retry = Retry() if retry is None else (retry or None)
+        self.breaker = Breaker() if breaker is None else (breaker or None)
+
+    def send(self, method, url, send, headers=None, rewindable=True):
+        """Send a request through the policy.
+
+        Args:
+            method (str): Method of the request.
+            url (str): URL of the request.
+            send (callable): Sends the request once, returns the response.
+            headers (dict): Headers of the request, including the headers
+                            of the session.
+            rewindable (bool): Whether the body can be sent again.
+
+        Returns:
+            requests.Response: HTTP response.
+        """
+        host = urlparse(url).netloc
+        retry, breaker = self.retry, self.breaker
+        idempotent = retry is not None and rewindable and \
+            retry.is_idempotent(method, headers)
+        if retry is not None:
+            retry.deposit(host)
+        attempt = 0
+        while True:
+            attempt += 1
+            if breaker is not None:
+                breaker.before(host)
+            started = time.monotonic()
+            try:
+                response = send()
+            except requests.RequestException as error:
+                if breaker is not None:
+                    breaker.record(host, True, time.monotonic() - started)
+                if retry is None or attempt > retry.total or \
+                        not (idempotent or (rewindable and _not_sent(error))) \
+                        or not retry.withdraw(host):
+                    raise
+                time.sleep(retry.sleep_time(attempt))
+                continue
+            except BaseException:
+                # record other errors too, or a half-open probe never ends
+                if breaker is not None:
+                    breaker.record(host, True, time.monotonic() - started)
+                raise
+            if breaker is not None:
+                breaker.record(
+                    host, response.status_code in breaker.failure_statuses,
+                    time.monotonic() - started)
+            if retry is None or not idempotent or attempt > retry.total or \
+                    response.status_code not in retry.statuses or \
+                    not retry.withdraw(host):
+                return response
+            response.close()
+            time.sleep(retry.sleep_time(attempt, response))
@@ -0,0 +1,363 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012-2016 Xue Can <xuecan@gmail.com> and contributors.
+# Licensed under the MIT license: http://opensource.org/licenses/mit-license
+
+"""
+请求耗时统计
+============
+
+``Recorder`` 记录 ``httpkit.Session`` 发出的每个请求的各阶段耗时::
+
+    from ganggu import httpkit
+    from ganggu.httpkit import timing
+
+    recorder = timing.Recorder()
+    recorder.add_hook(lambda t: print(t.as_dict()))
+    session = httpkit.Session(timing=recorder)
+    # 或者作用于模块级函数使用的共享 Session
+    httpkit.shared_session().timing = recorder
+
+    session.get('https://httpbin.org/get')
+    recorder.snapshot()    # 每个主机、每个阶段的直方图
+    recorder.export()      # Prometheus 文本格式
+
+每个请求的 ``Timing`` 包括：
+
+* ``dns``：解析主机名的秒数
+* ``connect``：建立 TCP 连接的秒数
+* ``tls``：TLS 握手的秒数
+* ``ttfb``：从发送完请求（包括请求体）到收到响应头的秒数，不包括前三项
+* ``total``：请求的总秒数，不包括重定向之后的请求，``stream=True`` 时不
+  包括读取响应体的时间
+* ``reused``：是否复用了连接池中的连接，复用时前三项为 None
+
+这些数据来自 ``TimingAdapter`` 使用的连接类，``httpkit.Session`` 和共享的
+``Session`` 默认都使用它；没有设置 ``Recorder`` 时不做任何额外的工作。
+重定向的每一跳分别记录。
+"""
+
+import time
+import socket
+import bisect
+import threading
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.exceptions import NewConnectionError, ConnectTimeoutError
+from urllib3.util.connection import allowed_gai_family
+
+__all__ = ['Timing', 'Histogram', 'Recorder', 'TimingAdapter']
+
+
+# upper bounds in seconds of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, float('inf'))
+
+# phases kept in the histograms
+PHASES = ('dns', 'connect', 'tls', 'ttfb', 'total')
+
+# the timing of the request being sent by this thread
+_CURRENT = threading.local()
+
+
+class Timing(object):
+    """Timings of a request, in seconds."""
+
+    __slots__ = ('host', 'method', 'status', 'error', 'reused', 'started',
+                 'sent', 'dns', 'connect', 'tls', 'ttfb', 'total')
+
+    def __init__(self, host, method):
+        self.host = host
+        self.method = method
+        self.status = None
+        self.error = None
+        self.reused = True
+        self.started = time.monotonic()
+        self.sent = None
+        self.dns = self.connect = self.tls = self.ttfb = self.total = None
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__
+                    if name not in ('started', 'sent'))
+
+
+def _current():
+    return getattr(_CURRENT, 'timing', None)
+
+
+class _TimingMixin(object):
+    """Connection recording its phases into the current timing."""
+
+    def _new_conn(self):
+        timing = _current()
+        if timing is None:
+            return super(_TimingMixin, self)._new_conn()
+        timing.reused = False
+        started = time.monotonic()
+        try:
+            infos = socket.getaddrinfo(self._dns_host, self.port,
+                                       allowed_gai_family(),
+                                       socket.SOCK_STREAM)
+        except socket.gaierror:
+            # let urllib3 raise its own error
+            return super(_TimingMixin, self)._new_conn()
+        resolved = time.monotonic()
+        timing.dns = resolved - started
+        addresses = []
+        for info in infos:
+            if info[4][0] not in addresses:
+                addresses.append(info[4][0])
+        dns_host = self._dns_host
+        try:
+            for i, address in enumerate(addresses):
+                self._dns_host = address
+                try:
+                    sock = super(_TimingMixin, self)._new_conn()
+                except (NewConnectionError, ConnectTimeoutError):
+                    if i == len(addresses) - 1:
+                        raise
+                    continue
+                timing.connect = time.monotonic() - resolved
+                return sock
+        finally:
+            self._dns_host = dns_host
+
+    def request(self, *args, **kwargs):
+        super(_TimingMixin, self).request(*args, **kwargs)
+        timing = _current()
+        if timing is not None:
+            timing.sent = time.monotonic()
+
+    def getresponse(self, *args, **kwargs):
+        response = super(_TimingMixin, self).getresponse(*args, **kwargs)
+        timing = _current()
+        if timing is not None:
+            timing.ttfb = time.monotonic() - (timing.sent or timing.started)
+        return response
+
+
+class TimedHTTPConnection(_TimingMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimingMixin, HTTPSConnection):
+
+    def connect(self):
+        timing = _current()
+        started = time.monotonic()
+        super(TimedHTTPSConnection, self).connect()
+        if timing is not None and timing.connect is not None:
+            timing.tls = time.monotonic() - started - \
+                (timing.dns or 0) - timing.connect
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimingAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections record their timings."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimingAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+    def send(self, request, stream=False, **kwargs):
+        response = super(TimingAdapter, self).send(request, stream=stream,
+                                                   **kwargs)
+        timing = _current()
+        if timing is not None:
+            # finish here so that the time of following redirects is not
+            # included, the body would be read right after anyway
+            if not stream:
+                response.content
+            timing.total = time.monotonic() - timing.started
+        return response
+
+
+class Histogram(object):
+    """Histogram with fixed buckets."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Estimate the percentile, by linear interpolation in a bucket."""
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = min(self.buckets[i], self.max)
+                lower = max(lower, self.min)
+                if upper <= lower:
+                    return upper
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def snapshot(self):
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': buckets,
+        }
+
+
+class _HostStats(object):
+
+    def __init__(self, buckets):
+        self.requests = 0
+        self.errors = 0
+        self.reused = 0
+        self.phases = dict((phase, Histogram(buckets)) for phase in PHASES)
+
+
+class Recorder(object):
+    """Per-host histograms of request timings."""
+
+    def __init__(self, buckets=BUCKETS, hooks=None):
+        """
+        Args:
+            buckets (tuple): Upper bounds of the histogram buckets, the last
+                             one should be ``float('inf')``.
+            hooks (list): Callables called with each ``Timing``.
+        """
+        self.buckets = tuple(buckets)
+        self.hooks = list(hooks or [])
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """Call ``hook(timing)`` after each request."""
+        self.hooks.append(hook)
+
+    def begin(self, method, url):
+        """Start the timing of a request sent by this thread.
+
+        Returns:
+            tuple: Token for ``end()``.
+        """
+        previous = _current()
+        timing = Timing(urlparse(url).netloc, method)
+        _CURRENT.timing = timing
+        return timing, previous
+
+    def end(self, token, response=None, error=None):
+        """Finish the timing of a request and record it.
+
+        Returns:
+            Timing: The timing of the request.
+        """
+        timing, previous = token
+        _CURRENT.timing = previous
+        if timing.total is None:
+            timing.total = time.monotonic() - timing.started
+        if response is not None:
+            timing.status = response.status_code
+        if error is not None:
+            timing.error = type(error).__name__
+        self.record(timing)
+        return timing
+
+    def record(self, timing):
+        with self._lock:
+            stats = self._hosts.get(timing.host)
+            if stats is None:
+                stats = self._hosts[timing.host] = _HostStats(self.buckets)
+            stats.requests += 1
+            if timing.error is not None:
+                stats.errors += 1
+            elif timing.reused:
+                stats.reused += 1
+            for phase in PHASES:
+                value = getattr(timing, phase)
+                if value is not None:
+                    stats.phases[phase].observe(value)
+        for hook in self.hooks:
+            hook(timing)
+
+    def snapshot(self):
+        """Return the statistics of each host.
+
+        Returns:
+            dict: ``{host: {'requests', 'errors', 'reused', 'phases':
+                  {phase: histogram}}}``, see ``Histogram.snapshot()``.
+        """
+        with self._lock:
+            return dict((host, {
+                'requests': stats.requests,
+                'errors': stats.errors,
+                'reused': stats.reused,
+                'phases': dict((phase, histogram.snapshot())
+                               for phase, histogram in stats.phases.items()
+                               if histogram.count),
+            }) for host, stats in self._hosts.items())
+
+    def export(self, prefix='httpkit'):
+        """Export the statistics in the Prometheus text format.
+
+        Returns:
+            str: The exposition text.
+        """
+        lines = [
+            '# TYPE %s_request_seconds histogram' % prefix,
+        ]
+        counters = []
+        for host, stats in sorted(self.snapshot().items()):
+            for phase, histogram in sorted(stats['phases'].items()):
+                labels = 'host="%s",phase="%s"' % (host, phase)
+                for bound, count in histogram['buckets']:
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_request_seconds_bucket{%s,le="%s"} %d' %
+                                 (prefix, labels, le, count))
+                lines.append('%s_request_seconds_sum{%s} %r' %
+                             (prefix, labels, histogram['sum']))
+                lines.append('%s_request_seconds_count{%s} %d' %
+                             (prefix, labels, histogram['count']))
+            for name in ('requests', 'errors', 'reused'):
+                counters.append('%s_%s_total{host="%s"} %d' %
+                                (prefix, name, host, stats[name]))
+        for name in ('requests', 'errors', 'reused'):
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            lines.extend(line for line in counters
+                         if line.startswith('%s_%s_total' % (prefix, name)))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._hosts.clear()
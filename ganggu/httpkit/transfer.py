@@ -0,0 +1,225 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012-2016 Xue Can <xuecan@gmail.com> and contributors.
+# Licensed under the MIT license: http://opensource.org/licenses/mit-license
+
+"""
+文件的下载和上传
+================
+
+``download()`` 和 ``upload()`` 以固定大小的块传输文件，内存占用与文件大小
+无关，它们也可以通过 ``httpkit.download()`` 和 ``httpkit.upload()`` 使用::
+
+    from ganggu import httpkit
+
+    httpkit.download('http://example.com/big.tar.gz', '/tmp/big.tar.gz',
+                     checksum='sha256:9f86d08...')
+    httpkit.upload('http://example.com/upload', '/tmp/big.tar.gz')
+
+下载时响应体直接从连接读入预先分配的缓冲区（``readinto()``），再从缓冲区
+写入文件，同时计算校验和，不产生中间的 bytes 对象。数据先写入
+``<path>.part``，完成并通过校验后才改名为 ``path``；中断后再次调用会以
+``Range`` 请求继续下载，服务端不支持时从头开始。
+
+上传时文件被 ``mmap`` 映射，每次发送映射中的一个切片（``memoryview``），
+由内核直接从页缓存复制到 socket。requests 没有暴露底层的 socket，因此
+不能使用 ``os.sendfile()``。
+"""
+
+import os
+import re
+import mmap
+import hashlib
+import requests
+
+__all__ = ['ChecksumMismatch', 'download', 'upload']
+
+
+# bytes of each chunk read from the connection or sent from the file
+CHUNK_SIZE = 256 * 1024
+
+# suffix of the partially downloaded file
+PART_SUFFIX = '.part'
+
+_CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+class ChecksumMismatch(ValueError):
+    """The checksum of the downloaded file is not the expected one."""
+
+
+def _hasher(checksum):
+    """Return (hash object, expected hex digest) of a checksum spec."""
+    if checksum is None:
+        return None, None
+    if isinstance(checksum, str):
+        algorithm, _, expected = checksum.partition(':')
+    else:
+        algorithm, expected = checksum
+    return hashlib.new(algorithm), expected.lower()
+
+
+def _write_all(fd, view):
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _hash_file(fd, hasher, view):
+    """Feed the existing content of the file into the hasher."""
+    os.lseek(fd, 0, os.SEEK_SET)
+    while True:
+        count = os.readv(fd, [view])
+        if not count:
+            break
+        hasher.update(view[:count])
+
+
+def download(url, path, resume=True, checksum=None, progress=None,
+             chunk_size=None, session=None, **kwargs):
+    """Downloads the URL to a file in bounded chunks.
+
+    Args:
+        url (str|callable): URL of the file. Or a callable should return
+                            the URL.
+        path (str): Path of the file.
+        resume (bool): Continue a partial download left by a previous call.
+        checksum (str|tuple): Expected checksum, ``'sha256:<hex digest>'``
+                              or ``('sha256', '<hex digest>')``, any
+                              algorithm of ``hashlib`` can be used.
+        progress (callable): Called as ``progress(done, total)`` after each
+                             chunk, ``total`` is None if unknown.
+        chunk_size (int): Bytes of a chunk, ``CHUNK_SIZE`` by default.
+        session (Session): Session to use, the shared session by default.
+        **kwargs: Optional arguments that ``Session.request()`` takes.
+
+    Returns:
+        int: Size of the file.
+
+    Raises:
+        ChecksumMismatch: The checksum does not match, the partial file is
+                          removed.
+        requests.RequestException: The download failed, the partial file is
+                                   kept for resuming.
+    """
+    from . import shared_session
+    session = session or shared_session()
+    hasher, expected = _hasher(checksum)
+    view = memoryview(bytearray(chunk_size or CHUNK_SIZE))
+    part = path + PART_SUFFIX
+    fd = os.open(part, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        offset = os.fstat(fd).st_size if resume else 0
+        headers = dict(kwargs.pop('headers', None) or {})
+        # the body is read as is, without content decoding
+        headers['Accept-Encoding'] = 'identity'
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        resp = session.get(url, headers=headers, stream=True, **kwargs)
+        if offset and resp.status_code == 416:
+            # the range is not satisfiable, download again
+            resp.close()
+            offset = 0
+            del headers['Range']
+            resp = session.get(url, headers=headers, stream=True, **kwargs)
+        with resp:
+            resp.raise_for_status()
+            match = _CONTENT_RANGE.match(resp.headers.get('Content-Range', ''))
+            if resp.status_code != 206 or not match or \
+                    int(match.group(1)) != offset:
+                offset = 0
+            total = resp.headers.get('Content-Length')
+            total = offset + int(total) if total is not None else None
+            if offset and hasher is not None:
+                _hash_file(fd, hasher, view)
+            os.ftruncate(fd, offset)
+            os.lseek(fd, offset, os.SEEK_SET)
+            done = offset
+            while True:
+                count = resp.raw.readinto(view)
+                if not count:
+                    break
+                chunk = view[:count]
+                _write_all(fd, chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                done += count
+                if progress is not None:
+                    progress(done, total)
+        if total is not None and done != total:
+            raise requests.ConnectionError(
+                'connection closed after %d of %d bytes' % (done, total))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    if hasher is not None and hasher.hexdigest() != expected:
+        os.unlink(part)
+        raise ChecksumMismatch('%s checksum of %s is %s, expected %s' %
+                               (hasher.name, url, hasher.hexdigest(),
+                                expected))
+    os.replace(part, path)
+    return done
+
+
+class _MappedFile(object):
+    """File-like body sending slices of a memory mapped file."""
+
+    def __init__(self, path, chunk_size, progress):
+        self._file = open(path, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._map = None
+        self._view = memoryview(b'')
+        if self._size:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            if hasattr(self._map, 'madvise'):
+                self._map.madvise(mmap.MADV_SEQUENTIAL)
+            self._view = memoryview(self._map)
+        self._offset = 0
+        self._chunk_size = chunk_size
+        self._progress = progress
+
+    def __len__(self):
+        return self._size - self._offset
+
+    def read(self, size=-1):
+        # chunks larger than the block size of the connection are fine,
+        # they are passed to ``socket.sendall()`` as they are
+        size = max(size, self._chunk_size)
+        chunk = self._view[self._offset:self._offset + size]
+        self._offset += len(chunk)
+        if chunk and self._progress is not None:
+            self._progress(self._offset, self._size)
+        return chunk
+
+    def close(self):
+        self._view.release()
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+
+def upload(url, path, method='PUT', progress=None, chunk_size=None,
+           session=None, **kwargs):
+    """Uploads a file as the request body in bounded chunks.
+
+    Args:
+        url (str|callable): URL to upload to. Or a callable should return
+                            the URL.
+        path (str): Path of the file.
+        method (str): Method of the request.
+        progress (callable): Called as ``progress(done, total)`` after each
+                             chunk.
+        chunk_size (int): Bytes of a chunk, ``CHUNK_SIZE`` by default.
+        session (Session): Session to use, the shared session by default.
+        **kwargs: Optional arguments that ``Session.request()`` takes.
+
+    Returns:
+        requests.Response: HTTP response.
+    """
+    from . import shared_session
+    session = session or shared_session()
+    body = _MappedFile(path, chunk_size or CHUNK_SIZE, progress)
+    try:
+        return session.request(method, url, data=body, **kwargs)
+    finally:
+        body.close()
@@ -29,23 +29,68 @@
 来获取日志器对象。
 
 本模块提供了一系列 ``setup_*_handler()`` 函数用于快速设置日志处理器。
+之后调用 ``setup_async_handlers()`` 可以把日志器上的处理器移到后台线程中
+执行，调用日志方法的线程只需要把日志记录放入队列。
 
 注意：由于本模块对标准库中的 ``logging`` 进行了所谓的 monkey patch，因此\
 需要在应用程序尽可能早的位置导入本模块，目的是尽可能不要让其它的库首先调用
 ``logging.getLogger()`` 函数，否则得到的 ``Logger`` 对象无法使用本模块提供的方法。
 
+``Logger.set_rate_limit()`` 限制日志器中每个消息模板的输出频率，日志方法的
+``rate=`` 和 ``sample=`` 参数限制单个调用点，例如
+``logger.error('upstream %s failed', host, rate=10)`` 每秒最多输出 10 条，
+``logger.debug('got %r', item, sample=100)`` 每 100 条输出 1 条。被抑制的
+日志数量会定期以一条汇总记录输出。
+
+多个进程（例如 prefork 的 Celery 或 gunicorn worker）写同一个日志文件时，
+可以在 fork 之前调用 ``setup_aggregator()``：子进程的日志记录通过 Unix
+socket 发送给父进程中的一个线程，由它成批写入。
+
+``setup_*_handler()`` 的 ``json=True`` 参数使用 ``JSONFormatter``，每条日志
+记录输出为一行 JSON，便于日志收集系统处理。
+
+``bind()`` 和 ``bound_context()`` 把字段（例如 ``request_id``）绑定到当前的
+上下文（``contextvars``），之后日志器上的处理器输出的每条日志记录都带有
+这些字段，不需要每次都传递 ``extra=``。asyncio 任务创建时复制当前的上下文；
+``ContextThread`` 和 ``ContextExecutor`` 让线程和线程池中的任务同样继承
+启动（提交）者的上下文。``flaskmate`` 和 ``asynctask`` 分别为 Flask 请求和
+Celery 任务绑定 ``request_id`` 和 ``task_id``。
+
 本模块依赖如下第三方库：
 
 * `coloredlogs <https://coloredlogs.readthedocs.io/en/latest/>`_。
+* `orjson <https://github.com/ijl/orjson>`_，可选，用于加快 JSON 编码。
 """
 
+import os
+import json
+import time
+import queue
+import shutil
+import socket
+import struct
+import operator
+import tempfile
+import selectors
+import atexit
 import logging
+import weakref
+import threading
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 from logging import StreamHandler
-from logging.handlers import WatchedFileHandler
+from logging.handlers import WatchedFileHandler, QueueHandler, QueueListener
+from logging.handlers import SocketHandler
 from coloredlogs import ColoredFormatter
 
-__version__ = '1.1.1'
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+__version__ = '1.7.0'
 
 
 # 一些默认值
@@ -74,8 +119,41 @@ DEFAULTS = {
         'debug':     {'color': 'green'},
         'spam':      {'color': 'blue'}
     },
+    # 异步日志队列的容量
+    'QUEUE-SIZE': 10000,
+    # 队列已满时的策略：'drop' 丢弃日志记录，'block' 等待队列有空位
+    'QUEUE-POLICY': 'drop',
+    # 缓冲的日志文件：缓冲区达到这个字节数时写入文件
+    'BUFFER-SIZE': 64 * 1024,
+    # 缓冲的日志文件：最早的日志记录缓冲了这个秒数时写入文件
+    'FLUSH-INTERVAL': 1.0,
+    # 缓冲的日志文件：不低于这个等级的日志记录立即写入文件
+    'FLUSH-LEVEL': logging.ERROR,
+    # 缓冲的日志文件：检查文件是否被 logrotate 等移走的最小间隔秒数
+    'ROTATE-CHECK-INTERVAL': 1.0,
+    # JSON 日志的字段：(JSON 中的键, 日志记录的属性)，属性 asctime 是 ISO
+    # 8601 格式的时间，message 是格式化后的消息
+    'JSON-FIELDS': (
+        ('time', 'asctime'),
+        ('name', 'name'),
+        ('process', 'process'),
+        ('level', 'levelname'),
+        ('message', 'message'),
+    ),
+    # 输出被限流或采样抑制的日志汇总的间隔秒数
+    'SUPPRESSED-SUMMARY-INTERVAL': 60.0,
 }
 
+# 每个日志器最多跟踪的消息模板数量，超过时重置限流状态
+_MAX_THROTTLES = 10000
+
+# 保护所有日志器的限流状态
+_THROTTLE_LOCK = threading.Lock()
+
+# 队列已满时的策略
+DROP = 'drop'
+BLOCK = 'block'
+
 
 # 在 DEBUG 和 INFO 之间增加 SPAM 级别(兼容 verboselogs 1.1)
 logging.addLevelName(5, 'SPAM')
@@ -103,6 +181,91 @@ class Logger(logging.Logger):
 
     def __init__(self, *args, **kwargs):
         super(Logger, self).__init__(*args, **kwargs)
+        # (每秒条数, 采样间隔) 或 None
+        self._rate_limit = None
+        # 消息模板 -> [令牌数, 上次补充的时刻, 调用次数]
+        self._throttles = {}
+        # 消息模板 -> [被抑制的数量, 最高的等级]
+        self._suppressed = {}
+        self._summary_at = 0.0
+
+    def set_rate_limit(self, rate=None, sample=None):
+        """限制每个消息模板的日志数量，返回实例自身。
+
+        日志方法的 ``rate=`` 和 ``sample=`` 参数优先于这里的设置。
+
+        Args:
+            rate (float|None): 每个消息模板每秒最多输出的条数，None 表示
+                               不限制。
+            sample (int|None): 每个消息模板每 ``sample`` 条只输出第一条，
+                               None 表示不采样。
+
+        Returns:
+            self: 实例自身。
+        """
+        self._rate_limit = (rate, sample) if rate or sample else None
+        return self
+
+    def _log(self, level, msg, args, exc_info=None, extra=None,
+             stack_info=False, stacklevel=1, rate=None, sample=None):
+        if rate is None and sample is None and self._rate_limit is not None:
+            rate, sample = self._rate_limit
+        if (rate or sample) and not self._allow(msg, level, rate, sample):
+            return
+        if self._suppressed and time.monotonic() >= self._summary_at:
+            self.report_suppressed()
+        # 多出的一层是这个方法本身
+        super(Logger, self)._log(level, msg, args, exc_info, extra,
+                                 stack_info, stacklevel + 1)
+
+    def _allow(self, msg, level, rate, sample):
+        """记录一次调用并返回是否允许输出。"""
+        key = msg if isinstance(msg, str) else str(msg)
+        now = time.monotonic()
+        with _THROTTLE_LOCK:
+            throttle = self._throttles.get(key)
+            if throttle is None:
+                if len(self._throttles) >= _MAX_THROTTLES:
+                    self._throttles.clear()
+                throttle = self._throttles[key] = [float(rate or 0), now, 0]
+            throttle[2] += 1
+            allowed = not sample or (throttle[2] - 1) % sample == 0
+            if allowed and rate:
+                tokens = min(float(rate),
+                             throttle[0] + (now - throttle[1]) * rate)
+                throttle[1] = now
+                allowed = tokens >= 1
+                throttle[0] = tokens - 1 if allowed else tokens
+            if not allowed:
+                if not self._suppressed:
+                    self._summary_at = \
+                        now + DEFAULTS['SUPPRESSED-SUMMARY-INTERVAL']
+                suppressed = self._suppressed.setdefault(key, [0, level])
+                suppressed[0] += 1
+                suppressed[1] = max(suppressed[1], level)
+        return allowed
+
+    def report_suppressed(self):
+        """立即输出被抑制的日志的汇总。
+
+        汇总记录的等级是被抑制的日志中最高的等级。
+
+        Returns:
+            int: 被抑制的日志总数。
+        """
+        with _THROTTLE_LOCK:
+            suppressed, self._suppressed = self._suppressed, {}
+        if not suppressed:
+            return 0
+        items = sorted(suppressed.items(), key=lambda item: -item[1][0])
+        total = sum(count for _, (count, _) in items)
+        level = max(level for _, (_, level) in items)
+        details = ', '.join('%r x%d' % (key, count)
+                            for key, (count, _) in items[:10])
+        if self.isEnabledFor(level):
+            super(Logger, self)._log(level, 'suppressed %d log records: %s',
+                                     (total, details))
+        return total
 
     def spam(self, *args, **kwargs):
         self.log(logging.SPAM, *args, **kwargs)
@@ -152,6 +315,8 @@ class Logger(logging.Logger):
         Returns:
             self: 实例自身。
         """
+        # 在调用日志方法的线程中为日志记录加上当前上下文的字段
+        hdlr.addFilter(CONTEXT_FILTER)
         super(Logger, self).addHandler(hdlr)
         return self
 
@@ -231,6 +396,204 @@ def get_logger(name=None):
     return getLogger(name)
 
 
+# 绑定到当前上下文的字段，值是一个不会被修改的 dict，绑定时整体替换
+_CONTEXT = contextvars.ContextVar('logkit.context', default={})
+
+
+def bind(**fields):
+    """把字段绑定到当前上下文，之后的日志记录都带有这些字段。
+
+    绑定只影响当前的线程或 asyncio 任务，以及之后由它启动的线程和任务。
+
+    Returns:
+        contextvars.Token: 传给 ``reset_context()`` 可以恢复绑定之前的字段。
+    """
+    context = dict(_CONTEXT.get())
+    context.update(fields)
+    return _CONTEXT.set(context)
+
+
+def unbind(*names):
+    """从当前上下文中移除指定的字段。"""
+    context = _CONTEXT.get()
+    if any(name in context for name in names):
+        _CONTEXT.set(dict((key, value) for key, value in context.items()
+                          if key not in names))
+
+
+def reset_context(token=None):
+    """恢复 ``bind()`` 之前的字段。
+
+    Args:
+        token (contextvars.Token|None): ``bind()`` 的返回值，None 表示清空
+                                        当前上下文的所有字段。
+    """
+    if token is None:
+        _CONTEXT.set({})
+    else:
+        _CONTEXT.reset(token)
+
+
+def get_context():
+    """返回当前上下文绑定的字段。"""
+    return dict(_CONTEXT.get())
+
+
+@contextlib.contextmanager
+def bound_context(**fields):
+    """在 with 语句块中绑定字段，离开时恢复原来的字段。"""
+    token = bind(**fields)
+    try:
+        yield
+    finally:
+        _CONTEXT.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """把当前上下文绑定的字段加入日志记录的过滤器。
+
+    ``extra=`` 参数中的同名字段优先。过滤器不加锁，也不复制字段。
+    ``Logger.addHandler()`` 为日志器上的处理器加上它；``setup_async_handlers()``
+    和 ``setup_aggregator()`` 把处理器移到后台线程中时移除它，因此它只在
+    调用日志方法的线程中执行，后台线程中的处理器看到的是调用者的字段。
+    """
+
+    def filter(self, record):
+        context = _CONTEXT.get()
+        if context:
+            attributes = record.__dict__
+            for key, value in context.items():
+                if key not in attributes:
+                    attributes[key] = value
+        return True
+
+
+CONTEXT_FILTER = ContextFilter()
+
+
+def _start_detached(start):
+    """在空的上下文中启动后台线程，它不应带有启动者绑定的字段。"""
+    contextvars.Context().run(start)
+
+
+def _detach_context_filter(hdlr):
+    """处理器被移到后台线程中后，不再由它加上（后台线程的）上下文字段。
+
+    处理器仍然属于其它日志器时保留过滤器。
+    """
+    loggers = [logging.root] + \
+        list(logging.Logger.manager.loggerDict.values())
+    for logger in loggers:
+        if hdlr in getattr(logger, 'handlers', ()):
+            return
+    hdlr.removeFilter(CONTEXT_FILTER)
+
+
+class ContextThread(threading.Thread):
+    """在启动者的上下文（的副本）中执行 ``run()`` 的线程。
+
+    用法与 ``threading.Thread`` 相同，启动者绑定的字段在线程中仍然有效，
+    线程中的绑定不会影响启动者。
+    """
+
+    def start(self):
+        self._logkit_context = contextvars.copy_context()
+        super(ContextThread, self).start()
+
+    def run(self):
+        self._logkit_context.run(super(ContextThread, self).run)
+
+
+class ContextExecutor(ThreadPoolExecutor):
+    """在提交者的上下文（的副本）中执行每个任务的线程池。
+
+    线程池中的线程会被复用，因此上下文随任务而不是随线程传递。
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super(ContextExecutor, self).submit(
+            contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+# LogRecord 自身的属性，其余的属性来自 ``extra=`` 参数
+_RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__) | \
+    frozenset(['message', 'asctime', 'taskName'])
+
+
+def _dumps_orjson(data):
+    return orjson.dumps(data, default=str).decode('utf-8')
+
+
+def _dumps_json(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'),
+                      default=str)
+
+
+class JSONFormatter(logging.Formatter):
+    """把日志记录格式化为一行 JSON 的格式化器。
+
+    输出的字段在创建时确定，每个字段对应一个预先准备的取值函数；日志调用
+    的 ``extra=`` 参数中的字段也会被输出。有异常信息时增加 ``exc_info``
+    字段。安装了 orjson 时使用它编码，否则使用标准库的 json。
+    """
+
+    def __init__(self, fields=None, datefmt=None, extra=True):
+        """
+        Args:
+            fields (tuple|None): (JSON 中的键, 日志记录的属性) 的序列，None
+                                 表示使用 ``DEFAULTS['JSON-FIELDS']``。
+            datefmt (str|None): 时间格式，None 表示 ISO 8601 格式。
+            extra (bool): 是否输出 ``extra=`` 参数中的字段。
+        """
+        super(JSONFormatter, self).__init__(datefmt=datefmt)
+        if fields is None:
+            fields = DEFAULTS['JSON-FIELDS']
+        self.fields = tuple(fields)
+        self.extra = extra
+        self._getters = tuple((key, self._getter(attribute))
+                              for key, attribute in self.fields)
+        self._dumps = _dumps_json if orjson is None else _dumps_orjson
+        # (秒数, 格式化后的时间前缀, 时区)
+        self._second = (None, None, None)
+
+    def _getter(self, attribute):
+        if attribute == 'message':
+            return logging.LogRecord.getMessage
+        if attribute == 'asctime':
+            return lambda record: self.formatTime(record, self.datefmt)
+        return operator.attrgetter(attribute)
+
+    def formatTime(self, record, datefmt=None):
+        if datefmt:
+            return super(JSONFormatter, self).formatTime(record, datefmt)
+        # 同一秒内的记录共享格式化后的前缀
+        second, prefix, zone = self._second
+        if second != int(record.created):
+            second = int(record.created)
+            struct = self.converter(second)
+            prefix = time.strftime('%Y-%m-%dT%H:%M:%S', struct)
+            zone = time.strftime('%z', struct)
+            zone = zone[:3] + ':' + zone[3:] if zone else ''
+            self._second = (second, prefix, zone)
+        return '%s.%03d%s' % (prefix, record.msecs, zone)
+
+    def format(self, record):
+        data = {}
+        for key, getter in self._getters:
+            data[key] = getter(record)
+        if self.extra:
+            for key, value in record.__dict__.items():
+                if key not in _RECORD_ATTRIBUTES and key not in data:
+                    data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc_info'] = record.exc_text
+        if record.stack_info:
+            data['stack_info'] = self.formatStack(record.stack_info)
+        return self._dumps(data)
+
+
 def _prepare_logger(level, logger):
     """为设置日志处理器的函数准备参数"""
     level = level.upper()
@@ -241,25 +604,202 @@ def _prepare_logger(level, logger):
     return level, logger
 
 
-def setup_colored_handler(level='WARNING', logger=None):
+def setup_colored_handler(level='WARNING', logger=None, json=False):
     """为指定 logger 添加定向到 stderr 的彩色输出日志处理器。
 
     Args:
         level (str): 日志等级。
         logger (None|str|Logger): 日志器或其名称。
+        json (bool): 是否输出 JSON 格式（不带颜色）的日志。
     """
     level, logger = _prepare_logger(level, logger)
     handler = StreamHandler()
     handler.setLevel(level)
-    formatter = ColoredFormatter(DEFAULTS['LOG-FORMAT'],
-                                 DEFAULTS['DATE-FORMAT'],
-                                 DEFAULTS['LEVEL-STYLES'],
-                                 DEFAULTS['FIELD-STYLES'])
+    if json:
+        formatter = JSONFormatter()
+    else:
+        formatter = ColoredFormatter(DEFAULTS['LOG-FORMAT'],
+                                     DEFAULTS['DATE-FORMAT'],
+                                     DEFAULTS['LEVEL-STYLES'],
+                                     DEFAULTS['FIELD-STYLES'])
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
 
-def setup_file_handler(filename, level='WARNING', logger=None):
+class BufferedFileHandler(logging.Handler):
+    """把日志记录缓冲在内存中，成批写入文件的处理器。
+
+    格式化后的日志记录被编码后放入缓冲区，满足下列条件之一时，以一次
+    ``writev()`` 系统调用写入整个缓冲区：
+
+    * 缓冲区达到 ``buffer_size`` 字节；
+    * 最早的日志记录已经缓冲了 ``flush_interval`` 秒，由后台线程检查；
+    * 日志记录的等级不低于 ``flush_level``。
+
+    写入之前检查文件是否被 logrotate 等移走，但每 ``check_interval`` 秒
+    最多检查一次，而不是像 ``WatchedFileHandler`` 那样每条记录都检查。
+    """
+
+    def __init__(self, filename, encoding='utf8', buffer_size=None,
+                 flush_interval=None, flush_level=None, check_interval=None):
+        """
+        Args:
+            filename (str): 日志文件名。
+            encoding (str): 文件编码。
+            buffer_size (int|None): 缓冲区字节数，None 表示使用
+                                    ``DEFAULTS['BUFFER-SIZE']``。
+            flush_interval (float|None): 最长缓冲秒数，None 表示使用
+                                         ``DEFAULTS['FLUSH-INTERVAL']``。
+            flush_level (int|None): 立即写入的等级，None 表示使用
+                                    ``DEFAULTS['FLUSH-LEVEL']``。
+            check_interval (float|None): 检查文件的最小间隔秒数，None
+                表示使用 ``DEFAULTS['ROTATE-CHECK-INTERVAL']``。
+        """
+        super(BufferedFileHandler, self).__init__()
+        self.baseFilename = os.path.abspath(filename)
+        self.encoding = encoding
+        self.buffer_size = DEFAULTS['BUFFER-SIZE'] \
+            if buffer_size is None else buffer_size
+        self.flush_interval = DEFAULTS['FLUSH-INTERVAL'] \
+            if flush_interval is None else flush_interval
+        self.flush_level = DEFAULTS['FLUSH-LEVEL'] \
+            if flush_level is None else flush_level
+        self.check_interval = DEFAULTS['ROTATE-CHECK-INTERVAL'] \
+            if check_interval is None else check_interval
+        self._buffer = []
+        self._size = 0
+        self._since = None
+        self._fd = None
+        self._identity = None
+        self._checked = 0.0
+        self._open()
+        _BUFFERED_HANDLERS.add(self)
+        _start_flusher()
+
+    def _open(self):
+        self._fd = os.open(self.baseFilename,
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        stat = os.fstat(self._fd)
+        self._identity = (stat.st_dev, stat.st_ino)
+        self._checked = time.monotonic()
+
+    def _reopen_if_moved(self):
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            stat = os.stat(self.baseFilename)
+            identity = (stat.st_dev, stat.st_ino)
+        except FileNotFoundError:
+            identity = None
+        if identity != self._identity:
+            os.close(self._fd)
+            self._open()
+
+    def emit(self, record):
+        try:
+            data = (self.format(record) + '\n').encode(self.encoding)
+        except Exception:
+            self.handleError(record)
+            return
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._since is None:
+            self._since = time.monotonic()
+        if self._size >= self.buffer_size or \
+                record.levelno >= self.flush_level:
+            self._write()
+
+    def _write(self):
+        """写入缓冲区，调用者需要持有锁。"""
+        if not self._buffer or self._fd is None:
+            return
+        buffers, self._buffer = self._buffer, []
+        self._size = 0
+        self._since = None
+        try:
+            self._reopen_if_moved()
+            _write_buffers(self._fd, buffers)
+        except OSError:
+            self.handleError(None)
+
+    def flush(self):
+        self.acquire()
+        try:
+            self._write()
+        finally:
+            self.release()
+
+    def _flush_if_aged(self, now):
+        since = self._since
+        if since is not None and now - since >= self.flush_interval:
+            self.flush()
+
+    def close(self):
+        self.acquire()
+        try:
+            self._write()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        finally:
+            self.release()
+        _BUFFERED_HANDLERS.discard(self)
+        super(BufferedFileHandler, self).close()
+
+    def _reset_after_fork(self):
+        # 缓冲区中的记录属于父进程，由父进程写入
+        self._buffer = []
+        self._size = 0
+        self._since = None
+
+
+# IOV_MAX，一次 writev() 最多可以写入的缓冲区数量
+_IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+
+def _write_buffers(fd, buffers):
+    """把多个缓冲区写入文件，处理部分写入的情况。"""
+    if not hasattr(os, 'writev'):
+        data = memoryview(b''.join(buffers))
+        while data:
+            data = data[os.write(fd, data):]
+        return
+    buffers = [memoryview(data) for data in buffers]
+    while buffers:
+        written = os.writev(fd, buffers[:_IOV_MAX])
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers[0])
+            buffers.pop(0)
+        if written:
+            buffers[0] = buffers[0][written:]
+
+
+# 所有的 BufferedFileHandler 实例，由后台线程定期检查是否需要写入
+_BUFFERED_HANDLERS = weakref.WeakSet()
+_FLUSHER = {'thread': None}
+
+
+def _flush_aged_buffers():
+    while True:
+        interval = DEFAULTS['FLUSH-INTERVAL']
+        time.sleep(max(min(interval / 2.0, 1.0), 0.01))
+        now = time.monotonic()
+        for handler in list(_BUFFERED_HANDLERS):
+            handler._flush_if_aged(now)
+
+
+def _start_flusher():
+    if _FLUSHER['thread'] is None:
+        thread = threading.Thread(target=_flush_aged_buffers,
+                                  name='logkit.flusher', daemon=True)
+        _FLUSHER['thread'] = thread
+        _start_detached(thread.start)
+
+
+def setup_file_handler(filename, level='WARNING', logger=None,
+                       buffered=False, json=False):
     """设置保存在文件系统的日志。
 
     程序能够感知诸如 logrotate 对日志的处理并自动打开新的日志文件。
@@ -268,11 +808,399 @@ def setup_file_handler(filename, level='WARNING', logger=None):
         filename (str): 日志文件名。
         level (str): 日志等级。
         logger (None|str|Logger): 日志器或其名称。
+        buffered (bool): 是否使用 ``BufferedFileHandler`` 成批写入文件。
+        json (bool): 是否输出 JSON 格式的日志。
     """
     level, logger = _prepare_logger(level, logger)
-    handler = WatchedFileHandler(filename, 'a', encoding='utf8')
+    if buffered:
+        handler = BufferedFileHandler(filename, encoding='utf8')
+    else:
+        handler = WatchedFileHandler(filename, 'a', encoding='utf8')
     handler.setLevel(level)
-    formatter = logging.Formatter(DEFAULTS['LOG-FORMAT'],
-                                  DEFAULTS['DATE-FORMAT'])
+    if json:
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter(DEFAULTS['LOG-FORMAT'],
+                                      DEFAULTS['DATE-FORMAT'])
     handler.setFormatter(formatter)
     logger.addHandler(handler)
+
+
+class AsyncHandler(QueueHandler):
+    """把日志记录放入有界队列，由后台的 ``QueueListener`` 交给真正的处理器。
+
+    队列已满时，``DROP`` 策略丢弃日志记录并计数，之后第一条成功入队的记录
+    之前会插入一条 WARNING 记录报告丢弃的数量；``BLOCK`` 策略等待队列
+    有空位。
+    """
+
+    def __init__(self, handlers, queue_size=None, policy=None):
+        """
+        Args:
+            handlers (list): 在后台线程中执行的日志处理器。
+            queue_size (int|None): 队列容量，None 表示使用
+                                   ``DEFAULTS['QUEUE-SIZE']``。
+            policy (str|None): 队列已满时的策略，None 表示使用
+                               ``DEFAULTS['QUEUE-POLICY']``。
+        """
+        self.queue_size = queue_size or DEFAULTS['QUEUE-SIZE']
+        self.policy = policy or DEFAULTS['QUEUE-POLICY']
+        if self.policy not in (DROP, BLOCK):
+            raise ValueError('unknown policy: %s' % self.policy)
+        super(AsyncHandler, self).__init__(queue.Queue(self.queue_size))
+        self.dropped = 0
+        self._unreported = 0
+        self.listener = QueueListener(self.queue, *handlers,
+                                      respect_handler_level=True)
+        _start_detached(self.listener.start)
+
+    @property
+    def handlers(self):
+        return self.listener.handlers
+
+    def add_handlers(self, handlers):
+        """增加在后台线程中执行的日志处理器。"""
+        self.listener.handlers = self.listener.handlers + tuple(handlers)
+
+    def enqueue(self, record):
+        if self.policy == BLOCK:
+            self.queue.put(record)
+            return
+        # ``handle()`` 已经持有这个可重入锁，直接调用 ``emit()`` 时计数器
+        # 同样需要它保护
+        with self.lock:
+            try:
+                if self._unreported:
+                    self.queue.put_nowait(self._dropped_record())
+                    self._unreported = 0
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+                self._unreported += 1
+
+    def _dropped_record(self):
+        return logging.makeLogRecord({
+            'name': __name__, 'levelno': logging.WARNING,
+            'levelname': 'WARNING',
+            'msg': '%d log records dropped, the queue is full' %
+                   self._unreported,
+        })
+
+    def stop(self):
+        """处理完队列中的日志记录后停止后台线程。"""
+        if self.listener._thread is not None:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.flush()
+
+    def close(self):
+        self.stop()
+        super(AsyncHandler, self).close()
+
+    def _reset_after_fork(self):
+        # 队列中的记录属于父进程，它们会由父进程的后台线程处理；后台线程没有
+        # 被复制到子进程中，因此使用新的队列和线程
+        self.queue = queue.Queue(self.queue_size)
+        self._unreported = 0
+        self.listener = QueueListener(self.queue, *self.listener.handlers,
+                                      respect_handler_level=True)
+        _start_detached(self.listener.start)
+
+
+# 所有的 AsyncHandler 实例
+_ASYNC_HANDLERS = []
+_ASYNC_LOCK = threading.Lock()
+
+
+def setup_async_handlers(logger=None, queue_size=None, policy=None):
+    """把日志器上的处理器移到后台线程中执行。
+
+    应该在 ``setup_*_handler()`` 之后调用；再次调用时，新增加的处理器也会被
+    移到后台线程中。进程退出时会处理完队列中的日志记录；fork 产生的子进程
+    会启动自己的后台线程。
+
+    Args:
+        logger (None|str|Logger): 日志器或其名称。
+        queue_size (int|None): 队列容量，None 表示使用
+                               ``DEFAULTS['QUEUE-SIZE']``。
+        policy (str|None): 队列已满时的策略（``DROP`` 或 ``BLOCK``），None
+                           表示使用 ``DEFAULTS['QUEUE-POLICY']``。
+
+    Returns:
+        AsyncHandler: 日志器上的异步处理器。
+    """
+    if not isinstance(logger, Logger):
+        logger = get_logger(logger)
+    with _ASYNC_LOCK:
+        current = None
+        handlers = []
+        for hdlr in logger.handlers[:]:
+            if isinstance(hdlr, AsyncHandler):
+                current = hdlr
+            else:
+                handlers.append(hdlr)
+                logger.removeHandler(hdlr)
+                _detach_context_filter(hdlr)
+        if current is not None:
+            current.add_handlers(handlers)
+            return current
+        hdlr = AsyncHandler(handlers, queue_size, policy)
+        logger.addHandler(hdlr)
+        _ASYNC_HANDLERS.append(hdlr)
+    return hdlr
+
+
+@atexit.register
+def _stop_async_handlers():
+    for hdlr in _ASYNC_HANDLERS:
+        hdlr.stop()
+
+
+@atexit.register
+def _report_all_suppressed():
+    # 在 _stop_async_handlers() 之前执行
+    # ``getLogger()`` 把日志器注册在 logging 模块的 manager 中
+    loggers = [logging.root] + \
+        list(logging.Logger.manager.loggerDict.values())
+    for logger in loggers:
+        if isinstance(logger, Logger) and logger._suppressed:
+            logger.report_suppressed()
+
+
+# 聚合日志时，长度前缀的格式
+_FRAME_HEADER = struct.Struct('>L')
+
+# 聚合日志时，每次从 socket 读取的最大字节数
+_RECV_SIZE = 256 * 1024
+
+
+def _encode_record(record):
+    """把日志记录编码为带长度前缀的 JSON，参见 ``SocketHandler.makePickle()``。"""
+    data = dict(record.__dict__)
+    data['msg'] = record.getMessage()
+    data['args'] = None
+    data['exc_info'] = None
+    data.pop('message', None)
+    if record.exc_info and not record.exc_text:
+        data['exc_text'] = logging.Formatter().formatException(
+            record.exc_info)
+    if orjson is not None:
+        payload = orjson.dumps(data, default=str)
+    else:
+        payload = json.dumps(data, default=str).encode('utf-8')
+    return _FRAME_HEADER.pack(len(payload)) + payload
+
+
+class LogAggregator(object):
+    """在后台线程中接收各个子进程发送的日志记录，交给日志处理器。
+
+    子进程使用 ``AggregatedHandler`` 通过 Unix socket 发送日志记录，每个
+    子进程使用自己的连接，每条记录带有长度前缀，因此同一个子进程的记录
+    保持顺序，每条记录都完整地写入。每一轮读取到的记录处理完之后才调用
+    处理器的 ``flush()``，配合 ``BufferedFileHandler`` 可以成批写入。
+    """
+
+    def __init__(self, handlers, path=None):
+        """
+        Args:
+            handlers (list): 写入日志的处理器。
+            path (str|None): Unix socket 的路径，None 表示在只有当前用户
+                             可以访问的临时目录中创建。
+        """
+        self.handlers = tuple(handlers)
+        self._directory = None
+        if path is None:
+            self._directory = tempfile.mkdtemp(prefix='logkit-')
+            path = os.path.join(self._directory, 'aggregator.sock')
+        self.path = path
+        self._pid = os.getpid()
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(128)
+        self._server.setblocking(False)
+        self._wakeup, self._waker = socket.socketpair()
+        self._closed = False
+        self._thread = threading.Thread(target=self._serve,
+                                        name='logkit.aggregator',
+                                        daemon=True)
+        _start_detached(self._thread.start)
+
+    def handle(self, record):
+        """把日志记录交给处理器。"""
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _serve(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._server, selectors.EVENT_READ, None)
+        selector.register(self._wakeup, selectors.EVENT_READ, None)
+        while not self._closed:
+            events = selector.select()
+            self._process(selector, events)
+        # 退出前处理完已经收到的数据
+        while True:
+            events = selector.select(0)
+            if not self._process(selector, events):
+                break
+        for key in list(selector.get_map().values()):
+            if key.data is not None:
+                key.fileobj.close()
+        selector.close()
+
+    def _process(self, selector, events):
+        """处理一轮事件，返回是否有新的连接或数据。"""
+        active = received = False
+        for key, _ in events:
+            if key.fileobj is self._server:
+                try:
+                    conn, _ = self._server.accept()
+                except BlockingIOError:
+                    continue
+                conn.setblocking(False)
+                selector.register(conn, selectors.EVENT_READ, bytearray())
+                active = True
+                continue
+            if key.fileobj is self._wakeup:
+                self._wakeup.recv(64)
+                continue
+            try:
+                chunk = key.fileobj.recv(_RECV_SIZE)
+            except BlockingIOError:
+                continue
+            except OSError:
+                chunk = b''
+            active = True
+            if not chunk:
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                continue
+            buf = key.data
+            buf += chunk
+            offset = 0
+            while len(buf) - offset >= _FRAME_HEADER.size:
+                size, = _FRAME_HEADER.unpack_from(buf, offset)
+                end = offset + _FRAME_HEADER.size + size
+                if len(buf) < end:
+                    break
+                payload = bytes(buf[offset + _FRAME_HEADER.size:end])
+                offset = end
+                try:
+                    record = logging.makeLogRecord(json.loads(payload))
+                except ValueError:
+                    continue
+                self.handle(record)
+                received = True
+            del buf[:offset]
+        if received:
+            for handler in self.handlers:
+                handler.flush()
+        return active
+
+    def close(self):
+        """处理完已经收到的日志记录后停止后台线程。"""
+        if self._closed or os.getpid() != self._pid:
+            return
+        self._closed = True
+        self._waker.send(b'x')
+        self._thread.join()
+        self._server.close()
+        self._wakeup.close()
+        self._waker.close()
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+        else:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class AggregatedHandler(SocketHandler):
+    """把日志记录交给 ``LogAggregator`` 的处理器。
+
+    在创建 ``LogAggregator`` 的进程中直接调用它的处理器，在 fork 产生的
+    子进程中通过 Unix socket 发送给它。
+    """
+
+    def __init__(self, aggregator):
+        """
+        Args:
+            aggregator (LogAggregator|str): 聚合器，或者其 socket 的路径
+                                            （在不是由 fork 产生的进程中）。
+        """
+        path = getattr(aggregator, 'path', aggregator)
+        super(AggregatedHandler, self).__init__(path, None)
+        self.aggregator = aggregator if path is not aggregator else None
+        _AGGREGATED_HANDLERS.add(self)
+
+    def makePickle(self, record):
+        return _encode_record(record)
+
+    def emit(self, record):
+        if self.aggregator is not None:
+            self.aggregator.handle(record)
+        else:
+            super(AggregatedHandler, self).emit(record)
+
+    def _reset_after_fork(self):
+        # 子进程使用自己的连接
+        self.aggregator = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+# 所有的 AggregatedHandler 和 LogAggregator 实例
+_AGGREGATED_HANDLERS = weakref.WeakSet()
+_AGGREGATORS = []
+
+
+def setup_aggregator(logger=None, path=None):
+    """在 fork 之前调用，由当前进程的一个线程写入所有子进程的日志。
+
+    日志器上原有的处理器被移到 ``LogAggregator`` 中，日志器上只保留一个
+    ``AggregatedHandler``。
+
+    Args:
+        logger (None|str|Logger): 日志器或其名称。
+        path (str|None): Unix socket 的路径，None 表示使用临时目录。
+
+    Returns:
+        LogAggregator: 聚合器。
+    """
+    if not isinstance(logger, Logger):
+        logger = get_logger(logger)
+    handlers = logger.handlers[:]
+    for hdlr in handlers:
+        logger.removeHandler(hdlr)
+        _detach_context_filter(hdlr)
+    aggregator = LogAggregator(handlers, path)
+    _AGGREGATORS.append(aggregator)
+    logger.addHandler(AggregatedHandler(aggregator))
+    return aggregator
+
+
+@atexit.register
+def _close_aggregators():
+    for aggregator in _AGGREGATORS:
+        aggregator.close()
+
+
+def _reset_after_fork():
+    global _ASYNC_LOCK, _THROTTLE_LOCK
+    _ASYNC_LOCK = threading.Lock()
+    _THROTTLE_LOCK = threading.Lock()
+    for hdlr in _ASYNC_HANDLERS:
+        hdlr._reset_after_fork()
+    for hdlr in list(_BUFFERED_HANDLERS):
+        hdlr._reset_after_fork()
+    _FLUSHER['thread'] = None
+    if _BUFFERED_HANDLERS:
+        _start_flusher()
+    for hdlr in list(_AGGREGATED_HANDLERS):
+        hdlr._reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
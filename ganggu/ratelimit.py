@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012-2016 Xue Can <xuecan@gmail.com> and contributors.
+# Licensed under the MIT license: http://opensource.org/licenses/mit-license
+
+"""
+基于 Redis 的限流器和分布式锁
+=============================
+
+本模块提供了滑动窗口限流器 ``SlidingWindowLimiter``、令牌桶限流器
+``TokenBucketLimiter`` 以及带有防护令牌（fencing token）的分布式锁
+``FencedLock``。
+
+每一次检查都只执行一个 Lua 脚本，因此是原子的，也只需要一次往返。脚本通过
+``redis.StrictRedis.register_script()`` 注册，执行时使用 ``EVALSHA``，仅当
+Redis 中没有缓存该脚本时才会发送脚本内容。
+
+例如，限制对某个外部服务的调用每秒不超过 10 次::
+
+    from ganggu import httpkit, redisstore, ratelimit
+
+    store = redisstore.get_redis_store('redis://127.0.0.1:6379/0')
+    limiter = ratelimit.TokenBucketLimiter(store, rate=10, capacity=10)
+    limiter.acquire('api.example.com')
+    resp = httpkit.get('http://api.example.com/')
+
+本模块依赖如下第三方库：
+
+* `redis <https://pypi.python.org/pypi/redis>`_
+"""
+
+import os
+import abc
+import time
+import uuid
+from collections import namedtuple
+
+__version__ = '1.0.0'
+
+
+# 默认的键前缀
+PREFIX = 'ratelimit:'
+
+
+# 限流检查的结果
+#   allowed (bool): 是否允许本次请求。
+#   remaining (int): 剩余可用的次数。
+#   retry_after (float): 被拒绝时，至少需要等待的秒数。
+Limit = namedtuple('Limit', ['allowed', 'remaining', 'retry_after'])
+
+
+class RateLimitExceeded(Exception):
+    """在限定的时间内未能获得许可。"""
+
+    def __init__(self, key, retry_after):
+        Exception.__init__(self, 'rate limit exceeded for %s, retry after'
+                           ' %.3fs' % (key, retry_after))
+        self.key = key
+        self.retry_after = retry_after
+
+
+# 脚本使用 Redis 服务器的时钟，避免各客户端的时钟偏差；Redis 5 之前需要
+# 先开启命令复制才能在 TIME 之后写入
+_NOW_MS = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+"""
+
+# KEYS[1]: 有序集合；ARGV: 窗口毫秒数、上限、成员
+_SLIDING_WINDOW_SCRIPT = _NOW_MS + """
+local window = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+local count = redis.call('ZCARD', KEYS[1])
+if count < limit then
+    redis.call('ZADD', KEYS[1], now, ARGV[3])
+    redis.call('PEXPIRE', KEYS[1], window)
+    return {1, limit - count - 1, 0}
+end
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if oldest[2] == nil then
+    return {0, 0, window}
+end
+return {0, 0, tonumber(oldest[2]) + window - now}
+"""
+
+# KEYS[1]: 哈希表；ARGV: 每秒令牌数、容量、请求的令牌数
+_TOKEN_BUCKET_SCRIPT = _NOW_MS + """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+if now > ts then
+    tokens = math.min(capacity, tokens + (now - ts) * rate / 1000)
+else
+    now = ts
+end
+local allowed = 0
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+    allowed = 1
+else
+    wait = math.ceil((requested - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity * 1000 / rate) + 1000)
+return {allowed, math.floor(tokens), wait}
+"""
+
+# KEYS[1]: 锁；KEYS[2]: 防护令牌计数器；ARGV: 持有者标识、毫秒数
+_LOCK_ACQUIRE_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return redis.call('INCR', KEYS[2])
+end
+return false
+"""
+
+# KEYS[1]: 锁；ARGV: 持有者标识
+_LOCK_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS[1]: 锁；ARGV: 持有者标识、毫秒数
+_LOCK_EXTEND_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class _Limiter(object, metaclass=abc.ABCMeta):
+    """限流器的公共部分，子类实现 ``hit()``。"""
+
+    script = None
+
+    def __init__(self, store, prefix=None):
+        self.store = store
+        self.prefix = PREFIX if prefix is None else prefix
+        self._script = store.register_script(self.script)
+
+    @abc.abstractmethod
+    def hit(self, key, cost=1):
+        """检查并记录一次请求。
+
+        Args:
+            key (str): 限流对象，例如下游服务的主机名。
+            cost (int): 本次请求消耗的次数。
+
+        Returns:
+            Limit: 检查结果。
+        """
+
+    def acquire(self, key, cost=1, timeout=None):
+        """阻塞直到获得许可。
+
+        Args:
+            key (str): 限流对象。
+            cost (int): 本次请求消耗的次数。
+            timeout (float|None): 最多等待的秒数，None 表示一直等待。
+
+        Returns:
+            Limit: 允许请求时的检查结果。
+
+        Raises:
+            RateLimitExceeded: 在 ``timeout`` 秒内未能获得许可。
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            result = self.hit(key, cost)
+            if result.allowed:
+                return result
+            wait = result.retry_after
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if wait > left:
+                    raise RateLimitExceeded(key, wait)
+            time.sleep(wait)
+
+
+class SlidingWindowLimiter(_Limiter):
+    """滑动窗口限流器：任意 ``window`` 秒内最多 ``limit`` 次。
+
+    每次请求都记录在有序集合中，因此内存占用与 ``limit`` 成正比，适合
+    上限不大的场景。
+    """
+
+    script = _SLIDING_WINDOW_SCRIPT
+
+    def __init__(self, store, limit, window, prefix=None):
+        """
+        Args:
+            store (redis.StrictRedis): Redis 客户端。
+            limit (int): 窗口内允许的次数。
+            window (float): 窗口的秒数。
+            prefix (str|None): 键前缀，None 表示使用 ``PREFIX``。
+        """
+        super(SlidingWindowLimiter, self).__init__(store, prefix)
+        self.limit = int(limit)
+        self.window = float(window)
+
+    def hit(self, key, cost=1):
+        if cost != 1:
+            raise ValueError('sliding window limiter only supports cost=1')
+        if self.limit <= 0:
+            return Limit(False, 0, self.window)
+        allowed, remaining, wait = self._script(
+            keys=[self.prefix + 'sw:' + key],
+            args=[int(self.window * 1000), self.limit, os.urandom(8).hex()])
+        return Limit(bool(allowed), remaining, wait / 1000.0)
+
+
+class TokenBucketLimiter(_Limiter):
+    """令牌桶限流器：平均每秒 ``rate`` 次，允许 ``capacity`` 次的突发。
+
+    每个限流对象只占用一个哈希表。
+    """
+
+    script = _TOKEN_BUCKET_SCRIPT
+
+    def __init__(self, store, rate, capacity=None, prefix=None):
+        """
+        Args:
+            store (redis.StrictRedis): Redis 客户端。
+            rate (float): 每秒补充的令牌数。
+            capacity (int|None): 桶的容量，None 表示与 ``rate`` 相同。
+            prefix (str|None): 键前缀，None 表示使用 ``PREFIX``。
+        """
+        super(TokenBucketLimiter, self).__init__(store, prefix)
+        if rate <= 0:
+            raise ValueError('rate should be positive')
+        self.rate = float(rate)
+        self.capacity = int(capacity or max(1, rate))
+
+    def hit(self, key, cost=1):
+        if cost > self.capacity:
+            raise ValueError('cost should not exceed capacity')
+        allowed, remaining, wait = self._script(
+            keys=[self.prefix + 'tb:' + key],
+            args=[repr(self.rate), self.capacity, cost])
+        return Limit(bool(allowed), remaining, wait / 1000.0)
+
+
+class FencedLock(object):
+    """带防护令牌的分布式锁。
+
+    每次成功获得锁都会得到一个单调递增的整数令牌。受保护的资源应该拒绝
+    携带比已见过的令牌更小的请求，这样即使锁因超时被他人获得，旧的持有者
+    也无法破坏数据。
+    """
+
+    def __init__(self, store, name, ttl=10.0, prefix=None):
+        """
+        Args:
+            store (redis.StrictRedis): Redis 客户端。
+            name (str): 锁的名称。
+            ttl (float): 锁自动过期的秒数。
+            prefix (str|None): 键前缀，None 表示使用 ``PREFIX``。
+        """
+        prefix = PREFIX if prefix is None else prefix
+        self.store = store
+        self.name = name
+        self.ttl = float(ttl)
+        # 脚本同时访问这两个键，使用相同的 hash tag 使它们在 Redis Cluster
+        # 中位于同一个槽
+        self.key = prefix + 'lock:{' + name + '}'
+        self.fence_key = prefix + 'fence:{' + name + '}'
+        self.token = None
+        self.fence = None
+        self._acquire = store.register_script(_LOCK_ACQUIRE_SCRIPT)
+        self._release = store.register_script(_LOCK_RELEASE_SCRIPT)
+        self._extend = store.register_script(_LOCK_EXTEND_SCRIPT)
+
+    def acquire(self, blocking=True, timeout=None, interval=0.05):
+        """获得锁。
+
+        Args:
+            blocking (bool): 锁被占用时是否等待。
+            timeout (float|None): 最多等待的秒数，None 表示一直等待。
+            interval (float): 重试的间隔秒数。
+
+        Returns:
+            int|None: 防护令牌，未能获得锁时返回 None。
+        """
+        token = uuid.uuid4().hex
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            fence = self._acquire(keys=[self.key, self.fence_key],
+                                  args=[token, int(self.ttl * 1000)])
+            if fence is not None:
+                self.token = token
+                self.fence = int(fence)
+                return self.fence
+            if not blocking or \
+                    (deadline is not None and time.monotonic() >= deadline):
+                return None
+            time.sleep(interval)
+
+    def release(self):
+        """释放锁。
+
+        Returns:
+            bool: 如果锁已经过期或被他人持有则返回 False。
+        """
+        if self.token is None:
+            return False
+        released = self._release(keys=[self.key], args=[self.token])
+        self.token = None
+        self.fence = None
+        return bool(released)
+
+    def extend(self, ttl=None):
+        """将锁的过期时间重置为 ``ttl`` 秒。
+
+        Returns:
+            bool: 如果锁已经过期或被他人持有则返回 False。
+        """
+        if self.token is None:
+            return False
+        ttl = self.ttl if ttl is None else ttl
+        return bool(self._extend(keys=[self.key],
+                                 args=[self.token, int(ttl * 1000)]))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
@@ -5,43 +5,959 @@
 """
 # Tools for Redis
 
+`make_redis_store()` creates a standalone client with its own connection
+pool. `get_redis_store()` looks up a process-wide registry keyed by the
+normalized URI, so all callers of the same URI share one
+`BlockingConnectionPool`. The registry is reset in child processes after
+`os.fork()`.
+
+Besides single nodes, ``redis+sentinel://`` and ``redis+cluster://`` uris
+create clients which read from replicas.
+
+`BatchStore` wraps a client and runs bulk operations over arbitrarily large
+iterables in pipelined chunks, streaming the results back.
+
+`NearCache` keeps hot string keys in a bounded in-process LRU map. Entries
+are invalidated through Redis client tracking, or through a pub/sub channel
+when the server does not support tracking.
+
+`Codec` serializes Python values (json, msgpack or pickle) and compresses
+large payloads (zlib or lz4). `CodecStore` wraps a client to read and write
+values through a codec.
+
+`make_async_redis_store()` accepts the same uris and returns an asyncio
+client. Clients of one event loop share a pool per uri; `AsyncBatchStore`
+is the asyncio counterpart of `BatchStore`.
+
 Requirement:
 
 * redis
+* msgpack (optional, for the msgpack codec)
+* lz4 (optional, for lz4 compression)
 """
 
-from urllib.parse import urlparse, unquote
+import os
+import time
+import threading
+import weakref
+from collections import OrderedDict
+from itertools import islice
+from urllib.parse import urlparse, unquote, quote
+import json
+import zlib
+import pickle
+import asyncio
 import redis
+import redis.asyncio
+from redis.cluster import RedisCluster, ClusterNode
+from redis.sentinel import Sentinel
+from redis.asyncio import cluster as async_cluster
+from redis.asyncio import sentinel as async_sentinel
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
 
 RedisError = redis.RedisError
 
 SOCKET_CONNECT_TIMEOUT = 2.0
 SOCKET_TIMEOUT = 5.0
 
+# defaults of the shared connection pools
+MAX_CONNECTIONS = 50
+POOL_TIMEOUT = 2.0           # seconds to wait for a free connection
+HEALTH_CHECK_INTERVAL = 30   # seconds, 0 to disable
 
-def make_redis_store(uri):
-    """Create a redis instance.
+# number of commands sent in one pipeline by `BatchStore`
+BATCH_SIZE = 500
 
-    redis[+legacy|+strict]://[:password@]host:port/db
-    """
+# defaults of `NearCache`
+NEAR_CACHE_SIZE = 1024
+NEAR_CACHE_TTL = 60
+NEAR_CACHE_CHANNEL = 'ganggu:near-cache:invalidate'
+TRACKING_CHANNEL = '__redis__:invalidate'
+
+# payloads of `Codec` larger than this (in bytes) are compressed
+COMPRESS_THRESHOLD = 1024
+
+SENTINEL_SCHEME = 'redis+sentinel'
+CLUSTER_SCHEME = 'redis+cluster'
+
+# commands a `SentinelStore` sends to replicas
+READ_COMMANDS = frozenset([
+    'GET', 'MGET', 'GETRANGE', 'STRLEN', 'EXISTS', 'TYPE', 'TTL', 'PTTL',
+    'HGET', 'HMGET', 'HGETALL', 'HKEYS', 'HVALS', 'HLEN', 'HEXISTS',
+    'HSTRLEN', 'LINDEX', 'LLEN', 'LRANGE', 'SCARD', 'SISMEMBER',
+    'SMISMEMBER', 'SMEMBERS', 'SRANDMEMBER', 'SINTER', 'SUNION', 'SDIFF',
+    'ZCARD', 'ZCOUNT', 'ZLEXCOUNT', 'ZRANGE', 'ZRANGEBYLEX', 'ZRANGEBYSCORE',
+    'ZRANK', 'ZREVRANGE', 'ZREVRANGEBYLEX', 'ZREVRANGEBYSCORE', 'ZREVRANK',
+    'ZSCORE', 'ZMSCORE', 'GETBIT', 'BITCOUNT', 'BITPOS', 'PFCOUNT',
+    'SCAN', 'SSCAN', 'HSCAN', 'ZSCAN', 'DBSIZE',
+])
+
+DEFAULT_PORT = 6379
+SENTINEL_PORT = 26379
+DEFAULT_DATABASE = 0
+
+# normalized uri -> client sharing a pool
+_REGISTRY = {}
+_REGISTRY_LOCK = threading.Lock()
+
+# event loop -> {normalized uri -> asyncio client sharing a pool}
+_ASYNC_REGISTRY = weakref.WeakKeyDictionary()
+
+# live `NearCache` instances, their listeners are restarted after fork
+_NEAR_CACHES = weakref.WeakSet()
+
+
+def _parse_hosts(netloc, default_port=DEFAULT_PORT):
+    """Parse ``host:port[,host:port...]`` into a list of (host, port)."""
+    hosts = []
+    for item in netloc.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        result = urlparse('//' + item)
+        hosts.append(((result.hostname or 'localhost').lower(),
+                      result.port or default_port))
+    return hosts or [('localhost', default_port)]
+
+
+def _parse_uri(uri):
+    """Parse a redis uri into a dict of connection arguments."""
     result = urlparse(uri)
     scheme = result.scheme.lower()
-    if not result.scheme.startswith('redis'):
+    if not scheme.startswith('redis'):
         raise ValueError('not a redis uri')
-    host = result.hostname
-    port = result.port
-    database = int(result.path[1:])
-    if result.password:
-        password = unquote(result.password)
-    else:
-        password = None
+    # ``urlparse`` cannot split a netloc holding several hosts
+    auth, _, netloc = result.netloc.rpartition('@')
+    password = auth.partition(':')[2] if auth else ''
+    password = unquote(password) if password else None
+    hosts = _parse_hosts(netloc, SENTINEL_PORT if scheme == SENTINEL_SCHEME
+                         else DEFAULT_PORT)
+    segments = [seg for seg in result.path.split('/') if seg]
+    service = None
+    if scheme == SENTINEL_SCHEME:
+        if not segments:
+            raise ValueError('service name is required for redis+sentinel')
+        service = unquote(segments.pop(0))
+    elif len(hosts) > 1 and scheme != CLUSTER_SCHEME:
+        raise ValueError('only redis+sentinel and redis+cluster accept'
+                         ' multiple hosts')
+    db = int(segments[0]) if segments else DEFAULT_DATABASE
+    if scheme == CLUSTER_SCHEME and db != 0:
+        raise ValueError('redis cluster only supports database 0')
+    return {
+        'scheme': scheme,
+        'hosts': hosts,
+        'host': hosts[0][0],
+        'port': hosts[0][1],
+        'db': db,
+        'password': password,
+        'service': service,
+    }
+
+
+def _client_class(scheme):
     if scheme == 'redis+legacy':
-        class_ = redis.Redis
-    else:
-        class_ = redis.StrictRedis
+        return redis.Redis
+    return redis.StrictRedis
+
+
+def normalize_uri(uri):
+    """Return the canonical form of a redis uri.
+
+    Scheme and hostnames are lower-cased, the ports and database are filled
+    with their defaults and ``redis+strict`` is folded into ``redis``.
+    """
+    params = _parse_uri(uri)
+    scheme = params['scheme']
+    if scheme == 'redis+strict':
+        scheme = 'redis'
+    auth = ''
+    if params['password'] is not None:
+        auth = ':%s@' % quote(params['password'], safe='')
+    hosts = ','.join('%s:%d' % host for host in params['hosts'])
+    path = '/%d' % params['db']
+    if params['service'] is not None:
+        path = '/%s%s' % (quote(params['service'], safe=''), path)
+    return '%s://%s%s%s' % (scheme, auth, hosts, path)
+
+
+class SentinelStore(redis.StrictRedis):
+    """A client for a Sentinel-managed deployment.
+
+    Writes go to the master, commands listed in `READ_COMMANDS` go to a
+    replica picked by Sentinel. Pipelines and transactions always run on
+    the master.
+    """
+
+    def __init__(self, connection_pool, replica_pool):
+        super(SentinelStore, self).__init__(connection_pool=connection_pool)
+        self.replica = redis.StrictRedis(connection_pool=replica_pool)
+
+    def execute_command(self, *args, **options):
+        if str(args[0]).upper() in READ_COMMANDS:
+            return self.replica.execute_command(*args, **options)
+        return super(SentinelStore, self).execute_command(*args, **options)
+
+
+def _make_sentinel_store(params, **kwargs):
+    options = {
+        'socket_timeout': SOCKET_TIMEOUT,
+        'socket_connect_timeout': SOCKET_CONNECT_TIMEOUT,
+    }
+    sentinel = Sentinel(params['hosts'], sentinel_kwargs=dict(options),
+                        **options)
+    kwargs.update(db=params['db'], password=params['password'])
+    master = sentinel.master_for(params['service'], **kwargs)
+    replica = sentinel.slave_for(params['service'], **kwargs)
+    return SentinelStore(master.connection_pool, replica.connection_pool)
+
+
+def _make_cluster_store(params, **kwargs):
+    nodes = [ClusterNode(host, port) for host, port in params['hosts']]
+    kwargs.setdefault('read_from_replicas', True)
+    return RedisCluster(startup_nodes=nodes,
+                        password=params['password'],
+                        socket_timeout=SOCKET_TIMEOUT,
+                        socket_connect_timeout=SOCKET_CONNECT_TIMEOUT,
+                        **kwargs)
+
+
+def make_redis_store(uri, connection_pool=None, **kwargs):
+    """Create a redis instance.
+
+    redis[+legacy|+strict]://[:password@]host:port/db
+    redis+sentinel://[:password@]host:port[,host:port...]/service[/db]
+    redis+cluster://[:password@]host:port[,host:port...]
+
+    The hosts of ``redis+sentinel`` are the sentinels, the returned
+    `SentinelStore` sends reads to replicas. The hosts of ``redis+cluster``
+    are startup nodes, the returned `redis.cluster.RedisCluster` reads from
+    replicas too.
+
+    Args:
+        uri (str): The redis uri.
+        connection_pool (redis.ConnectionPool): Use the given pool instead
+                                                of creating a new one.
+        **kwargs: Extra client options for sentinel and cluster uris,
+                  for example ``max_connections``.
+    """
+    params = _parse_uri(uri)
+    scheme = params['scheme']
+    if scheme in (SENTINEL_SCHEME, CLUSTER_SCHEME):
+        if connection_pool is not None:
+            raise ValueError('%s manages its own connection pools' % scheme)
+        if scheme == SENTINEL_SCHEME:
+            return _make_sentinel_store(params, **kwargs)
+        return _make_cluster_store(params, **kwargs)
+    class_ = _client_class(scheme)
+    if connection_pool is not None:
+        return class_(connection_pool=connection_pool)
     store = class_(
-        host, port, database, password,
+        params['host'], params['port'], params['db'], params['password'],
         socket_timeout=SOCKET_TIMEOUT,
         socket_connect_timeout=SOCKET_CONNECT_TIMEOUT
     )
     return store
+
+
+def make_connection_pool(uri, max_connections=None, timeout=None,
+                         health_check_interval=None):
+    """Create a `BlockingConnectionPool` for the uri.
+
+    Args:
+        uri (str): The redis uri.
+        max_connections (int): Upper bound of connections in the pool.
+        timeout (float): Seconds to wait for a free connection before
+                         raising `redis.ConnectionError`.
+        health_check_interval (int): Seconds an idle connection may stay
+                                     unchecked before a PING is sent.
+
+    Returns:
+        redis.BlockingConnectionPool: The pool.
+    """
+    params = _parse_uri(uri)
+    if max_connections is None:
+        max_connections = MAX_CONNECTIONS
+    if timeout is None:
+        timeout = POOL_TIMEOUT
+    if health_check_interval is None:
+        health_check_interval = HEALTH_CHECK_INTERVAL
+    return redis.BlockingConnectionPool(
+        max_connections=max_connections,
+        timeout=timeout,
+        host=params['host'],
+        port=params['port'],
+        db=params['db'],
+        password=params['password'],
+        socket_timeout=SOCKET_TIMEOUT,
+        socket_connect_timeout=SOCKET_CONNECT_TIMEOUT,
+        health_check_interval=health_check_interval
+    )
+
+
+def get_redis_store(uri, **kwargs):
+    """Return the shared redis instance of the uri.
+
+    All calls with the same normalized uri return the same client, backed by
+    one `BlockingConnectionPool`. Keyword arguments are passed to
+    `make_connection_pool()` and only take effect when the pool is created.
+
+    Sentinel and cluster uris manage their own pools, keyword arguments are
+    passed to `make_redis_store()` for them instead.
+
+    Args:
+        uri (str): The redis uri.
+
+    Returns:
+        redis.StrictRedis: The shared client.
+    """
+    key = normalize_uri(uri)
+    store = _REGISTRY.get(key)
+    if store is not None:
+        return store
+    with _REGISTRY_LOCK:
+        store = _REGISTRY.get(key)
+        if store is None:
+            if key.startswith((SENTINEL_SCHEME, CLUSTER_SCHEME)):
+                store = make_redis_store(key, **kwargs)
+            else:
+                pool = make_connection_pool(key, **kwargs)
+                store = make_redis_store(key, connection_pool=pool)
+            _REGISTRY[key] = store
+    return store
+
+
+def close_all():
+    """Disconnect and forget all shared pools."""
+    with _REGISTRY_LOCK:
+        stores = list(_REGISTRY.values())
+        _REGISTRY.clear()
+    for store in stores:
+        if isinstance(store, RedisCluster):
+            store.close()
+            continue
+        store.connection_pool.disconnect()
+        if isinstance(store, SentinelStore):
+            store.replica.connection_pool.disconnect()
+
+
+def _reset_after_fork():
+    """Drop the pools inherited from the parent process.
+
+    The sockets belong to the parent, so they are just forgotten here rather
+    than closed.
+    """
+    global _REGISTRY_LOCK
+    _REGISTRY_LOCK = threading.Lock()
+    _REGISTRY.clear()
+    _ASYNC_REGISTRY.clear()
+    for cache in list(_NEAR_CACHES):
+        cache._reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _chunked(iterable, size):
+    """Split an iterable into lists of at most `size` items."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BatchStore(object):
+    """Pipelined bulk operations over a redis client.
+
+    Every `*_many()` method accepts any iterable, sends it to redis in
+    pipelines of `chunk_size` commands and returns a generator yielding one
+    result per input item, in input order. Nothing is sent until the
+    generator is consumed.
+    """
+
+    def __init__(self, store, chunk_size=None):
+        """
+        Args:
+            store (redis.StrictRedis): The client, for example the one
+                                       returned by `get_redis_store()`.
+            chunk_size (int): Commands per pipeline, `BATCH_SIZE` if None.
+        """
+        chunk_size = chunk_size or BATCH_SIZE
+        if chunk_size < 1:
+            raise ValueError('chunk_size should be a positive integer')
+        self.store = store
+        self.chunk_size = chunk_size
+
+    def _pipelined(self, items, command):
+        for chunk in _chunked(items, self.chunk_size):
+            pipe = self.store.pipeline(transaction=False)
+            for item in chunk:
+                command(pipe, item)
+            yield from pipe.execute()
+
+    def mget_many(self, keys):
+        """Yield the value of each key, None for missing keys.
+
+        On a cluster each chunk is split by hash slot, so keys need not share
+        a slot.
+        """
+        if isinstance(self.store, RedisCluster):
+            mget = self.store.mget_nonatomic
+        else:
+            mget = self.store.mget
+        for chunk in _chunked(keys, self.chunk_size):
+            yield from mget(chunk)
+
+    def mset_many(self, items, ex=None):
+        """Set many keys, yield the result of each SET.
+
+        Args:
+            items (dict|iterable): A mapping or an iterable of (key, value).
+            ex (int): Expire time in seconds.
+        """
+        if hasattr(items, 'items'):
+            items = items.items()
+        return self._pipelined(
+            items, lambda pipe, item: pipe.set(item[0], item[1], ex=ex))
+
+    def hgetall_many(self, keys):
+        """Yield the hash stored at each key as a dict."""
+        return self._pipelined(keys, lambda pipe, key: pipe.hgetall(key))
+
+    def expire_many(self, keys, seconds):
+        """Set a timeout on each key, yield whether it was set."""
+        return self._pipelined(
+            keys, lambda pipe, key: pipe.expire(key, seconds))
+
+    def delete_many(self, keys):
+        """Delete each key, yield the number of keys removed (0 or 1)."""
+        return self._pipelined(keys, lambda pipe, key: pipe.delete(key))
+
+
+class NearCache(object):
+    """A client-side cache of string keys in front of a redis client.
+
+    Values read by `get()` are kept in a bounded LRU map for at most `ttl`
+    seconds. A daemon thread listens for invalidations: the server pushes
+    them through ``CLIENT TRACKING ... BCAST`` redirected to a pub/sub
+    connection, or, if tracking is unavailable (Redis < 6), writers going
+    through `set()` and `delete()` publish the keys on `channel`.
+
+    Only single-node and sentinel clients are supported.
+    """
+
+    def __init__(self, store, maxsize=None, ttl=None, channel=None,
+                 tracking=True, prefixes=()):
+        """
+        Args:
+            store (redis.StrictRedis): The client to read through.
+            maxsize (int): Number of keys kept, `NEAR_CACHE_SIZE` if None.
+            ttl (float): Seconds a value may be served locally,
+                         `NEAR_CACHE_TTL` if None, 0 for no limit.
+            channel (str): Invalidation channel of the pub/sub fallback.
+            tracking (bool): Try server-assisted tracking first.
+            prefixes (list): Key prefixes to track, all keys if empty.
+        """
+        if isinstance(store, RedisCluster):
+            raise TypeError('NearCache does not support redis cluster')
+        self.store = store
+        self.maxsize = maxsize or NEAR_CACHE_SIZE
+        self.ttl = NEAR_CACHE_TTL if ttl is None else ttl
+        self.channel = channel or NEAR_CACHE_CHANNEL
+        self.tracking = tracking
+        self.prefixes = list(prefixes)
+        self.mode = None
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped on every invalidation, so that a value fetched while its
+        # key was invalidated is not cached
+        self._generation = 0
+        self._pubsub = None
+        self._tracker = None
+        self._thread = None
+        self._running = False
+        self._broken = False
+        self._forked = False
+        _NEAR_CACHES.add(self)
+        self.start()
+
+    def start(self):
+        """Subscribe to invalidations and start the listener thread."""
+        self._subscribe()
+        self._running = True
+        self._thread = threading.Thread(target=self._listen,
+                                        name='NearCache', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop the listener and drop all local values."""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(SOCKET_TIMEOUT)
+            self._thread = None
+        self._unsubscribe()
+        self.clear()
+
+    def _subscribe(self):
+        pubsub = self.store.pubsub(ignore_subscribe_messages=True)
+        channel, mode = self.channel, 'channel'
+        if self.tracking:
+            try:
+                self._tracker = self._enable_tracking(pubsub)
+                channel, mode = TRACKING_CHANNEL, 'tracking'
+            except redis.ResponseError:
+                pass
+        pubsub.subscribe(channel)
+        pubsub.connection.register_connect_callback(self._on_reconnect)
+        self._pubsub = pubsub
+        self.mode = mode
+
+    def _enable_tracking(self, pubsub):
+        """Redirect tracking of a dedicated connection to the pub/sub one."""
+        pubsub.execute_command('CLIENT', 'ID')
+        client_id = pubsub.parse_response(block=True, timeout=SOCKET_TIMEOUT)
+        args = ['CLIENT', 'TRACKING', 'ON', 'REDIRECT', client_id, 'BCAST']
+        for prefix in self.prefixes:
+            args.extend(['PREFIX', prefix])
+        # tracking lasts as long as this connection, keep it out of the pool
+        tracker = self.store.connection_pool.make_connection()
+        try:
+            tracker.send_command(*args)
+            tracker.read_response()
+        except Exception:
+            tracker.disconnect()
+            raise
+        return tracker
+
+    def _unsubscribe(self):
+        if self._pubsub is not None:
+            self._pubsub.close()
+            self._pubsub = None
+        if self._tracker is not None:
+            self._tracker.disconnect()
+            self._tracker = None
+
+    def _on_reconnect(self, connection):
+        # invalidations may have been lost while disconnected, and in
+        # tracking mode the new connection id breaks the redirection
+        self.clear()
+        if self.mode == 'tracking':
+            self._broken = True
+
+    def _listen(self):
+        while self._running:
+            try:
+                if self._broken:
+                    self._broken = False
+                    self._unsubscribe()
+                    self._subscribe()
+                message = self._pubsub.get_message(timeout=1.0)
+            except RedisError:
+                self.clear()
+                self._broken = self.mode == 'tracking'
+                time.sleep(1.0)
+                continue
+            if message is not None and message['type'] == 'message':
+                self._handle_message(message)
+
+    def _handle_message(self, message):
+        data = message['data']
+        if data is None:
+            # FLUSHDB/FLUSHALL
+            self.clear()
+        elif isinstance(data, list):
+            self.invalidate(*data)
+        else:
+            self.invalidate(data)
+
+    def _reset_after_fork(self):
+        # the listener thread does not survive a fork, restart it lazily
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._pubsub = None
+        self._tracker = None
+        self._thread = None
+        self._forked = self._running
+
+    def get(self, key):
+        """Return the value of the key, from the local map if possible."""
+        if self._forked:
+            self._forked = False
+            self.start()
+        key = _key_bytes(key)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if not expires or expires > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            generation = self._generation
+        value = self.store.get(key)
+        with self._lock:
+            if generation == self._generation:
+                self._put(key, value, now)
+        return value
+
+    def _put(self, key, value, now):
+        self._data[key] = (value, now + self.ttl if self.ttl else 0)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def set(self, key, value, **kwargs):
+        """Write through to redis and invalidate the key everywhere."""
+        result = self.store.set(key, value, **kwargs)
+        self._publish(key)
+        return result
+
+    def delete(self, *keys):
+        """Delete keys in redis and invalidate them everywhere."""
+        result = self.store.delete(*keys)
+        self._publish(*keys)
+        return result
+
+    def _publish(self, *keys):
+        self.invalidate(*keys)
+        if self.mode == 'channel':
+            for key in keys:
+                self.store.publish(self.channel, key)
+
+    def invalidate(self, *keys):
+        """Drop keys from the local map."""
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                if self._data.pop(_key_bytes(key), None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        """Drop all local values."""
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def stats(self):
+        """Return hit, miss, eviction and invalidation counters."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'size': len(self._data),
+        }
+
+
+def _key_bytes(key):
+    if isinstance(key, bytes):
+        return key
+    return str(key).encode('utf-8')
+
+
+class AsyncSentinelStore(redis.asyncio.StrictRedis):
+    """The asyncio counterpart of `SentinelStore`."""
+
+    def __init__(self, connection_pool, replica_pool):
+        super(AsyncSentinelStore, self).__init__(
+            connection_pool=connection_pool)
+        self.replica = redis.asyncio.StrictRedis(connection_pool=replica_pool)
+
+    async def execute_command(self, *args, **options):
+        if str(args[0]).upper() in READ_COMMANDS:
+            return await self.replica.execute_command(*args, **options)
+        return await super(AsyncSentinelStore, self).execute_command(
+            *args, **options)
+
+
+def _make_async_store(params, **kwargs):
+    options = {
+        'socket_timeout': SOCKET_TIMEOUT,
+        'socket_connect_timeout': SOCKET_CONNECT_TIMEOUT,
+    }
+    scheme = params['scheme']
+    if scheme == SENTINEL_SCHEME:
+        sentinel = async_sentinel.Sentinel(
+            params['hosts'], sentinel_kwargs=dict(options), **options)
+        kwargs.update(db=params['db'], password=params['password'])
+        master = sentinel.master_for(params['service'], **kwargs)
+        replica = sentinel.slave_for(params['service'], **kwargs)
+        return AsyncSentinelStore(master.connection_pool,
+                                  replica.connection_pool)
+    if scheme == CLUSTER_SCHEME:
+        nodes = [async_cluster.ClusterNode(host, port)
+                 for host, port in params['hosts']]
+        kwargs.setdefault('read_from_replicas', True)
+        return async_cluster.RedisCluster(startup_nodes=nodes,
+                                          password=params['password'],
+                                          **dict(options, **kwargs))
+    max_connections = kwargs.pop('max_connections', MAX_CONNECTIONS)
+    timeout = kwargs.pop('timeout', POOL_TIMEOUT)
+    kwargs.setdefault('health_check_interval', HEALTH_CHECK_INTERVAL)
+    pool = redis.asyncio.BlockingConnectionPool(
+        max_connections=max_connections,
+        timeout=timeout,
+        host=params['host'],
+        port=params['port'],
+        db=params['db'],
+        password=params['password'],
+        **dict(options, **kwargs)
+    )
+    return redis.asyncio.StrictRedis(connection_pool=pool)
+
+
+def make_async_redis_store(uri, **kwargs):
+    """Return the asyncio redis instance of the uri.
+
+    The uri grammar is the one of `make_redis_store()`. Asyncio connections
+    belong to the event loop which opened them, so the client is shared by
+    all callers with the same normalized uri within the running loop.
+    Keyword arguments only take effect when the client is created, they are
+    the ones of `make_connection_pool()` for single-node uris and extra
+    client options for sentinel and cluster uris.
+
+    Args:
+        uri (str): The redis uri.
+
+    Returns:
+        redis.asyncio.StrictRedis: The shared client.
+    """
+    key = normalize_uri(uri)
+    stores = _ASYNC_REGISTRY.setdefault(asyncio.get_running_loop(), {})
+    store = stores.get(key)
+    if store is None:
+        store = _make_async_store(_parse_uri(key), **kwargs)
+        stores[key] = store
+    return store
+
+
+async def async_close_all():
+    """Disconnect and forget the shared clients of the running loop."""
+    stores = _ASYNC_REGISTRY.pop(asyncio.get_running_loop(), {})
+    for store in stores.values():
+        if isinstance(store, async_cluster.RedisCluster):
+            await store.aclose()
+            continue
+        await store.connection_pool.disconnect()
+        if isinstance(store, AsyncSentinelStore):
+            await store.replica.connection_pool.disconnect()
+
+
+class AsyncBatchStore(object):
+    """The asyncio counterpart of `BatchStore`.
+
+    Every `*_many()` method is an asynchronous generator yielding one result
+    per input item, in input order.
+    """
+
+    def __init__(self, store, chunk_size=None):
+        """
+        Args:
+            store (redis.asyncio.StrictRedis): The client, for example the
+                                               one returned by
+                                               `make_async_redis_store()`.
+            chunk_size (int): Commands per pipeline, `BATCH_SIZE` if None.
+        """
+        chunk_size = chunk_size or BATCH_SIZE
+        if chunk_size < 1:
+            raise ValueError('chunk_size should be a positive integer')
+        self.store = store
+        self.chunk_size = chunk_size
+
+    async def _pipelined(self, items, command):
+        for chunk in _chunked(items, self.chunk_size):
+            pipe = self.store.pipeline(transaction=False)
+            for item in chunk:
+                command(pipe, item)
+            for result in await pipe.execute():
+                yield result
+
+    async def mget_many(self, keys):
+        """Yield the value of each key, None for missing keys."""
+        if isinstance(self.store, async_cluster.RedisCluster):
+            mget = self.store.mget_nonatomic
+        else:
+            mget = self.store.mget
+        for chunk in _chunked(keys, self.chunk_size):
+            for value in await mget(chunk):
+                yield value
+
+    def mset_many(self, items, ex=None):
+        """Set many keys, yield the result of each SET."""
+        if hasattr(items, 'items'):
+            items = items.items()
+        return self._pipelined(
+            items, lambda pipe, item: pipe.set(item[0], item[1], ex=ex))
+
+    def hgetall_many(self, keys):
+        """Yield the hash stored at each key as a dict."""
+        return self._pipelined(keys, lambda pipe, key: pipe.hgetall(key))
+
+    def expire_many(self, keys, seconds):
+        """Set a timeout on each key, yield whether it was set."""
+        return self._pipelined(
+            keys, lambda pipe, key: pipe.expire(key, seconds))
+
+    def delete_many(self, keys):
+        """Delete each key, yield the number of keys removed (0 or 1)."""
+        return self._pipelined(keys, lambda pipe, key: pipe.delete(key))
+
+
+def _json_dumps(value):
+    return json.dumps(value, separators=(',', ':'),
+                      ensure_ascii=False).encode('utf-8')
+
+
+def _json_loads(data):
+    return json.loads(data.decode('utf-8'))
+
+
+def _pickle_dumps(value):
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _msgpack_dumps(value):
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def _msgpack_loads(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+# name -> (dumps, loads)
+SERIALIZERS = {
+    'json': (_json_dumps, _json_loads),
+    'pickle': (_pickle_dumps, pickle.loads),
+}
+if msgpack is not None:
+    SERIALIZERS['msgpack'] = (_msgpack_dumps, _msgpack_loads)
+
+# name -> (flag, compress, decompress), the flag is the first byte of every
+# encoded payload
+_PLAIN_FLAG = b'\x00'
+COMPRESSORS = {
+    'zlib': (b'z', zlib.compress, zlib.decompress),
+}
+if lz4 is not None:
+    COMPRESSORS['lz4'] = (b'4', lz4.frame.compress, lz4.frame.decompress)
+
+
+class Codec(object):
+    """Serialize values to bytes stored in redis and back.
+
+    Every payload starts with one flag byte telling whether and how the rest
+    is compressed, so a codec decodes values written with any compression.
+    Pickle should only be used with data written by trusted parties.
+    """
+
+    def __init__(self, serializer='json', compression=None, threshold=None):
+        """
+        Args:
+            serializer (str): A name in `SERIALIZERS`.
+            compression (str|None): A name in `COMPRESSORS`, or None.
+            threshold (int): Payloads larger than this are compressed,
+                             `COMPRESS_THRESHOLD` if None.
+        """
+        if serializer not in SERIALIZERS:
+            raise ValueError('unknown or unavailable serializer: %s'
+                             % serializer)
+        if compression is not None and compression not in COMPRESSORS:
+            raise ValueError('unknown or unavailable compression: %s'
+                             % compression)
+        self.serializer = serializer
+        self.compression = compression
+        self.threshold = COMPRESS_THRESHOLD if threshold is None \
+            else threshold
+        self._dumps, self._loads = SERIALIZERS[serializer]
+        self._decompressors = dict(
+            (flag, decompress) for flag, _, decompress
+            in COMPRESSORS.values())
+
+    def encode(self, value):
+        """Return the payload of the value."""
+        data = self._dumps(value)
+        if self.compression is not None and len(data) > self.threshold:
+            flag, compress, _ = COMPRESSORS[self.compression]
+            return flag + compress(data)
+        return _PLAIN_FLAG + data
+
+    def decode(self, data):
+        """Return the value of the payload, None if the payload is None."""
+        if data is None:
+            return None
+        flag, data = data[:1], data[1:]
+        if flag != _PLAIN_FLAG:
+            decompress = self._decompressors.get(flag)
+            if decompress is None:
+                raise ValueError('unknown payload flag: %r' % flag)
+            data = decompress(data)
+        return self._loads(data)
+
+
+class CodecStore(object):
+    """A redis client reading and writing values through a `Codec`.
+
+    Commands not defined here are passed to the wrapped client untouched.
+    """
+
+    def __init__(self, store, codec=None):
+        """
+        Args:
+            store (redis.StrictRedis): The client to wrap.
+            codec (Codec): The codec, json without compression if None.
+        """
+        self.store = store
+        self.codec = codec or Codec()
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def get(self, key, default=None):
+        """Return the decoded value of the key, `default` if missing."""
+        data = self.store.get(key)
+        if data is None:
+            return default
+        return self.codec.decode(data)
+
+    def set(self, key, value, ex=None, nx=False, xx=False):
+        """Encode and store the value."""
+        return self.store.set(key, self.codec.encode(value),
+                              ex=ex, nx=nx, xx=xx)
+
+    def mget(self, keys):
+        """Return the decoded values of the keys, None for missing ones."""
+        return [self.codec.decode(data) for data in self.store.mget(keys)]
+
+    def mset(self, mapping, ex=None):
+        """Encode and store many values in one round trip."""
+        pipe = self.store.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipe.set(key, self.codec.encode(value), ex=ex)
+        return all(pipe.execute())
+
+    def hget(self, name, key, default=None):
+        """Return the decoded value of a hash field, `default` if missing."""
+        data = self.store.hget(name, key)
+        if data is None:
+            return default
+        return self.codec.decode(data)
+
+    def hset(self, name, key, value):
+        """Encode and store the value in a hash field."""
+        return self.store.hset(name, key, self.codec.encode(value))
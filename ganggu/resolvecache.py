@@ -9,89 +9,769 @@
 默认的，Python 或者 requests 处理 URL 时，并不会缓存域名解释的结果。\
 这个模块提供了一个简单的机制来解决这个问题。
 
-函数 ``hostname_to_ipaddr()`` 用于获取指定主机对应的 IPv4 的地址，\
-这个过程会缓存结果以便在缓存过期之前都可以使用。
+函数 ``resolve()`` 用于获取指定主机对应的地址列表，函数
+``hostname_to_ipaddr()`` 返回其中的第一个地址，这个过程会缓存结果以便在\
+缓存过期之前都可以使用。``aresolve()`` 是 ``resolve()`` 的 asyncio 版本，\
+查询过程不会阻塞事件循环。
+
+实际的查询由解释器完成，可以通过 ``set_resolver()`` 设置：
+
+* ``SystemResolver`` 使用 ``socket.getaddrinfo()``，遵循 ``/etc/hosts``
+  等系统配置，但无法得知记录的 TTL，因此使用 ``DEFAULT_TTL``，这是默认的\
+  解释器；
+* ``DNSResolver`` 使用 dnspython 直接查询 DNS，遵循记录的 TTL。
+
+查询失败的结果也会被缓存 ``NEGATIVE_TTL`` 秒，在此期间对同一主机的查询\
+直接抛出 ``ResolveError``，以免下游域名故障时反复冲击 DNS 服务器。
+
+对同一主机的并发查询会被合并，只有一个调用者真正发起查询。记录过期后的
+``STALE_TTL`` 秒内，调用者立即得到原来的地址，同时在后台刷新记录；刷新失败\
+时继续使用原来的地址，``NEGATIVE_TTL`` 秒后再次刷新，记录过期超过
+``STALE_TTL`` 秒后不再使用。
+
+默认只查询 IPv4 地址，将 ``ADDRESS_FAMILY`` 设置为 ``socket.AF_UNSPEC``
+可以同时得到 IPv6 地址。
 
 更进一步，函数 ``url()`` 会转换指定 URL 的 hostname 部分返回使用
-IPv4 地址形式的 URL。许多时候，我们希望在实际发起请求时才去做这样的转换，
+IP 地址形式的 URL。一个主机有多个地址时，``url()`` 通过 ``select_address()``
+轮流使用这些地址；调用者可以用 ``mark_bad()`` 标记出现故障的地址，在一段\
+时间内尽量避开它。许多时候，我们希望在实际发起请求时才去做这样的转换，
 ``smart_url()`` 可以返回一个 callable，在需要的时候才去执行转换操作。
 
-开发人员可以自行设定缓存机制，它应该是 ``werkzeug.contrib.cache.BaseCache``
-子类的实例。默认的这个模块使用 ``werkzeug.contrib.cache.SimpleCache``。
+开发人员可以通过 ``set_cache_system()`` 自行设定缓存机制，它应该提供
+``get(key)`` 和 ``set(key, value, timeout)`` 方法，例如本模块的
+``BaseCache`` 子类或者 cachelib 中的缓存。默认的这个模块使用进程内的
+``SimpleCache``。使用 prefork 模型的服务（gunicorn、Celery 等）可以使用
+``SharedMemoryCache``，同一台主机上的所有工作进程共享一份缓存。
 
 本模块依赖如下第三方库：
 
-* `Werkzeug <http://werkzeug.pocoo.org/>`_。
+* `dnspython <http://www.dnspython.org/>`_，可选，``DNSResolver`` 需要。
 """
 
+import os
+import json
+import mmap
+import time
+import zlib
+import fcntl
 import socket
+import struct
+import asyncio
+import weakref
+import tempfile
+import contextlib
+import itertools
+import threading
 from urllib.parse import urlparse, urlunparse
 from functools import partial
-from werkzeug.contrib.cache import BaseCache, SimpleCache
 
-__version__ = '1.0.0'
+try:
+    import dns.resolver
+    import dns.asyncresolver
+    import dns.exception
+except ImportError:  # pragma: no cover
+    dns = None
+
+__version__ = '1.4.0'
+
+
+# 无法得知记录的 TTL 时缓存的秒数
+DEFAULT_TTL = 3600
+
+# 记录的 TTL 会被限制在这个范围内
+MIN_TTL = 1
+MAX_TTL = 86400
+
+# 查询失败的结果缓存的秒数
+NEGATIVE_TTL = 30
+
+# 记录过期后，在后台刷新期间仍可使用的秒数
+STALE_TTL = 300
 
+# 等待同一主机正在进行的查询的最长秒数，超过后自己查询
+FLIGHT_TIMEOUT = 10
 
-# 运行时的缓存机制实例
+# 默认查询的地址族，设置为 socket.AF_UNSPEC 可同时得到 IPv4 和 IPv6 地址
+ADDRESS_FAMILY = socket.AF_INET
+
+# ``select_address()`` 默认的选择策略
+ROUND_ROBIN = 'round-robin'
+LEAST_FAILURE = 'least-failure'
+STRATEGY = ROUND_ROBIN
+
+# 被 ``mark_bad()`` 标记的地址在这段时间（秒）内尽量不被选择
+BAD_TTL = 30
+
+
+# 运行时的缓存机制和解释器实例
 RUNTIME = {
-    'CACHE': None
+    'CACHE': None,
+    'RESOLVER': None,
 }
 
 
+class ResolveError(socket.gaierror, RuntimeError):
+    """无法解释主机名。
+
+    同时是 ``socket.gaierror`` 和 ``RuntimeError`` 的子类，以兼容之前的版本。
+    """
+
+
+class SystemResolver(object):
+    """使用 ``socket.getaddrinfo()`` 的解释器，无法得知记录的 TTL。"""
+
+    def resolve(self, hostname, family=socket.AF_INET):
+        """查询主机的地址。
+
+        Args:
+            hostname (str): 主机名称。
+            family (int): 地址族。
+
+        Returns:
+            tuple: 地址列表和 TTL 秒数，TTL 未知时为 None。
+        """
+        result = socket.getaddrinfo(hostname, 0, family, socket.SOCK_STREAM)
+        return _unique(item[-1][0] for item in result), None
+
+    async def aresolve(self, hostname, family=socket.AF_INET):
+        """``resolve()`` 的 asyncio 版本。"""
+        loop = asyncio.get_running_loop()
+        result = await loop.getaddrinfo(hostname, 0, family=family,
+                                        type=socket.SOCK_STREAM)
+        return _unique(item[-1][0] for item in result), None
+
+
+class DNSResolver(object):
+    """使用 dnspython 直接查询 DNS 的解释器，返回记录的 TTL。
+
+    注意：这个解释器不会读取 ``/etc/hosts``。
+    """
+
+    def __init__(self, resolver=None, aresolver=None):
+        """
+        Args:
+            resolver (dns.resolver.Resolver|None): 同步查询使用的实例。
+            aresolver (dns.asyncresolver.Resolver|None): 异步查询使用的实例。
+        """
+        if dns is None:
+            raise RuntimeError('DNSResolver requires dnspython')
+        self.resolver = resolver or dns.resolver.Resolver()
+        self.aresolver = aresolver or dns.asyncresolver.Resolver()
+
+    @staticmethod
+    def _rdtypes(family):
+        if family == socket.AF_INET6:
+            return ['AAAA']
+        if family == socket.AF_UNSPEC:
+            return ['A', 'AAAA']
+        return ['A']
+
+    @staticmethod
+    def _merge(answers, errors):
+        """合并 A 和 AAAA 的查询结果，TTL 取较小者。"""
+        if not answers:
+            raise ResolveError(socket.EAI_NONAME, str(errors[0]))
+        addresses = _unique(rdata.address
+                            for answer in answers for rdata in answer)
+        return addresses, min(answer.rrset.ttl for answer in answers)
+
+    def resolve(self, hostname, family=socket.AF_INET):
+        answers, errors = [], []
+        for rdtype in self._rdtypes(family):
+            try:
+                answers.append(self.resolver.resolve(hostname, rdtype))
+            except dns.exception.DNSException as e:
+                errors.append(e)
+        return self._merge(answers, errors)
+
+    async def aresolve(self, hostname, family=socket.AF_INET):
+        answers, errors = [], []
+        for rdtype in self._rdtypes(family):
+            try:
+                answers.append(await self.aresolver.resolve(hostname, rdtype))
+            except dns.exception.DNSException as e:
+                errors.append(e)
+        return self._merge(answers, errors)
+
+
+def _unique(addresses):
+    """去掉重复的地址并保持顺序。"""
+    result = []
+    for address in addresses:
+        if address not in result:
+            result.append(address)
+    return result
+
+
+class BaseCache(object):
+    """缓存机制的基类，接口与 ``werkzeug.contrib.cache.BaseCache`` 相同。
+
+    ``timeout`` 为 None 时使用 ``default_timeout``，为 0 时表示不过期。
+    """
+
+    def __init__(self, default_timeout=300):
+        self.default_timeout = default_timeout
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return time.time() + timeout if timeout else 0
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout=None):
+        return True
+
+    def delete(self, key):
+        return True
+
+    def clear(self):
+        return True
+
+
+class SimpleCache(BaseCache):
+    """进程内的缓存，超过 ``threshold`` 个键时清理过期和最早的键。"""
+
+    def __init__(self, threshold=500, default_timeout=300):
+        super(SimpleCache, self).__init__(default_timeout)
+        self.threshold = threshold
+        self._cache = {}
+
+    def _prune(self):
+        now = time.time()
+        for key, (expires, _) in list(self._cache.items()):
+            if expires and expires <= now:
+                self._cache.pop(key, None)
+        # 字典保持插入顺序，最早写入的键在前面
+        while len(self._cache) >= self.threshold:
+            self._cache.pop(next(iter(self._cache)), None)
+
+    def get(self, key):
+        item = self._cache.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires and expires <= time.time():
+            self._cache.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        if key not in self._cache and len(self._cache) >= self.threshold:
+            self._prune()
+        self._cache.pop(key, None)
+        self._cache[key] = (self._expires(timeout), value)
+        return True
+
+    def delete(self, key):
+        return self._cache.pop(key, None) is not None
+
+    def clear(self):
+        self._cache.clear()
+        return True
+
+
+class SharedMemoryCache(BaseCache):
+    """保存在共享内存（mmap）中的缓存，可被多个进程同时使用。
+
+    缓存是一个固定大小的开放寻址哈希表，每个键最多探测 ``PROBES`` 个槽位，
+    没有空位时覆盖其中最早过期的一个。每个槽位带有一个顺序锁（seqlock）
+    计数器：写入者在进程间的文件锁保护下先将计数器加一（奇数表示正在写入），
+    写完后再加一；读取者不加锁，若读取前后计数器不同或为奇数则重读，重读
+    ``READ_RETRIES`` 次仍未成功（例如写入者在写入过程中退出）时视为未命中，
+    下一次写入会修复这个槽位。
+
+    值使用 JSON 序列化，键和序列化后的值总长度不能超过槽位的容量，过长的值
+    不会被缓存。
+
+    ``path`` 为 None 时使用一个匿名的临时文件，只有在创建缓存之后 fork
+    出的子进程可以共享，例如 gunicorn 的 ``preload_app`` 模式。指定
+    ``path``（例如 ``/dev/shm/myapp-dns``）时，无关的进程也可以共享。
+    """
+
+    MAGIC = b'GGDNS001'
+    PROBES = 8
+    READ_RETRIES = 100
+    # 文件头：magic、槽位数、槽位大小
+    _HEADER = struct.Struct('<8sII')
+    # 槽位头：seqlock 计数器、过期时刻、键长度、值长度
+    _SLOT = struct.Struct('<IdHH')
+
+    def __init__(self, path=None, slots=4096, slot_size=512,
+                 default_timeout=300):
+        """
+        Args:
+            path (str|None): 共享内存文件的路径。
+            slots (int): 槽位数。
+            slot_size (int): 每个槽位的字节数。
+            default_timeout (int): 默认的缓存秒数。
+        """
+        super(SharedMemoryCache, self).__init__(default_timeout)
+        if slot_size <= self._SLOT.size:
+            raise ValueError('slot_size is too small')
+        self.slots = slots
+        self.slot_size = slot_size
+        self._lock = threading.Lock()
+        size = self._HEADER.size + slots * slot_size
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='ganggu-resolvecache-')
+            os.unlink(path)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._fd = fd
+        with self._locked():
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, size)
+                self._mmap = mmap.mmap(fd, size)
+                self._mmap[:self._HEADER.size] = self._HEADER.pack(
+                    self.MAGIC, slots, slot_size)
+            else:
+                self._mmap = mmap.mmap(fd, size)
+                magic, slots_, slot_size_ = self._HEADER.unpack_from(
+                    self._mmap)
+                if (magic, slots_, slot_size_) != (self.MAGIC, slots,
+                                                   slot_size):
+                    raise ValueError('%s has incompatible layout' % path)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """进程内用线程锁，进程间用 POSIX 记录锁。"""
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _offsets(self, key):
+        # Python 的 hash() 在每个进程中不同，这里需要稳定的哈希
+        start = zlib.crc32(key) % self.slots
+        for i in range(min(self.PROBES, self.slots)):
+            yield self._HEADER.size + \
+                ((start + i) % self.slots) * self.slot_size
+
+    def _read(self, offset):
+        """无锁地读取一个槽位，返回 (过期时刻, 键, 值)。"""
+        mm = self._mmap
+        for _ in range(self.READ_RETRIES):
+            seq, expires, key_len, value_len = self._SLOT.unpack_from(
+                mm, offset)
+            if seq & 1:
+                time.sleep(0)
+                continue
+            start = offset + self._SLOT.size
+            data = mm[start:start + key_len + value_len]
+            if self._SLOT.unpack_from(mm, offset)[0] == seq:
+                return expires, data[:key_len], data[key_len:]
+        return 0, b'', b''
+
+    def get(self, key):
+        key = key.encode('utf-8')
+        now = time.time()
+        for offset in self._offsets(key):
+            expires, key_, value = self._read(offset)
+            if key_ == key:
+                if expires and expires <= now:
+                    return None
+                return json.loads(value.decode('utf-8'))
+        return None
+
+    def _write(self, offset, expires, key, value):
+        mm = self._mmap
+        seq = self._SLOT.unpack_from(mm, offset)[0]
+        # 计数器已经是奇数时，说明上一个写入者没有写完，保持奇数即可
+        seq = seq if seq & 1 else (seq + 1) & 0xffffffff
+        struct.pack_into('<I', mm, offset, seq)
+        start = offset + self._SLOT.size
+        mm[start:start + len(key) + len(value)] = key + value
+        self._SLOT.pack_into(mm, offset, seq, expires,
+                             len(key), len(value))
+        struct.pack_into('<I', mm, offset, (seq + 1) & 0xffffffff)
+
+    def set(self, key, value, timeout=None):
+        key = key.encode('utf-8')
+        value = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        if self._SLOT.size + len(key) + len(value) > self.slot_size:
+            return False
+        expires = self._expires(timeout)
+        now = time.time()
+        with self._locked():
+            # 先在所有探测位置中查找这个键，避免同一个键出现在两个槽位中
+            victim, victim_rank = None, None
+            for offset in self._offsets(key):
+                expires_, key_len = struct.unpack_from(
+                    '<dH', self._mmap, offset + 4)
+                start = offset + self._SLOT.size
+                if key_len and self._mmap[start:start + key_len] == key:
+                    victim = offset
+                    break
+                # 空位和已过期的槽位最先被使用，永不过期的槽位最后才被覆盖
+                if key_len == 0 or (expires_ and expires_ <= now):
+                    rank = float('-inf')
+                else:
+                    rank = expires_ or float('inf')
+                if victim_rank is None or rank < victim_rank:
+                    victim, victim_rank = offset, rank
+            self._write(victim, expires, key, value)
+        return True
+
+    def delete(self, key):
+        key = key.encode('utf-8')
+        with self._locked():
+            for offset in self._offsets(key):
+                key_len = struct.unpack_from('<H', self._mmap, offset + 12)[0]
+                start = offset + self._SLOT.size
+                if key_len and self._mmap[start:start + key_len] == key:
+                    self._write(offset, 0, b'', b'')
+                    return True
+        return False
+
+    def clear(self):
+        with self._locked():
+            for i in range(self.slots):
+                offset = self._HEADER.size + i * self.slot_size
+                if struct.unpack_from('<H', self._mmap, offset + 12)[0]:
+                    self._write(offset, 0, b'', b'')
+        return True
+
+    def close(self):
+        """解除映射并关闭文件，之后不能再使用这个实例。"""
+        self._mmap.close()
+        os.close(self._fd)
+
+
 def set_cache_system(cache=None):
     """设置缓存机制实例。
 
     Args:
-        cache (werkzeug.contrib.cache.BaseCache): 缓存系统。
+        cache (BaseCache|None): 缓存系统，需要提供 ``get()`` 和 ``set()``
+                                方法，None 表示使用新的 ``SimpleCache``。
     """
-    if not isinstance(cache, BaseCache):
-        raise TypeError('first argument should be an instance of'
-                        ' werkzeug.contrib.cache.BaseCache or None')
+    if cache is None:
+        cache = SimpleCache(default_timeout=DEFAULT_TTL)
+    if not callable(getattr(cache, 'get', None)) or \
+            not callable(getattr(cache, 'set', None)):
+        raise TypeError('first argument should provide get() and set()'
+                        ' methods, like an instance of BaseCache')
     RUNTIME['CACHE'] = cache
 
 
-# 设置默认的缓存机制实例
-set_cache_system(SimpleCache(default_timeout=3600))
+def set_resolver(resolver=None):
+    """设置解释器实例。
 
+    Args:
+        resolver (SystemResolver|DNSResolver|None): 解释器，应该提供
+            ``resolve()`` 和 ``aresolve()`` 方法，None 表示使用
+            ``SystemResolver``。
+    """
+    RUNTIME['RESOLVER'] = resolver or SystemResolver()
+
+
+# 设置默认的缓存机制和解释器实例
+set_cache_system()
+set_resolver()
+
+
+# 缓存中的记录是一个三元组：(地址列表, 过期时刻, 错误信息)，过期时刻为 0
+# 表示永不过期，错误信息不为 None 时表示查询失败。成功的记录过期后仍会在缓存
+# 中保留 ``STALE_TTL`` 秒，以便在后台刷新时继续使用
+FRESH, STALE, EXPIRED = 'fresh', 'stale', 'expired'
+
+
+def _cache_key(hostname, family=socket.AF_INET):
+    if family == socket.AF_INET6:
+        return 'resolve6:' + hostname
+    if family == socket.AF_UNSPEC:
+        return 'resolve*:' + hostname
+    return 'resolve:' + hostname
+
+
+def _freshness(entry):
+    if entry is None:
+        return EXPIRED
+    addresses, expires, error = entry
+    now = time.time()
+    if not expires or expires > now:
+        return FRESH
+    if error is None and expires + STALE_TTL > now:
+        return STALE
+    return EXPIRED
+
+
+def _set_entry(key, addresses, ttl, timeout, error=None):
+    """保存记录，``timeout`` 不为 None 时优先于记录的 TTL。"""
+    if error is not None:
+        ttl = NEGATIVE_TTL
+    elif timeout is not None:
+        ttl = timeout
+    elif ttl is None:
+        ttl = DEFAULT_TTL
+    else:
+        ttl = min(max(ttl, MIN_TTL), MAX_TTL)
+    expires = time.time() + ttl if ttl else 0
+    entry = (tuple(addresses), expires, error)
+    if ttl and error is None:
+        RUNTIME['CACHE'].set(key, entry, ttl + STALE_TTL)
+    else:
+        RUNTIME['CACHE'].set(key, entry, ttl)
+    return entry
 
-def hostname_to_ipaddr(hostname, timeout=None):
-    """返回 hostname 对应的 IPv4 的地址。结果将被缓存。
+
+def _addresses(hostname, entry):
+    addresses, _, error = entry
+    if error is not None:
+        raise ResolveError(socket.EAI_NONAME,
+                           'cannot resolve %s: %s' % (hostname, error))
+    return list(addresses)
+
+
+def _store_result(key, result, timeout, stale=None):
+    """根据查询结果或异常保存记录。
+
+    刷新过期记录失败时，原来的记录保持不变，``NEGATIVE_TTL`` 秒内不再刷新。
+    """
+    failed = isinstance(result, BaseException) or not result[0]
+    if failed and stale is not None:
+        _REFRESH_FAILURES[key] = time.time()
+        return stale
+    _REFRESH_FAILURES.pop(key, None)
+    if isinstance(result, BaseException):
+        return _set_entry(key, (), None, timeout, str(result) or 'error')
+    addresses, ttl = result
+    if not addresses:
+        return _set_entry(key, (), None, timeout, 'no address')
+    return _set_entry(key, addresses, ttl, timeout)
+
+
+class _Flight(object):
+    """一次正在进行的查询，同一主机的其它调用者等待它的结果。"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.entry = None
+
+
+# 缓存键 -> 正在进行的查询
+_FLIGHTS = {}
+_FLIGHTS_LOCK = threading.Lock()
+
+# 缓存键 -> 最近一次刷新过期记录失败的时刻
+_REFRESH_FAILURES = {}
+
+# 事件循环 -> {缓存键 -> 正在进行查询的 asyncio.Task}
+_AFLIGHTS = weakref.WeakKeyDictionary()
+
+
+def _lookup(hostname, family, key, timeout, stale=None):
+    try:
+        result = RUNTIME['RESOLVER'].resolve(hostname, family)
+    except (OSError, UnicodeError) as e:
+        result = e
+    return _store_result(key, result, timeout, stale)
+
+
+def _fly(flight, hostname, family, key, timeout, stale):
+    try:
+        flight.entry = _lookup(hostname, family, key, timeout, stale)
+    finally:
+        with _FLIGHTS_LOCK:
+            del _FLIGHTS[key]
+        flight.event.set()
+    return flight.entry
+
+
+def _single_flight(hostname, family, key, timeout, stale=None):
+    """合并对同一主机的并发查询，只有一个调用者真正发起查询。
+
+    ``stale`` 不为 None 时在后台线程中刷新并立即返回 None。
+    """
+    with _FLIGHTS_LOCK:
+        flight = _FLIGHTS.get(key)
+        leader = flight is None
+        if leader:
+            flight = _FLIGHTS[key] = _Flight()
+    if stale is not None:
+        if leader:
+            threading.Thread(target=_fly, name='resolve:' + hostname,
+                             args=(flight, hostname, family, key, timeout,
+                                   stale),
+                             daemon=True).start()
+        return None
+    if leader:
+        return _fly(flight, hostname, family, key, timeout, stale)
+    if not flight.event.wait(FLIGHT_TIMEOUT) or flight.entry is None:
+        # 查询者太慢或者遇到了意外的异常，自己再试一次
+        return _lookup(hostname, family, key, timeout)
+    return flight.entry
+
+
+def _should_refresh(key):
+    """刷新失败后的 ``NEGATIVE_TTL`` 秒内不再刷新过期的记录。"""
+    return _REFRESH_FAILURES.get(key, 0) + NEGATIVE_TTL <= time.time()
+
+
+def resolve(hostname, timeout=None, family=None):
+    """返回 hostname 对应的地址列表。结果将被缓存。
+
+    同一主机同时只有一个查询，其它线程等待它的结果。记录过期后的
+    ``STALE_TTL`` 秒内，立即返回原来的地址并在后台刷新。
 
     Args:
         hostname (str): 主机名称。
-        timeout (int|None): 如果为 None 则缓存本模块默认配置的时间。否则缓存
-                            指定的秒数。特别的，如果为 0 表示缓存不过期。
+        timeout (int|None): 如果为 None 则使用记录的 TTL，TTL 未知时缓存
+                            ``DEFAULT_TTL`` 秒。否则缓存指定的秒数。特别的，
+                            如果为 0 表示缓存不过期。
+        family (int|None): 地址族，None 表示使用 ``ADDRESS_FAMILY``。
 
     Returns:
-        str: IPv4 地址的字符串形式。
+        list: 地址字符串的列表。
+
+    Raises:
+        ResolveError: 无法解释主机名（包括缓存的失败结果）。
     """
     hostname = str(hostname).strip()
-    key = 'resolve:'+hostname
-    cache = RUNTIME['CACHE']
-    ipaddr = cache.get(key)
-    if ipaddr is not None:
-        return ipaddr
-    result = socket.getaddrinfo(hostname, 0, socket.AF_INET, socket.SOCK_STREAM)
-    if not result:
-        raise RuntimeError('cannot getaddrinfo for %s' % hostname)
-    ipaddr = result[0][-1][0]
-    cache.set(key, ipaddr, timeout)
-    return ipaddr
-
-
-def url(url_):
-    """替换 URL 中 hostname 部分为 IPv4 地址。
+    family = ADDRESS_FAMILY if family is None else family
+    key = _cache_key(hostname, family)
+    entry = RUNTIME['CACHE'].get(key)
+    freshness = _freshness(entry)
+    if freshness == STALE:
+        if _should_refresh(key):
+            _single_flight(hostname, family, key, timeout, stale=entry)
+    elif freshness == EXPIRED:
+        entry = _single_flight(hostname, family, key, timeout)
+    return _addresses(hostname, entry)
+
+
+async def _alookup(hostname, family, key, timeout, stale=None):
+    try:
+        result = await RUNTIME['RESOLVER'].aresolve(hostname, family)
+    except (OSError, UnicodeError) as e:
+        result = e
+    return _store_result(key, result, timeout, stale)
+
+
+def _asingle_flight(hostname, family, key, timeout, stale=None):
+    """``_single_flight()`` 的 asyncio 版本，返回查询的 Task。"""
+    flights = _AFLIGHTS.setdefault(asyncio.get_running_loop(), {})
+    task = flights.get(key)
+    if task is None:
+        task = asyncio.ensure_future(
+            _alookup(hostname, family, key, timeout, stale))
+        flights[key] = task
+        task.add_done_callback(lambda _: flights.pop(key, None))
+    return task
+
+
+async def aresolve(hostname, timeout=None, family=None):
+    """``resolve()`` 的 asyncio 版本，查询过程不会阻塞事件循环。"""
+    hostname = str(hostname).strip()
+    family = ADDRESS_FAMILY if family is None else family
+    key = _cache_key(hostname, family)
+    entry = RUNTIME['CACHE'].get(key)
+    freshness = _freshness(entry)
+    if freshness == STALE:
+        if _should_refresh(key):
+            _asingle_flight(hostname, family, key, timeout, stale=entry)
+    elif freshness == EXPIRED:
+        # shield: 一个等待者被取消不应该影响其它等待者
+        entry = await asyncio.shield(
+            _asingle_flight(hostname, family, key, timeout))
+    return _addresses(hostname, entry)
+
+
+def hostname_to_ipaddr(hostname, timeout=None):
+    """返回 hostname 对应的第一个地址。结果将被缓存。
+
+    Args:
+        hostname (str): 主机名称。
+        timeout (int|None): 参见 ``resolve()``。
+
+    Returns:
+        str: 地址的字符串形式。
+    """
+    return resolve(hostname, timeout)[0]
+
+
+# 主机名 -> 轮询计数器
+_COUNTERS = {}
+
+# 地址 -> 最近一次被标记为故障的时刻
+_FAILURES = {}
+
+
+def mark_bad(address):
+    """标记一个地址出现了故障。
+
+    在 ``BAD_TTL`` 秒内 ``select_address()`` 会尽量避开这个地址。
+
+    Args:
+        address (str): 地址，通常来自 ``select_address()`` 或 ``url()``。
+    """
+    now = time.time()
+    # 顺便清理超过 ``BAD_TTL`` 的标记，避免 ``_FAILURES`` 无限增长
+    threshold = now - BAD_TTL
+    for other, marked in list(_FAILURES.items()):
+        if marked <= threshold:
+            _FAILURES.pop(other, None)
+    _FAILURES[address] = now
+
+
+def mark_good(address):
+    """清除一个地址的故障标记。"""
+    _FAILURES.pop(address, None)
+
+
+def select_address(hostname, strategy=None, family=None):
+    """从 hostname 对应的地址中选择一个。
+
+    两种策略都优先选择 ``BAD_TTL`` 秒内未被标记故障的地址：
+
+    * ``ROUND_ROBIN``：在健康的地址中轮询，都不健康时在全部地址中轮询；
+    * ``LEAST_FAILURE``：在健康的地址中轮询，都不健康时选择最早出现故障的\
+      地址。
+
+    Args:
+        hostname (str): 主机名称。
+        strategy (str|None): 选择策略，None 表示使用 ``STRATEGY``。
+        family (int|None): 地址族，参见 ``resolve()``。
+
+    Returns:
+        str: 地址的字符串形式。
+    """
+    addresses = resolve(hostname, family=family)
+    strategy = strategy or STRATEGY
+    if strategy not in (ROUND_ROBIN, LEAST_FAILURE):
+        raise ValueError('unknown strategy: %s' % strategy)
+    if len(addresses) == 1:
+        return addresses[0]
+    counter = _COUNTERS.get(hostname)
+    if counter is None:
+        counter = _COUNTERS.setdefault(hostname, itertools.count())
+    if _FAILURES:
+        threshold = time.time() - BAD_TTL
+        healthy = [address for address in addresses
+                   if _FAILURES.get(address, 0) <= threshold]
+        if healthy:
+            addresses = healthy
+        elif strategy == LEAST_FAILURE:
+            return min(addresses,
+                       key=lambda address: _FAILURES.get(address, 0))
+    return addresses[next(counter) % len(addresses)]
+
+
+def replace_host(url_, address):
+    """替换 URL 中 hostname 部分为指定的地址。
 
     Args:
         url_ (str): URL。
+        address (str): IPv4 或 IPv6 地址。
 
     Returns:
         str: URL。
     """
     parsed = urlparse(url_)
-    if not parsed.hostname:
-        raise ValueError('not hostname in the url')
-    ipaddr = hostname_to_ipaddr(parsed.hostname)
     netloc = ''
     if parsed.username:
         netloc += parsed.username
@@ -99,20 +779,58 @@ def url(url_):
         netloc += ':' + parsed.password
     if parsed.username or parsed.password:
         netloc += '@'
-    netloc += ipaddr
+    if ':' in address:
+        netloc += '[%s]' % address
+    else:
+        netloc += address
     if parsed.port:
         netloc += ':' + str(parsed.port)
     return urlunparse((parsed.scheme, netloc, parsed.path,
                        parsed.params, parsed.query, parsed.fragment))
 
 
-def smart_url(url_):
+def url(url_, strategy=None, family=None):
+    """替换 URL 中 hostname 部分为地址。
+
+    每次调用都通过 ``select_address()`` 选择地址，因此多个地址会被轮流使用。
+
+    Args:
+        url_ (str): URL。
+        strategy (str|None): 地址的选择策略，参见 ``select_address()``。
+        family (int|None): 地址族，例如 ``socket.AF_INET6`` 或
+                           ``socket.AF_UNSPEC``，None 表示使用
+                           ``ADDRESS_FAMILY``。
+
+    Returns:
+        str: URL。
+    """
+    parsed = urlparse(url_)
+    if not parsed.hostname:
+        raise ValueError('not hostname in the url')
+    address = select_address(parsed.hostname, strategy, family)
+    return replace_host(url_, address)
+
+
+def smart_url(url_, strategy=None, family=None):
     """返回延时执行 ``url()`` 函数的函数。
 
     Args:
         url_: 要延时处理的 URL。
+        strategy (str|None): 地址的选择策略，参见 ``select_address()``。
+        family (int|None): 地址族，参见 ``url()``。
 
     Returns:
-        callable: 执行这个 callable 将会调用 ``url(url_)``。
+        callable: 执行这个 callable 将会调用 ``url(url_, strategy, family)``。
     """
-    return partial(url, url_)
+    return partial(url, url_, strategy, family)
+
+
+def _reset_after_fork():
+    # 父进程中正在进行的查询不会在子进程中完成，锁也可能被复制为持有状态
+    global _FLIGHTS_LOCK
+    _FLIGHTS_LOCK = threading.Lock()
+    _FLIGHTS.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -64,10 +64,8 @@ setup(
         #'Programming Language :: Python :: 2.6',
         #'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        #'Programming Language :: Python :: 3.2',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.9',
     ],
 
     # What does your project relate to?
@@ -77,6 +75,9 @@ setup(
     # simple. Or you can use find_packages().
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
 
+    # contextvars, os.register_at_fork and positional-only parameters
+    python_requires='>=3.9',
+
     # Alternatively, if you want to distribute just a my_module.py, uncomment
     # this:
     #   py_modules=["my_module"],
@@ -86,6 +87,12 @@ setup(
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=[
+        'requests',
+        'aiohttp',
+        'redis>=4.2',  # redis.asyncio
+        'coloredlogs',
+        'pytz',
+        'tzlocal',
     ],
 
     # List additional groups of dependencies here (e.g. development
@@ -93,6 +100,14 @@ setup(
     # for example:
     # $ pip install -e .[dev,test]
     extras_require={
+        'msgpack': ['msgpack'],
+        'lz4': ['lz4'],
+        'orjson': ['orjson'],
+        'dns': ['dnspython'],
+        'flask': ['Flask', 'Flask-WTF', 'WTForms'],
+        'rdbms': ['SQLAlchemy'],
+        'celery': ['celery>=4.0.0rc4'],
+        'cipher': ['pycrypto'],
     #    'dev': ['check-manifest'],
     #    'test': ['coverage'],
     },
@@ -4,8 +4,19 @@
 
 from ganggu import httpkit as http
 from ganggu.resolvecache import smart_url
+from ganggu.httpkit import policy, cache, hedge, timing
+from ganggu import resolvecache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import io
+import os
+import threading
+import asyncio
+import time
 import requests
 import json
+import pickle
+import hashlib
+from email.utils import formatdate
 import pytest
 
 
@@ -65,3 +76,388 @@ def test_callable_url():
     resp1 = http.get(url1)
     resp2 = http.get(url2)
     assert resp1.text == resp2.text
+
+
+class LocalHandler(BaseHTTPRequestHandler):
+    """本地测试服务器，记录每个请求使用的客户端端口。"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.do_GET()
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.uploaded = body
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_file(self):
+        # 支持 Range 请求的文件
+        payload = self.server.payload
+        start = 0
+        self.server.ranges.append(self.headers.get('Range'))
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'][6:].rstrip('-'))
+            if start >= len(payload):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, len(payload) - 1, len(payload)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(payload) - start))
+        self.end_headers()
+        self.wfile.write(payload[start:])
+
+    def do_GET(self):
+        if self.path == '/file':
+            return self.send_file()
+        self.server.ports.append(self.client_address[1])
+        if self.path.startswith('/delay/'):
+            time.sleep(float(self.path.split('/')[2]))
+        if self.path.startswith('/slow/') and \
+                self.connection.getsockname()[0] == '127.0.0.1':
+            time.sleep(float(self.path.split('/')[2]))
+        status = 200
+        if self.path.startswith('/status/'):
+            status = int(self.path.split('/')[2])
+        if self.path.startswith('/cache/'):
+            return self.send_cacheable()
+        body = json.dumps({'path': self.path,
+                           'cookie': self.headers.get('Cookie')}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Set-Cookie', 'session=secret; Path=/')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def send_cacheable(self):
+        # /cache/<max-age>，ETag 为 "v1"
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            body = b''
+        else:
+            self.send_response(200)
+            body = json.dumps({'path': self.path}).encode()
+        self.send_header('Cache-Control',
+                         'max-age=%s' % self.path.split('/')[2])
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('0.0.0.0', 0), LocalHandler)
+    httpd.ports = []
+    httpd.ranges = []
+    httpd.payload = bytes(range(256)) * 4096
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_shared_session(server):
+    http.close_all()
+    for i in range(5):
+        resp = http.get(server.url + '/%d' % i)
+        assert resp.json()['path'] == '/%d' % i
+        assert resp.json()['cookie'] is None, '共享的 Session 不应保存 cookies'
+    assert len(set(server.ports)) == 1, '应该复用同一个连接'
+    session = http.shared_session()
+    assert session is http.shared_session()
+    http.set_pool_size(server.url, 3)
+    adapter = session.get_adapter(server.url + '/')
+    assert adapter._pool_maxsize == 3
+    http.get(server.url)
+    assert len(adapter.poolmanager.pools) == 1
+    http.set_pool_size(server.url, 4)
+    assert len(adapter.poolmanager.pools) == 0, '被替换的适配器应该关闭连接池'
+    http._reset_after_fork()
+    assert http.shared_session() is not session
+    http.close_all()
+    http.get(server.url)
+    assert len(set(server.ports)) == 3, 'close_all() 之后应该使用新的连接'
+    http.HOST_POOLS.clear()
+    http.close_all()
+
+
+def test_aio(server):
+    aiohttp = pytest.importorskip('aiohttp')
+    from ganggu.httpkit import aio
+
+    async def main():
+        url = server.url + '/aio'
+        responses = await asyncio.gather(
+            *[aio.get(url, params={'i': i}) for i in range(5)])
+        results = [await resp.json() for resp in responses]
+        resp = await aio.get(lambda: url, timeout=(1.0, 2.0))
+        agent = resp.request_info.headers['User-Agent']
+        assert aio.session() is aio.session()
+        await aio.close_all()
+        return results, agent
+
+    results, agent = asyncio.run(main())
+    assert [r['path'] for r in results] == ['/aio?i=%d' % i for i in range(5)]
+    assert all(r['cookie'] is None for r in results)
+    assert agent == requests.utils.default_user_agent()
+    assert len(set(server.ports)) <= aio.LIMIT_PER_HOST
+
+
+def test_gather(server):
+    url = server.url
+    specs = [
+        {'url': url + '/a'},
+        ('GET', url + '/b', {'params': {'x': 1}}),
+        {'url': 'http://127.0.0.1:1/refused'},
+        {'method': 'GET', 'url': smart_url(url + '/c')},
+    ]
+    results = http.gather(specs, max_workers=4, per_host_limit=2)
+    assert [r.json()['path'] for r in results[:2]] == ['/a', '/b?x=1']
+    assert isinstance(results[2], requests.ConnectionError), '错误应该被捕获'
+    assert results[3].json()['path'] == '/c'
+    started = time.monotonic()
+    specs = [{'url': url + '/delay/0'}] + \
+        [{'url': url + '/delay/2'} for _ in range(3)]
+    results = http.gather(specs, deadline=0.5, per_host_limit=2)
+    assert time.monotonic() - started < 1.5, '超过期限时应该立即返回'
+    assert results[0].status_code == 200
+    assert all(isinstance(r, http.DeadlineExceeded) for r in results[1:])
+    assert http.gather([]) == []
+    http.close_all()
+    del server.ports[:]
+    for _ in range(2):
+        http.gather([{'url': url + '/delay/0.1'}
+                     for _ in range(http.GATHER_WORKERS)])
+    assert len(set(server.ports)) == http.GATHER_WORKERS, \
+        '默认的 gather() 打开的连接应该都被连接池保存'
+
+
+def test_policy(server):
+    retry = policy.Retry(total=2, backoff=0.01, budget_min=2)
+    breaker = policy.Breaker(error_rate=0.5, min_requests=5,
+                             reset_timeout=0.2)
+    session = http.Session(policy=policy.Policy(retry, breaker))
+    resp = session.get(server.url + '/status/503')
+    assert resp.status_code == 503 and len(server.ports) == 3, '应该重试两次'
+    del server.ports[:]
+    resp = session.post(server.url + '/status/503')
+    assert len(server.ports) == 1, 'POST 不是幂等的，不应重试'
+    del server.ports[:]
+    session.post(server.url + '/status/503',
+                 headers={'Idempotency-Key': 'k1'})
+    assert len(server.ports) == 1, '重试预算已经耗尽'
+    with pytest.raises(policy.CircuitOpenError):
+        session.get(server.url + '/status/200')
+    assert breaker.state(server.url[7:]) == policy.OPEN
+    time.sleep(0.25)
+    assert session.get(server.url + '/ok').status_code == 200
+    assert breaker.state(server.url[7:]) == policy.CLOSED
+    refused = http.Session(policy=policy.Policy(
+        policy.Retry(total=1, backoff=0), False))
+    started = time.monotonic()
+    with pytest.raises(requests.ConnectionError):
+        refused.post('http://127.0.0.1:1/')
+    assert time.monotonic() - started < 1
+    probe = policy.Policy(False, policy.Breaker(min_requests=1,
+                                                reset_timeout=0))
+
+    def broken():
+        raise ValueError('not a request error')
+
+    probe.send('GET', server.url,
+               lambda: http.get(server.url + '/status/503'))
+    with pytest.raises(ValueError):
+        probe.send('GET', server.url, broken)
+    assert probe.send('GET', server.url, lambda: http.get(server.url)) \
+        .status_code == 200, '探测请求抛出其它异常后熔断器不应卡在半开状态'
+    retry = policy.Retry(max_backoff=100)
+    assert retry.is_idempotent('POST', {'idempotency-key': 'k2'}), \
+        '头的名称不区分大小写'
+    keyed = http.Session(policy=policy.Policy(
+        policy.Retry(total=1, backoff=0), False))
+    keyed.headers['idempotency-key'] = 'k3'
+    del server.ports[:]
+    keyed.post(server.url + '/status/503')
+    assert len(server.ports) == 2, '应该使用 Session 的头判断是否幂等'
+    resp = requests.Response()
+    resp.headers['Retry-After'] = formatdate(time.time() + 30, usegmt=True)
+    assert 28 < retry.sleep_time(1, resp) <= 30, '应该支持 HTTP 日期'
+    resp.headers['Retry-After'] = 'Wed, 21 Oct 2015 07:28:00 GMT'
+    assert retry.sleep_time(1, resp) == 0
+    resp.headers['Retry-After'] = 'soon'
+    assert retry.sleep_time(1, resp) <= retry.backoff
+
+
+@pytest.mark.parametrize('storage', ['memory', 'file', 'redis'])
+def test_cache(server, storage, tmp_path):
+    if storage == 'file':
+        storage = cache.FileStorage(str(tmp_path))
+    elif storage == 'redis':
+        fakeredis = pytest.importorskip('fakeredis')
+        storage = cache.RedisStorage(fakeredis.FakeStrictRedis())
+    else:
+        storage = cache.MemoryStorage(maxsize=4)
+    session = http.Session(cache=cache.HTTPCache(storage))
+    resp = session.get(server.url + '/cache/60')
+    assert not getattr(resp, 'from_cache', False)
+    resp = session.get(server.url + '/cache/60')
+    assert resp.from_cache and resp.json()['path'] == '/cache/60'
+    assert len(server.ports) == 1, '新鲜的响应不应发送请求'
+    # 过期的响应通过条件请求重新验证
+    session.get(server.url + '/cache/0', params={'a': 1})
+    resp = session.get(server.url + '/cache/0', params={'a': 1})
+    assert resp.from_cache and resp.status_code == 200
+    assert resp.json()['path'] == '/cache/0?a=1'
+    assert len(server.ports) == 3
+    session.get(server.url + '/cache/60',
+                headers={'Cache-Control': 'no-cache'})
+    assert len(server.ports) == 4, 'no-cache 应该强制重新验证'
+    session.get(server.url + '/a')
+    session.get(server.url + '/a')
+    assert len(server.ports) == 6, '没有缓存信息的响应不应被缓存'
+    session.get(server.url + '/cache/30', auth=('user', 'secret'))
+    resp = session.get(server.url + '/cache/30')
+    assert not getattr(resp, 'from_cache', False)
+    assert len(server.ports) == 8, '带有认证信息的请求的响应不应被缓存'
+    # 共享的存储中不使用 pickle，被篡改的记录只会被当作未命中
+    entry = storage.get('GET ' + server.url + '/cache/60')
+    assert isinstance(entry['content'], bytes) and entry['content']
+    if isinstance(storage, cache.FileStorage):
+        path = storage._path('GET ' + server.url + '/cache/60')
+        json.loads(open(path, 'rb').read().decode('utf-8'))
+        with open(path, 'wb') as f:
+            f.write(pickle.dumps(entry))
+        assert storage.get('GET ' + server.url + '/cache/60') is None
+
+
+class TwoAddressResolver(object):
+    """把所有主机名解释为 127.0.0.1 和 127.0.0.2。"""
+
+    def resolve(self, hostname, family=None):
+        return ['127.0.0.1', '127.0.0.2'], 60
+
+
+def test_hedge(server):
+    resolvecache.set_cache_system(resolvecache.SimpleCache())
+    resolvecache.set_resolver(TwoAddressResolver())
+    try:
+        hedging = hedge.Hedge(percentile=50, min_samples=4, max_ratio=1.0)
+        recorder = timing.Recorder()
+        session = http.Session(hedge=hedging, timing=recorder)
+        url = 'http://localhost:%d' % server.server_address[1]
+        for i in range(4):
+            assert session.get(url + '/fast').status_code == 200
+        assert hedging.stats()['hedged'] == 0, '样本不足时不应对冲'
+        for i in range(2):
+            started = time.monotonic()
+            resp = session.get(url + '/slow/1')
+            assert time.monotonic() - started < 0.8, '对冲请求应该更早完成'
+            assert resp.json()['path'] == '/slow/1'
+        stats = hedging.stats()
+        assert stats['hedged'] >= 1 and stats['hedge_wins'] >= 1
+        hedged = '127.0.0.2:%d' % server.server_address[1]
+        assert recorder.snapshot()[hedged]['phases']['connect']['count'], \
+            '对冲的尝试也应该记录各阶段的耗时'
+        assert session.post(server.url + '/fast').status_code == 200
+    finally:
+        resolvecache.set_resolver()
+        resolvecache.set_cache_system(resolvecache.SimpleCache())
+        resolvecache._COUNTERS.clear()
+
+
+def test_hedge_deadline_and_fork():
+    hedging = hedge.Hedge(min_samples=1, min_delay=0.01, max_ratio=1.0)
+    hedging.record('stuck.test', 0.01)
+    started = time.monotonic()
+    with pytest.raises(requests.Timeout):
+        hedging.send('http://stuck.test/', None,
+                     lambda url, headers: time.sleep(1) or io.BytesIO(),
+                     timeout=(0.1, 0.1))
+    assert time.monotonic() - started < 0.5, '等待对冲的尝试不应超过请求的超时'
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if hedging._submit(lambda: 1).result(timeout=2) == 1
+                 else 1)
+    _, status = os.waitpid(pid, 0)
+    assert status == 0, 'fork 出的子进程应该使用自己的线程池'
+
+
+def test_download_and_upload(server, tmp_path):
+    payload = server.payload
+    digest = 'sha256:' + hashlib.sha256(payload).hexdigest()
+    path = str(tmp_path / 'file')
+    reports = []
+    size = http.download(server.url + '/file', path, checksum=digest,
+                         chunk_size=65536,
+                         progress=lambda done, total: reports.append(done))
+    assert size == len(payload) and open(path, 'rb').read() == payload
+    assert reports[-1] == len(payload) and len(reports) == 16
+    # 断点续传
+    with open(path + '.part', 'wb') as f:
+        f.write(payload[:100000])
+    http.download(server.url + '/file', path, checksum=digest)
+    assert server.ranges[-1] == 'bytes=100000-'
+    assert open(path, 'rb').read() == payload
+    # 临时文件比服务端的文件还长时，从头开始下载
+    with open(path + '.part', 'wb') as f:
+        f.write(payload + b'extra')
+    http.download(server.url + '/file', path, checksum=digest)
+    assert server.ranges[-2:] == ['bytes=%d-' % (len(payload) + 5), None]
+    assert open(path, 'rb').read() == payload
+    with pytest.raises(http.transfer.ChecksumMismatch):
+        http.download(server.url + '/file', path, checksum='md5:00')
+    assert not (tmp_path / 'file.part').exists(), '校验失败时应该删除临时文件'
+    reports = []
+    resp = http.upload(server.url + '/upload', path, chunk_size=65536,
+                       progress=lambda done, total: reports.append(done))
+    assert resp.status_code == 201 and server.uploaded == payload
+    assert reports[-1] == len(payload)
+    (tmp_path / 'empty').write_bytes(b'')
+    http.upload(server.url + '/upload', str(tmp_path / 'empty'))
+    assert server.uploaded == b''
+
+
+def test_timing(server):
+    recorder = timing.Recorder()
+    seen = []
+    recorder.add_hook(seen.append)
+    session = http.Session(timing=recorder)
+    url = 'http://localhost:%d' % server.server_address[1]
+    for i in range(3):
+        assert session.get(url + '/%d' % i).status_code == 200
+    first, second = seen[0], seen[1]
+    assert not first.reused and second.reused, '第二个请求应该复用连接'
+    assert first.dns is not None and first.connect is not None
+    assert second.dns is None and second.connect is None
+    assert first.tls is None, 'http 请求没有 TLS 握手'
+    assert 0 < first.ttfb <= first.total
+    assert first.dns + first.connect + first.ttfb <= first.total, \
+        'ttfb 不应包括解析和连接的时间'
+    with pytest.raises(requests.ConnectionError):
+        session.get('http://127.0.0.1:1/')
+    stats = recorder.snapshot()
+    host = 'localhost:%d' % server.server_address[1]
+    assert stats[host]['requests'] == 3 and stats[host]['reused'] == 2
+    assert stats[host]['phases']['total']['count'] == 3
+    assert stats[host]['phases']['dns']['count'] == 1
+    assert stats['127.0.0.1:1']['errors'] == 1
+    text = recorder.export()
+    assert 'httpkit_request_seconds_count{host="%s",phase="total"} 3' % host \
+        in text
+    assert 'httpkit_reused_total{host="%s"} 2' % host in text
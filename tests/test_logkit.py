@@ -2,6 +2,11 @@
 # Copyright (C) 2014-2016 Xue Can <xuecan@gmail.com> and contributors.
 # Licensed under the MIT license: http://opensource.org/licenses/mit-license
 
+import os
+import json
+import time
+import asyncio
+import threading
 import logging
 import shutil
 from ganggu import logkit
@@ -45,3 +50,281 @@ def test_file_handler(tmpdir):
     content = logfile.read()
     assert 'Foo!' not in content, '旧日志应该已经被移走了'
     assert 'Foobar!' in content, '新日志应被写入日志文件名指向的文件'
+
+
+class SlowHandler(logging.Handler):
+    """每条日志记录都需要一段时间才能处理完的处理器。"""
+
+    def __init__(self, delay):
+        super(SlowHandler, self).__init__()
+        self.delay = delay
+        self.messages = []
+
+    def emit(self, record):
+        time.sleep(self.delay)
+        self.messages.append(record.getMessage())
+
+
+def test_async_handlers():
+    logger = logkit.get_logger('test.async').setPropagate(False)
+    logger.clearHandlers().setLevel('INFO')
+    slow = SlowHandler(0.01)
+    logger.addHandler(slow)
+    hdlr = logkit.setup_async_handlers(logger, queue_size=5)
+    assert logger.handlers == [hdlr] and hdlr.handlers == (slow,)
+    started = time.monotonic()
+    for i in range(50):
+        logger.info('message %d', i)
+    assert time.monotonic() - started < 0.2, '日志调用不应等待处理器'
+    assert hdlr.dropped > 0, '队列已满时应该丢弃日志记录'
+    time.sleep(0.2)
+    logger.info('last')
+    hdlr.stop()
+    assert slow.messages[0] == 'message 0' and slow.messages[-1] == 'last'
+    assert any('dropped' in message for message in slow.messages)
+    assert len(slow.messages) == 50 - hdlr.dropped + 2
+    full = logkit.AsyncHandler([SlowHandler(0)], queue_size=1)
+    full.listener.stop()
+    record = logging.makeLogRecord({'msg': 'x'})
+    threads = [threading.Thread(
+        target=lambda: [full.emit(record) for _ in range(1000)])
+        for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert full.dropped == 3999, '并发时丢弃计数应该准确'
+    logger.clearHandlers()
+    blocking = SlowHandler(0)
+    logger.addHandler(blocking)
+    hdlr = logkit.setup_async_handlers(logger, queue_size=2,
+                                       policy=logkit.BLOCK)
+    for i in range(20):
+        logger.info('message %d', i)
+    logkit._reset_after_fork()
+    logger.info('after fork')
+    hdlr.stop()
+    assert hdlr.dropped == 0 and blocking.messages[-1] == 'after fork'
+    logger.clearHandlers()
+
+
+def test_buffered_file_handler(tmpdir, monkeypatch):
+    logfile = tmpdir.join('buffered.log')
+    filename = logfile.strpath
+    calls = []
+    writev = os.writev
+    monkeypatch.setattr(os, 'writev',
+                        lambda fd, buffers: calls.append(len(buffers)) or
+                        writev(fd, buffers))
+    logger = logkit.get_logger('test.buffered').setPropagate(False)
+    logger.clearHandlers()
+    logkit.setup_file_handler(filename, 'INFO', logger, buffered=True)
+    handler = logger.handlers[0]
+    assert isinstance(handler, logkit.BufferedFileHandler)
+    handler.check_interval = 0
+    for i in range(10):
+        logger.info('line %d', i)
+    assert logfile.read() == '', '日志记录应该被缓冲'
+    logger.error('Boom!')
+    content = logfile.read()
+    assert 'line 9' in content and 'Boom!' in content, 'ERROR 应该立即写入'
+    assert calls == [11], '一批日志记录应该只调用一次 writev'
+    rotated = filename + '.1'
+    shutil.move(filename, rotated)
+    logger.info('Foobar!')
+    handler.flush_interval = 0.05
+    deadline = time.monotonic() + 3
+    while not logfile.check() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert 'Foobar!' in logfile.read(), '缓冲时间过长时应该由后台线程写入'
+    assert 'Foobar!' not in open(rotated).read()
+    logger.info('x' * logkit.DEFAULTS['BUFFER-SIZE'])
+    assert logfile.size() > logkit.DEFAULTS['BUFFER-SIZE']
+    logger.info('closed')
+    logger.clearHandlers()
+    handler.close()
+    assert 'closed' in logfile.read()
+
+
+def test_json_formatter(tmpdir, monkeypatch):
+    logfile = tmpdir.join('json.log')
+    logger = logkit.get_logger('test.json').setPropagate(False)
+    logger.clearHandlers()
+    logkit.setup_file_handler(logfile.strpath, 'INFO', logger, json=True)
+    logger.info('hello %s', '世界', extra={'request_id': 'r1', 'n': {1, 2}})
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        logger.exception('failed')
+    logger.clearHandlers()
+    first, second = [json.loads(line) for line in logfile.readlines()]
+    assert list(first)[:5] == ['time', 'name', 'process', 'level', 'message']
+    assert first['message'] == 'hello 世界' and first['level'] == 'INFO'
+    assert first['request_id'] == 'r1', 'extra 中的字段应该被输出'
+    assert first['n'] == str({1, 2}), '不能编码的值应该被转换为字符串'
+    assert first['time'][10] == 'T' and first['time'][19] == '.'
+    assert 'ZeroDivisionError' in second['exc_info']
+    formatter = logkit.JSONFormatter(fields=[('msg', 'message')],
+                                     extra=False)
+    record = logging.makeLogRecord({'msg': 'a %d', 'args': (1,), 'x': 1})
+    assert formatter.format(record) == '{"msg":"a 1"}'
+    monkeypatch.setattr(logkit, 'orjson', None)
+    formatter = logkit.JSONFormatter(fields=[('msg', 'message')])
+    assert formatter.format(record) == '{"msg":"a 1","x":1}', \
+        '没有 orjson 时应该使用标准库'
+
+
+class ListHandler(logging.Handler):
+    """把日志记录保存在列表中的处理器。"""
+
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_rate_limit():
+    logger = logkit.get_logger('test.ratelimit').setPropagate(False)
+    logger.clearHandlers().setLevel('DEBUG')
+    handler = ListHandler()
+    logger.addHandler(handler)
+    for i in range(10):
+        logger.debug('sampled %d', i, sample=4)
+        logger.info('limited %d', i, rate=3)
+    messages = [record.getMessage() for record in handler.records]
+    assert [m for m in messages if m.startswith('sampled')] == \
+        ['sampled 0', 'sampled 4', 'sampled 8']
+    assert [m for m in messages if m.startswith('limited')] == \
+        ['limited 0', 'limited 1', 'limited 2']
+    assert handler.records[0].pathname == __file__, '调用位置应该是调用者'
+    del handler.records[:]
+    assert logger.report_suppressed() == 14
+    summary = handler.records[0]
+    assert summary.levelno == logging.INFO
+    assert "'limited %d' x7" in summary.getMessage()
+    assert logger.report_suppressed() == 0
+    logger.set_rate_limit(sample=2)
+    for i in range(4):
+        logger.warning('same')
+    logger._summary_at = 0
+    logger.warning('other')
+    messages = [record.getMessage() for record in handler.records[1:]]
+    assert messages == ['same', 'same',
+                        "suppressed 2 log records: 'same' x2", 'other']
+    logger.warning('same')
+    logger.warning('same')
+    logkit._report_all_suppressed()
+    assert handler.records[-1].getMessage() == \
+        "suppressed 1 log records: 'same' x1", '退出时应该报告所有日志器'
+    logger.set_rate_limit()
+    logger.clearHandlers()
+
+
+def test_aggregator(tmpdir):
+    logger = logkit.get_logger('test.aggregator').setPropagate(False)
+    logger.clearHandlers().setLevel('INFO')
+    handler = ListHandler()
+    logger.addHandler(handler)
+    aggregator = logkit.setup_aggregator(logger)
+    assert isinstance(logger.handlers[0], logkit.AggregatedHandler)
+    logger.info('from parent')
+    children = []
+    for n in range(3):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                for i in range(300):
+                    logger.info('child %d line %d %s', n, i, 'x' * (i * 10))
+                logger.handlers[0].close()
+            finally:
+                os._exit(0)
+        children.append(pid)
+    for pid in children:
+        os.waitpid(pid, 0)
+    aggregator.close()
+    assert not os.path.exists(aggregator.path)
+    messages = [record.getMessage() for record in handler.records]
+    assert messages[0] == 'from parent'
+    for n in range(3):
+        lines = [m for m in messages if m.startswith('child %d ' % n)]
+        assert lines == ['child %d line %d %s' % (n, i, 'x' * (i * 10))
+                         for i in range(300)], '每个子进程的日志应该完整有序'
+    assert handler.records[-1].process in children
+    logger.clearHandlers()
+
+
+def test_context():
+    logger = logkit.get_logger('test.context').setPropagate(False)
+    logger.clearHandlers().setLevel('INFO')
+    handler = ListHandler()
+    logger.addHandler(handler)
+    token = logkit.bind(request_id='r1')
+    logger.info('bound')
+    logger.info('explicit', extra={'request_id': 'r0'})
+    with logkit.bound_context(user='u1'):
+        assert logkit.get_context() == {'request_id': 'r1', 'user': 'u1'}
+        thread = logkit.ContextThread(target=logger.info, args=('thread',))
+        thread.start()
+        thread.join()
+        with logkit.ContextExecutor(1) as executor:
+            executor.submit(logger.info, 'executor').result()
+        thread = threading.Thread(target=logger.info, args=('plain',))
+        thread.start()
+        thread.join()
+    assert logkit.get_context() == {'request_id': 'r1'}
+
+    async def task(request_id):
+        logkit.bind(request_id=request_id)
+        await asyncio.sleep(0.01)
+        logger.info('task')
+
+    async def main():
+        await asyncio.gather(task('a'), task('b'))
+        logger.info('main')
+
+    asyncio.run(main())
+    logkit.unbind('request_id')
+    logger.info('unbound')
+    logkit.reset_context(token)
+    assert logkit.get_context() == {}
+    fields = [(record.getMessage(), getattr(record, 'request_id', None),
+               getattr(record, 'user', None)) for record in handler.records]
+    assert fields[:5] == [('bound', 'r1', None), ('explicit', 'r0', None),
+                          ('thread', 'r1', 'u1'), ('executor', 'r1', 'u1'),
+                          ('plain', None, None)]
+    assert sorted(fields[5:7]) == [('task', 'a', None), ('task', 'b', None)]
+    assert fields[7:] == [('main', 'r1', None), ('unbound', None, None)], \
+        '任务中绑定的字段不应影响其它任务'
+    logger.clearHandlers()
+
+
+def test_context_of_background_threads():
+    logger = logkit.get_logger('test.context.async').setPropagate(False)
+    logger.clearHandlers().setLevel('INFO')
+    handler = ListHandler()
+    logger.addHandler(handler)
+    with logkit.bound_context(request_id='setup-time'):
+        hdlr = logkit.setup_async_handlers(logger)
+    assert logkit.CONTEXT_FILTER not in handler.filters, \
+        '移到后台线程中的处理器不应再加上上下文字段'
+    logger.info('outside any context')
+    with logkit.bound_context(request_id='r2'):
+        logger.info('inside')
+    hdlr.stop()
+    fields = [(record.getMessage(), getattr(record, 'request_id', None))
+              for record in handler.records]
+    assert fields == [('outside any context', None), ('inside', 'r2')], \
+        '后台线程不应带有启动时绑定的字段'
+    logger.clearHandlers()
+    shared = ListHandler()
+    first = logkit.get_logger('test.context.first').setPropagate(False)
+    second = logkit.get_logger('test.context.second').setPropagate(False)
+    first.addHandler(shared)
+    second.addHandler(shared)
+    logkit.setup_async_handlers(first).stop()
+    assert logkit.CONTEXT_FILTER in shared.filters, \
+        '仍然属于其它日志器的处理器应该保留过滤器'
+    first.clearHandlers()
+    second.clearHandlers()
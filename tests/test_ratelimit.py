@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012-2016 Xue Can <xuecan@gmail.com> and contributors.
+# Licensed under the MIT license: http://opensource.org/licenses/mit-license
+
+import pytest
+from redis.crc import key_slot
+from ganggu import ratelimit
+
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('lupa')  # fakeredis 需要 lupa 执行 Lua 脚本
+
+
+@pytest.fixture
+def store():
+    return fakeredis.FakeStrictRedis()
+
+
+def test_sliding_window(store):
+    limiter = ratelimit.SlidingWindowLimiter(store, limit=3, window=60)
+    results = [limiter.hit('api') for _ in range(4)]
+    assert [r.allowed for r in results] == [True, True, True, False]
+    assert [r.remaining for r in results] == [2, 1, 0, 0]
+    assert 59 < results[-1].retry_after <= 60
+    assert limiter.hit('other').allowed, '不同的限流对象应该互不影响'
+    with pytest.raises(ratelimit.RateLimitExceeded):
+        limiter.acquire('api', timeout=0.1)
+    closed = ratelimit.SlidingWindowLimiter(store, limit=0, window=60)
+    result = closed.hit('api')
+    assert not result.allowed and result.retry_after == 60
+    store.delete('ratelimit:sw:api')
+    script = ratelimit.SlidingWindowLimiter(store, limit=3, window=60)._script
+    assert script(keys=['ratelimit:sw:api'], args=[60000, 0, 'x']) == \
+        [0, 0, 60000], '脚本本身也应该处理空集合'
+
+
+def test_token_bucket(store):
+    limiter = ratelimit.TokenBucketLimiter(store, rate=20, capacity=2)
+    assert limiter.hit('api').allowed
+    assert limiter.hit('api').allowed
+    result = limiter.hit('api')
+    assert not result.allowed and 0 < result.retry_after <= 0.05
+    assert limiter.acquire('api', timeout=1.0).allowed
+    # 脚本应该已被缓存，之后只使用 EVALSHA
+    assert store.script_exists(limiter._script.sha) == [True]
+
+
+def test_fenced_lock(store):
+    lock1 = ratelimit.FencedLock(store, 'job', ttl=5)
+    lock2 = ratelimit.FencedLock(store, 'job', ttl=5)
+    fence1 = lock1.acquire()
+    assert fence1 is not None
+    assert lock2.acquire(blocking=False) is None
+    assert lock1.extend(10)
+    assert lock1.release()
+    assert not lock1.release()
+    with lock2:
+        assert lock2.fence > fence1, '防护令牌应该单调递增'
+        assert not lock1.extend()
+    assert store.get(lock2.key) is None
+    assert key_slot(lock1.key.encode()) == \
+        key_slot(lock1.fence_key.encode()), '锁和令牌的键应该位于同一个槽'
+    with pytest.raises(TypeError):
+        ratelimit._Limiter(store)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012-2016 Xue Can <xuecan@gmail.com> and contributors.
+# Licensed under the MIT license: http://opensource.org/licenses/mit-license
+
+import time
+import asyncio
+import redis
+import pytest
+from ganggu import redisstore
+
+
+def test_normalize_uri():
+    uri = 'REDIS+strict://:p%40ss@LocalHost/3'
+    assert redisstore.normalize_uri(uri) == 'redis://:p%40ss@localhost:6379/3'
+    assert redisstore.normalize_uri('redis://127.0.0.1') == \
+        'redis://127.0.0.1:6379/0'
+    with pytest.raises(ValueError):
+        redisstore.normalize_uri('http://127.0.0.1/0')
+
+
+def test_shared_pool():
+    redisstore.close_all()
+    store1 = redisstore.get_redis_store('redis://127.0.0.1:6379/1',
+                                        max_connections=7)
+    store2 = redisstore.get_redis_store('redis+strict://127.0.0.1/1')
+    store3 = redisstore.get_redis_store('redis://127.0.0.1:6379/2')
+    assert store1 is store2, '同一 URI 应该得到同一个实例'
+    assert store1 is not store3
+    pool = store1.connection_pool
+    assert isinstance(pool, redis.BlockingConnectionPool)
+    assert pool.max_connections == 7
+    assert pool.connection_kwargs['db'] == 1
+    redisstore.close_all()
+    assert redisstore.get_redis_store('redis://127.0.0.1/1') is not store1
+
+
+def test_reset_after_fork():
+    store = redisstore.get_redis_store('redis://127.0.0.1/4')
+    redisstore._reset_after_fork()
+    assert redisstore.get_redis_store('redis://127.0.0.1/4') is not store
+    redisstore.close_all()
+
+
+def test_batch_store():
+    fakeredis = pytest.importorskip('fakeredis')
+    store = fakeredis.FakeStrictRedis()
+    batch = redisstore.BatchStore(store, chunk_size=3)
+    items = [('k%d' % i, str(i)) for i in range(10)]
+    assert all(batch.mset_many(items, ex=60))
+    keys = [key for key, _ in items] + ['missing']
+    values = list(batch.mget_many(iter(keys)))
+    assert values == [value.encode() for _, value in items] + [None]
+    assert list(batch.expire_many(['k0', 'missing'], 10)) == [True, False]
+    store.hset('h1', 'a', '1')
+    assert list(batch.hgetall_many(['h1', 'h2'])) == [{b'a': b'1'}, {}]
+    assert sum(batch.delete_many(keys)) == 10
+    assert store.dbsize() == 1
+
+
+def test_cluster_and_sentinel_uri():
+    uri = 'redis+sentinel://:pass@Sentinel1:26379,sentinel2/mymaster/2'
+    params = redisstore._parse_uri(uri)
+    assert params['hosts'] == [('sentinel1', 26379), ('sentinel2', 26379)], \
+        'sentinel 的默认端口应该是 26379'
+    assert params['service'] == 'mymaster' and params['db'] == 2
+    assert params['password'] == 'pass'
+    assert redisstore.normalize_uri(uri) == \
+        'redis+sentinel://:pass@sentinel1:26379,sentinel2:26379/mymaster/2'
+    params = redisstore._parse_uri('redis+cluster://node1:7000,node2:7001')
+    assert params['hosts'] == [('node1', 7000), ('node2', 7001)]
+    with pytest.raises(ValueError):
+        redisstore._parse_uri('redis+sentinel://sentinel1:26379')
+    with pytest.raises(ValueError):
+        redisstore._parse_uri('redis+cluster://node1:7000/1')
+    with pytest.raises(ValueError):
+        redisstore._parse_uri('redis://node1:7000,node2:7001/0')
+
+
+def test_sentinel_store():
+    fakeredis = pytest.importorskip('fakeredis')
+    master = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+    replica = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+    replica.set('foo', 'replica')
+    store = redisstore.SentinelStore(master.connection_pool,
+                                     replica.connection_pool)
+    store.set('foo', 'master')
+    assert store.get('foo') == b'replica', '读操作应该发送到 replica'
+    assert master.get('foo') == b'master', '写操作应该发送到 master'
+
+
+def _wait_for(condition, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_near_cache():
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    store = fakeredis.FakeStrictRedis(server=server)
+    other = fakeredis.FakeStrictRedis(server=server)
+    cache1 = redisstore.NearCache(store, maxsize=2)
+    cache2 = redisstore.NearCache(other, maxsize=2)
+    try:
+        store.set('a', '1')
+        assert cache1.get('a') == b'1' and cache1.get(b'a') == b'1'
+        assert cache2.get('a') == b'1'
+        assert cache1.stats()['hits'] == 1 and cache1.stats()['misses'] == 1
+        cache1.get('b')
+        cache1.get('c')
+        assert cache1.stats()['evictions'] == 1
+        assert cache1.stats()['size'] == 2
+        cache1.set('a', '3')
+        assert cache1.get('a') == b'3'
+        # 另一个进程内缓存应该通过失效通知得知变化
+        assert _wait_for(lambda: cache2.stats()['size'] == 0)
+        assert cache2.get('a') == b'3'
+        cache1._handle_message({'type': 'message', 'data': [b'a']})
+        assert cache1.stats()['invalidations'] >= 1
+        cache1._handle_message({'type': 'message', 'data': None})
+        assert cache1.stats()['size'] == 0
+    finally:
+        cache1.close()
+        cache2.close()
+
+
+def test_async_redis_store():
+    async def main():
+        store1 = redisstore.make_async_redis_store('redis://127.0.0.1/5')
+        store2 = redisstore.make_async_redis_store(
+            'redis+strict://127.0.0.1:6379/5')
+        assert store1 is store2, '同一事件循环中同一 URI 应该得到同一个实例'
+        assert isinstance(store1.connection_pool,
+                          redis.asyncio.BlockingConnectionPool)
+        await redisstore.async_close_all()
+        return store1
+
+    store = asyncio.run(main())
+    assert asyncio.run(main()) is not store, '不同事件循环不应共享连接池'
+
+
+def test_async_batch_store():
+    fakeredis = pytest.importorskip('fakeredis')
+
+    async def main():
+        store = fakeredis.FakeAsyncRedis()
+        batch = redisstore.AsyncBatchStore(store, chunk_size=3)
+        items = dict(('k%d' % i, str(i)) for i in range(7))
+        assert all([result async for result in batch.mset_many(items)])
+        values = [value async for value in batch.mget_many(list(items) + ['x'])]
+        assert values == [value.encode() for value in items.values()] + [None]
+        deleted = [count async for count in batch.delete_many(items)]
+        assert sum(deleted) == 7
+
+    asyncio.run(main())
+
+
+def test_codec():
+    value = {'name': '港股', 'items': list(range(500))}
+    for serializer in redisstore.SERIALIZERS:
+        codec = redisstore.Codec(serializer)
+        assert codec.decode(codec.encode(value)) == value
+        for compression in redisstore.COMPRESSORS:
+            codec = redisstore.Codec(serializer, compression, threshold=64)
+            payload = codec.encode(value)
+            assert payload[:1] != b'\x00', '超过阈值的数据应该被压缩'
+            assert redisstore.Codec(serializer).decode(payload) == value
+    assert redisstore.Codec().decode(None) is None
+    with pytest.raises(ValueError):
+        redisstore.Codec('yaml')
+
+
+def test_codec_store():
+    fakeredis = pytest.importorskip('fakeredis')
+    codec = redisstore.Codec('pickle', 'zlib', threshold=16)
+    store = redisstore.CodecStore(fakeredis.FakeStrictRedis(), codec)
+    store.set('a', {'x': 1})
+    assert store.get('a') == {'x': 1}
+    assert store.get('missing', 0) == 0
+    assert store.mset({'b': [1, 2], 'c': 'x' * 100})
+    assert store.mget(['b', 'c', 'd']) == [[1, 2], 'x' * 100, None]
+    store.hset('h', 'f', (1, 2))
+    assert store.hget('h', 'f') == (1, 2)
+    assert store.exists('a') == 1, '其它命令应该直接交给被包装的客户端'
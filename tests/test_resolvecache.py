@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012-2016 Xue Can <xuecan@gmail.com> and contributors.
+# Licensed under the MIT license: http://opensource.org/licenses/mit-license
+
+import os
+import time
+import socket
+import struct
+import asyncio
+import threading
+import pytest
+from ganggu import resolvecache
+
+
+class FakeResolver(object):
+    """按预设的结果应答的解释器，记录查询次数。"""
+
+    def __init__(self, records, delay=0):
+        # hostname -> (地址列表, TTL)，值为 None 表示不存在
+        self.records = records
+        self.delay = delay
+        self.calls = 0
+
+    def resolve(self, hostname, family=socket.AF_INET):
+        self.calls += 1
+        time.sleep(self.delay)
+        record = self.records.get(hostname)
+        if record is None:
+            raise socket.gaierror(socket.EAI_NONAME, 'not found')
+        return list(record[0]), record[1]
+
+    async def aresolve(self, hostname, family=socket.AF_INET):
+        await asyncio.sleep(0)
+        return self.resolve(hostname, family)
+
+
+@pytest.fixture
+def resolver():
+    resolver = FakeResolver({
+        'a.example': (['10.0.0.1', '10.0.0.2'], 60),
+        'b.example': (['10.0.0.3'], None),
+        'short.example': (['10.0.0.4'], 0),
+        'c.example': (['10.0.0.5', '10.0.0.6', '10.0.0.7'], 60),
+        'v6.example': (['::1'], 60),
+    })
+    resolvecache.set_cache_system(resolvecache.SimpleCache())
+    resolvecache.set_resolver(resolver)
+    yield resolver
+    resolvecache.set_resolver()
+    resolvecache.set_cache_system(resolvecache.SimpleCache())
+    resolvecache._COUNTERS.clear()
+    resolvecache._FAILURES.clear()
+    resolvecache._REFRESH_FAILURES.clear()
+
+
+def _expires(hostname):
+    cache = resolvecache.RUNTIME['CACHE']
+    return cache.get(resolvecache._cache_key(hostname))[1] - time.time()
+
+
+def test_resolve(resolver):
+    assert resolvecache.resolve('a.example') == ['10.0.0.1', '10.0.0.2']
+    assert resolvecache.hostname_to_ipaddr('a.example') == '10.0.0.1'
+    assert resolver.calls == 1, '结果应该被缓存'
+    assert 59 < _expires('a.example') <= 60, '应该遵循记录的 TTL'
+    resolvecache.resolve('b.example')
+    assert _expires('b.example') > resolvecache.DEFAULT_TTL - 1
+    resolvecache.resolve('short.example')
+    assert 0 < _expires('short.example') <= resolvecache.MIN_TTL
+    resolvecache.resolve('b.example', timeout=5)
+    assert resolvecache.url('http://u:p@a.example:8080/x?y=1') == \
+        'http://u:p@10.0.0.1:8080/x?y=1'
+
+
+def test_negative_cache(resolver):
+    for _ in range(3):
+        with pytest.raises(resolvecache.ResolveError):
+            resolvecache.resolve('missing.example')
+    assert resolver.calls == 1, '失败的结果也应该被缓存'
+    assert 0 < _expires('missing.example') <= resolvecache.NEGATIVE_TTL
+    with pytest.raises(RuntimeError):
+        resolvecache.hostname_to_ipaddr('missing.example')
+
+
+def test_aresolve(resolver):
+    async def main():
+        first = await resolvecache.aresolve('a.example')
+        second = await resolvecache.aresolve('a.example')
+        with pytest.raises(socket.gaierror):
+            await resolvecache.aresolve('missing.example')
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first == second == ['10.0.0.1', '10.0.0.2']
+    assert resolver.calls == 2
+
+
+def test_system_resolver():
+    addresses, ttl = resolvecache.SystemResolver().resolve('127.0.0.1')
+    assert addresses == ['127.0.0.1'] and ttl is None
+    addresses, ttl = asyncio.run(
+        resolvecache.SystemResolver().aresolve('127.0.0.1'))
+    assert addresses == ['127.0.0.1']
+
+
+def _expire(hostname):
+    """让缓存的记录过期，但仍在 STALE_TTL 之内。"""
+    cache = resolvecache.RUNTIME['CACHE']
+    key = resolvecache._cache_key(hostname)
+    addresses, _, error = cache.get(key)
+    cache.set(key, (addresses, time.time() - 1, error), 3600)
+
+
+def test_single_flight(resolver):
+    resolver.delay = 0.2
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(resolvecache.resolve('a.example')))
+        for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert resolver.calls == 1, '并发的查询应该被合并'
+    assert results == [['10.0.0.1', '10.0.0.2']] * 10
+
+    async def main():
+        resolvecache.RUNTIME['CACHE'].clear()
+        return await asyncio.gather(
+            *[resolvecache.aresolve('b.example') for _ in range(10)])
+
+    resolver.delay = 0
+    assert asyncio.run(main()) == [['10.0.0.3']] * 10
+    assert resolver.calls == 2
+
+
+def test_stale_while_revalidate(resolver):
+    resolvecache.resolve('a.example')
+    _expire('a.example')
+    resolver.records['a.example'] = (['10.0.0.9'], 60)
+    resolver.delay = 0.2
+    started = time.monotonic()
+    assert resolvecache.resolve('a.example') == ['10.0.0.1', '10.0.0.2']
+    assert time.monotonic() - started < 0.1, '过期的记录应该被立即返回'
+    deadline = time.monotonic() + 3
+    while resolvecache.resolve('a.example') != ['10.0.0.9']:
+        assert time.monotonic() < deadline, '记录应该在后台被刷新'
+        time.sleep(0.01)
+    assert resolver.calls == 2
+    # 刷新失败时继续使用原来的地址
+    _expire('a.example')
+    resolver.records['a.example'] = None
+    resolver.delay = 0
+    assert resolvecache.resolve('a.example') == ['10.0.0.9']
+    time.sleep(0.1)
+    assert resolvecache.resolve('a.example') == ['10.0.0.9']
+    assert resolver.calls == 3, 'NEGATIVE_TTL 秒内不应再次刷新'
+    assert _expires('a.example') < 0, '刷新失败不应延长原来的过期时刻'
+    # 过期超过 STALE_TTL 之后不再使用原来的地址
+    cache = resolvecache.RUNTIME['CACHE']
+    key = resolvecache._cache_key('a.example')
+    cache.set(key, (('10.0.0.9',), time.time() - resolvecache.STALE_TTL - 1,
+                    None), 3600)
+    with pytest.raises(resolvecache.ResolveError):
+        resolvecache.resolve('a.example')
+
+
+def test_stuck_flight(resolver, monkeypatch):
+    # fork 时正在进行的查询不会在子进程中完成
+    key = resolvecache._cache_key('a.example')
+    resolvecache._FLIGHTS[key] = resolvecache._Flight()
+    monkeypatch.setattr(resolvecache, 'FLIGHT_TIMEOUT', 0.05)
+    try:
+        assert resolvecache.resolve('a.example') == ['10.0.0.1', '10.0.0.2']
+    finally:
+        resolvecache._reset_after_fork()
+    assert resolvecache._FLIGHTS == {}
+
+
+def test_select_address(resolver):
+    hostname = 'c.example'
+    picked = [resolvecache.select_address(hostname) for _ in range(6)]
+    assert picked == ['10.0.0.5', '10.0.0.6', '10.0.0.7'] * 2, '应该轮询'
+    resolvecache.mark_bad('10.0.0.6')
+    picked = set(resolvecache.select_address(hostname) for _ in range(4))
+    assert picked == {'10.0.0.5', '10.0.0.7'}, '应该避开被标记的地址'
+    resolvecache.mark_bad('10.0.0.5')
+    resolvecache.mark_bad('10.0.0.7')
+    assert resolvecache.select_address(
+        hostname, resolvecache.LEAST_FAILURE) == '10.0.0.6'
+    resolvecache.mark_good('10.0.0.7')
+    assert resolvecache.select_address(hostname) == '10.0.0.7'
+    with pytest.raises(ValueError):
+        resolvecache.select_address(hostname, 'random')
+    urls = set(resolvecache.smart_url('http://c.example/x')()
+               for _ in range(3))
+    assert urls == {'http://10.0.0.7/x'}
+    resolvecache._FAILURES['10.0.0.9'] = time.time() - resolvecache.BAD_TTL
+    resolvecache.mark_bad('10.0.0.5')
+    assert '10.0.0.9' not in resolvecache._FAILURES, '过期的故障标记应该被清理'
+
+
+def test_ipv6(resolver):
+    assert resolvecache.url('http://v6.example:81/') == 'http://[::1]:81/'
+    resolvecache.resolve('a.example', family=socket.AF_UNSPEC)
+    assert resolvecache.RUNTIME['CACHE'].get('resolve*:a.example')
+    resolvecache.url('http://a.example/', family=socket.AF_INET6)
+    assert resolvecache.RUNTIME['CACHE'].get('resolve6:a.example'), \
+        '应该按指定的地址族查询'
+    url = resolvecache.smart_url('http://a.example/', family=socket.AF_UNSPEC)
+    assert url() in ('http://10.0.0.1/', 'http://10.0.0.2/')
+
+
+def test_simple_cache():
+    cache = resolvecache.SimpleCache(threshold=3)
+    for i in range(5):
+        cache.set('k%d' % i, i)
+    assert cache.get('k0') is None and cache.get('k4') == 4
+    cache.set('x', 1, timeout=-1)
+    assert cache.get('x') is None
+    with pytest.raises(TypeError):
+        resolvecache.set_cache_system(object())
+
+
+def test_shared_memory_cache(tmpdir, resolver):
+    path = tmpdir.join('dns').strpath
+    cache = resolvecache.SharedMemoryCache(path, slots=16, slot_size=128)
+    cache.set('a', ['10.0.0.1', 1.5, None])
+    assert cache.get('a') == ['10.0.0.1', 1.5, None]
+    assert cache.get('b') is None
+    assert not cache.set('big', 'x' * 200), '过长的值不应被缓存'
+    cache.set('expired', 1, timeout=-1)
+    assert cache.get('expired') is None
+    for i in range(64):
+        cache.set('k%d' % i, i)
+    assert cache.get('k63') == 63, '表满时应覆盖旧的槽位'
+    assert cache.delete('k63') and cache.get('k63') is None
+    # 键已经在后面的探测位置时，前面空出的槽位不应产生第二份
+    cache.clear()
+    first = next(cache._offsets(b'x0'))
+    cache.set('x0', 0)
+    same = next('x%d' % i for i in range(1, 1000)
+                if next(cache._offsets(('x%d' % i).encode())) == first)
+    cache.set(same, 'old')
+    assert cache.delete('x0')
+    cache.set(same, 'new')
+    assert cache.delete(same) and cache.get(same) is None, \
+        '删除之后不应读到旧的值'
+    # 写入者在写入过程中退出时，读取者不应一直等待
+    cache.set('x0', 0)
+    struct.pack_into('<I', cache._mmap, first, 1)
+    assert cache.get('x0') is None
+    cache.set('x0', 1)
+    assert cache.get('x0') == 1, '下一次写入应该修复这个槽位'
+    # 另一个进程（这里是重新映射同一个文件）应该看到相同的内容
+    other = resolvecache.SharedMemoryCache(path, slots=16, slot_size=128)
+    cache.set('shared', 'yes')
+    assert other.get('shared') == 'yes'
+    with pytest.raises(ValueError):
+        resolvecache.SharedMemoryCache(path, slots=32, slot_size=128)
+    # 作为缓存机制使用，fork 出的子进程的查询结果父进程可以直接使用
+    resolvecache.set_cache_system(resolvecache.SharedMemoryCache())
+    pid = os.fork()
+    if pid == 0:
+        resolvecache.resolve('a.example')
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert resolvecache.resolve('a.example') == ['10.0.0.1', '10.0.0.2']
+    assert resolver.calls == 0
+    other.close()
+    cache.clear()
+    assert cache.get('shared') is None
+    cache.close()